@@ -0,0 +1,557 @@
+#!/usr/bin/env python3
+"""
+yt-dlp giả cho bench/: hiểu các tham số mà downloader.py truyền cho yt-dlp.exe, tải media thật từ
+bench/media_server.py (HTTP cục bộ) và in output giống yt-dlp, để đo overhead của wrapper mà không cần mạng.
+
+Kịch bản được chọn theo URL: tham số bench= (https://www.youtube.com/watch?v=<id 11 ký tự>&bench=<kịch bản>) hoặc tên
+người dùng TikTok (https://www.tiktok.com/@<kịch bản>/video/<id số>, vì wrapper bỏ query của URL TikTok).
+Kịch bản có dạng <tên>-<media>, media là mp4 (mặc định), hls hoặc dash:
+    ok-<media>          tải thành công
+    yt152-<media>       lỗi 152-18 "Watch video on YouTube", trừ khi dùng youtube:player_client=web
+    status0-<media>     TikTok "Video not available, status code 0", trừ khi dùng tiktok:player_client=ios
+    thumbonly           "only images are available"; --write-thumbnail --skip-download thì thành công
+    throttle-<media>    "HTTP Error 429: Too Many Requests" khi tải, cho tới thời điểm FAKE_YTDLP_THROTTLE_UNTIL
+    fanout-<n>-<media>  playlist (https://www.youtube.com/playlist?list=<id>&bench=...) gồm n video ok-<media>
+Nhiều URL (--batch-file) được xử lý lần lượt trong cùng tiến trình; kịch bản trong log là "batch".
+
+Biến môi trường:
+    FAKE_YTDLP_MEDIA            địa chỉ media server, vd http://127.0.0.1:8000 (bắt buộc khi tải)
+    FAKE_YTDLP_LOG              file JSONL, mỗi lần chạy ghi một dòng (tool, mode, scenario, rc, start, end)
+    FAKE_YTDLP_STARTUP          số giây giả lập thời gian khởi động của yt-dlp.exe (mặc định 0)
+    FAKE_YTDLP_EXTRACT          số giây giả lập mỗi lần extract (mặc định 0)
+    FAKE_YTDLP_COOKIES_LOCKED   =1: --cookies-from-browser luôn lỗi "Could not copy Chrome cookie database"
+    FAKE_YTDLP_FILESIZE         filesize_approx (byte) của mọi format thay cho ước lượng theo bitrate
+    FAKE_YTDLP_THROTTLE_UNTIL   epoch (giây): kịch bản throttle trả 429 trước thời điểm này (mặc định luôn trả 429)
+
+Chạy với argv[0] tên ffmpeg(.exe) thì đóng vai ffmpeg giả: nối các file -i vào file output (tham số cuối).
+"""
+import json
+import os
+import re
+import sys
+import time
+import urllib.parse
+import urllib.request
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+
+# Các tham số nhận giá trị (để tách đúng URL khỏi giá trị tham số)
+VALUE_OPTIONS = {
+    '-f', '-o', '-P', '-S', '--paths', '--impersonate', '--downloader', '--retries', '--fragment-retries',
+    '--remote-components', '--concurrent-fragments', '--http-chunk-size', '--limit-rate', '--download-archive',
+    '--cookies', '--cookies-from-browser', '--add-headers', '--extractor-args', '--js-runtimes',
+    '--merge-output-format', '--format-sort', '--ffmpeg-location', '--load-info-json', '--progress-template',
+    '--print', '--audio-format', '--audio-quality', '--postprocessor-args', '--convert-thumbnails',
+    '--remux-video', '--playlist-items', '--socket-timeout', '--sleep-requests', '--output-na-placeholder',
+    '-a', '--batch-file',
+}
+PROGRESS_INTERVAL = 0.2
+SAMPLE_COOKIES = (
+    ('.tiktok.com', 'sessionid'), ('www.tiktok.com', 'tt_csrf_token'),
+    ('.douyin.com', 'ttwid'), ('.google.com', 'NID'),
+)
+
+
+class YtdlpError(Exception):
+    pass
+
+
+def log(opts, text):
+    # Giống yt-dlp: -J/--print ngầm bật --quiet, stdout chỉ còn JSON/giá trị được in
+    if not opts['quiet']:
+        print(text, flush=True)
+
+
+def parse_args(argv):
+    opts = {'flags': set(), 'values': {}, 'print_to_file': [], 'urls': []}
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        if arg == '--print-to-file':
+            opts['print_to_file'].append((argv[i + 1], argv[i + 2]))
+            i += 3
+            continue
+        if arg in VALUE_OPTIONS:
+            opts['values'].setdefault(arg, []).append(argv[i + 1])
+            i += 2
+            continue
+        if arg.startswith('-'):
+            opts['flags'].add(arg)
+        elif '://' in arg:
+            opts['urls'].append(arg)
+        i += 1
+    opts['quiet'] = bool({'-q', '--quiet', '-J', '--dump-single-json'} & opts['flags']) or '--print' in opts['values']
+    for batch_file in opts['values'].get('-a', []) + opts['values'].get('--batch-file', []):
+        with open(batch_file, 'r', encoding='utf-8') as f:
+            opts['urls'] += [line.strip() for line in f if line.strip() and not line.startswith(('#', ';'))]
+    return opts
+
+
+def value(opts, name, default=None):
+    values = opts['values'].get(name)
+    return values[-1] if values else default
+
+
+def video_id(url):
+    parsed = urllib.parse.urlparse(url)
+    query = urllib.parse.parse_qs(parsed.query)
+    if 'v' in query:
+        return query['v'][0]
+    if 'list' in query:
+        return query['list'][0]
+    return parsed.path.rstrip('/').rsplit('/', 1)[-1]
+
+
+def extractor_for(url):
+    host = urllib.parse.urlparse(url).hostname or ''
+    if 'youtube' in host or 'youtu.be' in host:
+        return 'youtube', 'Youtube'
+    if 'tiktok' in host:
+        return 'tiktok', 'TikTok'
+    if 'douyin' in host:
+        return 'douyin', 'Douyin'
+    return 'generic', 'Generic'
+
+
+def scenario_of(url):
+    """(tên kịch bản, media, các phần của kịch bản) suy ra từ URL"""
+    parsed = urllib.parse.urlparse(url)
+    spec = urllib.parse.parse_qs(parsed.query).get('bench', [''])[0]
+    if not spec:
+        match = re.search(r'/@([^/]+)/', parsed.path)
+        spec = match.group(1) if match else 'ok'
+    parts = spec.split('-')
+    media = next((p for p in parts[1:] if p in ('mp4', 'hls', 'dash')), 'mp4')
+    return parts[0], media, parts
+
+
+def build_formats(media, base):
+    if media == 'mp4':
+        return [{'format_id': str(code), 'url': f'{base}/progressive/{height}.mp4', 'ext': 'mp4', 'protocol': 'https',
+                 'vcodec': 'avc1.64001f', 'acodec': 'mp4a.40.2', 'height': height, 'tbr': height * 2}
+                for code, height in ((18, 360), (22, 720))]
+    if media == 'hls':
+        return [{'format_id': f'hls-{height}', 'url': f'{base}/hls/{height}/index.m3u8', 'ext': 'mp4',
+                 'protocol': 'm3u8_native', 'vcodec': 'avc1.64001f', 'acodec': 'mp4a.40.2', 'height': height,
+                 'tbr': height * 2}
+                for height in (360, 720, 1080)]
+    # DASH: đọc manifest thật từ server như extractor
+    with urllib.request.urlopen(f'{base}/dash/manifest.mpd', timeout=30) as response:
+        root = ET.fromstring(response.read())
+    ns = {'mpd': 'urn:mpeg:dash:schema:mpd:2011'}
+    formats = []
+    for adaptation in root.iterfind('.//mpd:AdaptationSet', ns):
+        is_audio = adaptation.get('contentType') == 'audio'
+        for rep in adaptation.iterfind('mpd:Representation', ns):
+            fragments = [{'path': seg.get('media')} for seg in rep.iterfind('.//mpd:SegmentURL', ns)]
+            formats.append({
+                'format_id': f"dash-{rep.get('id')}", 'ext': 'm4a' if is_audio else 'mp4',
+                'protocol': 'http_dash_segments', 'fragment_base_url': f'{base}/dash/', 'fragments': fragments,
+                'vcodec': 'none' if is_audio else rep.get('codecs'), 'acodec': rep.get('codecs') if is_audio else 'none',
+                'height': None if is_audio else int(rep.get('height')),
+                'abr': int(rep.get('bandwidth')) / 1000 if is_audio else None,
+                'language': adaptation.get('lang') if is_audio else None,
+                'tbr': int(rep.get('bandwidth')) / 1000,
+            })
+    return formats
+
+
+def extract(url, opts, base):
+    """Giả lập extractor: in log giống yt-dlp, ném YtdlpError theo kịch bản, trả về info dict"""
+    extractor, extractor_key = extractor_for(url)
+    vid = video_id(url)
+    scenario, media, parts = scenario_of(url)
+    log(opts, f'[{extractor}] Extracting URL: {url}')
+    log(opts, f'[{extractor}] {vid}: Downloading webpage')
+    time.sleep(float(os.getenv('FAKE_YTDLP_EXTRACT', '0')))
+    extractor_args = ' '.join(opts['values'].get('--extractor-args', []))
+    if '--cookies-from-browser' in opts['values'] and os.getenv('FAKE_YTDLP_COOKIES_LOCKED') == '1':
+        raise YtdlpError('Could not copy Chrome cookie database. See  https://github.com/yt-dlp/yt-dlp/issues/7271')
+    if scenario == 'yt152' and 'youtube:player_client=web' not in extractor_args:
+        raise YtdlpError(f'[youtube] {vid}: Video unavailable. Watch video on YouTube. Error code: 152 - 18')
+    if scenario == 'status0' and 'tiktok:player_client=ios' not in extractor_args:
+        raise YtdlpError(f'[TikTok] {vid}: Video not available, status code 0')
+
+    if scenario == 'fanout':
+        # ID của entry cũng là ID YouTube hợp lệ (11 ký tự), duy nhất theo ID playlist
+        entries = [f'{vid[-8:]}{i:03d}' for i in range(1, int(parts[1]) + 1)]
+        return {
+            '_type': 'playlist', 'id': vid, 'title': f'Playlist {vid}', 'extractor': extractor,
+            'extractor_key': extractor_key,
+            'entries': [{'id': entry, 'title': f'Video {entry}', 'ie_key': extractor_key, 'playlist_index': i,
+                         'url': f'https://www.youtube.com/watch?v={entry}&bench=ok-{media}',
+                         'webpage_url': f'https://www.youtube.com/watch?v={entry}&bench=ok-{media}'}
+                        for i, entry in enumerate(entries, 1)],
+        }
+    formats = [] if scenario == 'thumbonly' else build_formats(media, base)
+    # Như yt-dlp: kích thước ước lượng từ bitrate và thời lượng (FAKE_YTDLP_FILESIZE: ghi đè, để thử thiếu dung lượng)
+    for f in formats:
+        f['filesize_approx'] = int(os.getenv('FAKE_YTDLP_FILESIZE') or f['tbr'] * 1000 / 8 * 40)
+    return {
+        'id': vid, 'title': f'Bench {vid}', 'extractor': extractor, 'extractor_key': extractor_key,
+        'webpage_url': url, 'original_url': url, 'duration': 40, 'formats': formats,
+        'thumbnail': f'{base}/thumb.webp', 'thumbnails': [{'url': f'{base}/thumb.webp', 'id': '0'}],
+    }
+
+
+def _matches_filter(f, expr):
+    match = re.fullmatch(r'(\w+)\s*(<=|>=|!=|\^=|\$=|\*=|=|<|>)\s*(.+)', expr)
+    if not match:
+        return True
+    key, op, expected = match.groups()
+    actual = f.get(key)
+    if actual is None:
+        return False
+    if op in ('<=', '>=', '<', '>'):
+        try:
+            a, b = float(actual), float(expected)
+        except ValueError:
+            return False
+        return {'<=': a <= b, '>=': a >= b, '<': a < b, '>': a > b}[op]
+    actual, expected = str(actual), expected.strip('\'"')
+    return {'=': actual == expected, '!=': actual != expected, '^=': actual.startswith(expected),
+            '$=': actual.endswith(expected), '*=': expected in actual}[op]
+
+
+def _pick_format(formats, token):
+    by_id = {f['format_id']: f for f in formats}
+    if token in by_id:
+        return by_id[token]
+    name = re.sub(r'\[.*?\]', '', token)
+    filters = re.findall(r'\[([^\]]+)\]', token)
+    has_video = lambda f: f.get('vcodec') not in (None, 'none')
+    has_audio = lambda f: f.get('acodec') not in (None, 'none')
+    if name in ('bv', 'bestvideo', 'bv*', 'bestvideo*'):
+        candidates = [f for f in formats if has_video(f) and (name.endswith('*') or not has_audio(f))]
+        key = lambda f: (f.get('height') or 0, f.get('tbr') or 0)
+    elif name in ('ba', 'bestaudio', 'ba*', 'bestaudio*'):
+        candidates = [f for f in formats if has_audio(f) and (name.endswith('*') or not has_video(f))]
+        key = lambda f: (f.get('abr') or f.get('tbr') or 0)
+    elif name in ('b', 'best', 'b*', 'best*'):
+        candidates = [f for f in formats if (has_video(f) or has_audio(f)) if name.endswith('*')
+                      or (has_video(f) and has_audio(f))]
+        key = lambda f: (f.get('height') or 0, f.get('tbr') or 0)
+    else:
+        return None
+    candidates = [f for f in candidates if all(_matches_filter(f, expr) for expr in filters)]
+    return max(candidates, key=key, default=None)
+
+
+def select_formats(formats, spec):
+    for alternative in (spec or 'bv*+ba/b').split('/'):
+        chosen = [_pick_format(formats, token.strip()) for token in alternative.split('+')]
+        if chosen and all(chosen):
+            return chosen
+    return None
+
+
+def render_template(template, info, ext=None):
+    fields = dict(info, ext=ext or info.get('ext') or 'mp4')
+
+    def field(match):
+        name, width = match.group(1), match.group(2)
+        text = str(fields.get(name, 'NA'))
+        return text[:int(width)] if width else text
+
+    return re.sub(r'%\((\w+)\)(?:\.(\d+))?[sdB]', field, template)
+
+
+def output_template(opts, kind=None):
+    plain, typed = None, {}
+    for template in opts['values'].get('-o', []):
+        prefix, sep, rest = template.partition(':')
+        if sep and prefix in ('thumbnail', 'subtitle', 'infojson'):
+            typed[prefix] = rest
+        else:
+            plain = template
+    return typed.get(kind) or plain or '%(title)s [%(id)s].%(ext)s'
+
+
+class Progress:
+    """In tiến độ dạng dòng [download] của yt-dlp hoặc theo --progress-template (download:...)"""
+
+    def __init__(self, opts, total, fragment_count=None):
+        template = value(opts, '--progress-template') or ''
+        self.template = template[len('download:'):] if template.startswith('download:') else None
+        self.total = total
+        self.fragment_count = fragment_count
+        self.started = time.time()
+        self.last = 0.0
+        self.done = 0
+        self.fragment_index = 0
+        self.quiet = opts['quiet'] or '--no-progress' in opts['flags']
+
+    def update(self, nbytes, fragment=False, final=False):
+        self.done += nbytes
+        if fragment:
+            self.fragment_index += 1
+        now = time.time()
+        if self.quiet or (not final and now - self.last < PROGRESS_INTERVAL):
+            return
+        self.last = now
+        elapsed = max(now - self.started, 1e-6)
+        speed = self.done / elapsed
+        eta = int((self.total - self.done) / speed) if speed and self.total else 0
+        if self.template:
+            state = {'status': 'finished' if final else 'downloading', 'downloaded_bytes': self.done,
+                     'total_bytes': self.total, 'total_bytes_estimate': self.total, 'speed': speed, 'eta': eta,
+                     'fragment_index': self.fragment_index or None, 'fragment_count': self.fragment_count}
+            marker = self.template.split('%(', 1)[0]
+            print(marker + json.dumps(state), flush=True)
+            return
+        percent = 100.0 * self.done / self.total if self.total else 0.0
+        frag = f' (frag {self.fragment_index}/{self.fragment_count})' if self.fragment_count else ''
+        if final:
+            print(f'[download] 100% of {self.total / 1024 ** 2:8.2f}MiB in {elapsed:05.2f}s at '
+                  f'{speed / 1024 ** 2:.2f}MiB/s', flush=True)
+        else:
+            print(f'[download] {percent:5.1f}% of ~{self.total / 1024 ** 2:8.2f}MiB at {speed / 1024 ** 2:8.2f}MiB/s '
+                  f'ETA {eta // 60:02d}:{eta % 60:02d}{frag}', flush=True)
+
+
+def _fetch(url):
+    with urllib.request.urlopen(url, timeout=60) as response:
+        return response.read()
+
+
+def download_format(f, path, opts):
+    log(opts, f'[download] Destination: {path}')
+    if f['protocol'] in ('m3u8_native', 'http_dash_segments'):
+        if f['protocol'] == 'm3u8_native':
+            playlist = _fetch(f['url']).decode('utf-8')
+            base = f['url'].rsplit('/', 1)[0] + '/'
+            urls = [base + line for line in playlist.splitlines() if line and not line.startswith('#')]
+        else:
+            urls = [f['fragment_base_url'] + frag['path'] for frag in f['fragments']]
+        workers = int(value(opts, '--concurrent-fragments', '1'))
+        log(opts, f"[{'hlsnative' if f['protocol'] == 'm3u8_native' else 'dashsegments'}] Total fragments: {len(urls)}")
+        # Kích thước ước lượng từ fragment đầu (giống yt-dlp: total_bytes_estimate)
+        first = _fetch(urls[0])
+        progress = Progress(opts, len(first) * len(urls), len(urls))
+        progress.update(len(first), fragment=True)
+        with open(path, 'wb') as out, ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            out.write(first)
+            for data in pool.map(_fetch, urls[1:]):
+                out.write(data)
+                progress.update(len(data), fragment=True)
+        progress.update(0, final=True)
+        return
+    with urllib.request.urlopen(f['url'], timeout=60) as response, open(path, 'wb') as out:
+        progress = Progress(opts, int(response.headers.get('Content-Length') or 0))
+        while True:
+            data = response.read(64 * 1024)
+            if not data:
+                break
+            out.write(data)
+            progress.update(len(data))
+        progress.update(0, final=True)
+
+
+def write_thumbnail(info, opts):
+    path = output_path(opts, render_template(output_template(opts, 'thumbnail'), info, 'webp'))
+    log(opts, f'[info] Downloading video thumbnail 0 ...')
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'wb') as out:
+        out.write(_fetch(info['thumbnail']))
+    log(opts, f'[info] Writing video thumbnail 0 to: {path}')
+
+
+def output_path(opts, name, kind='home'):
+    """Như yt-dlp: tên file tương đối nằm trong -P/--paths (temp: file đang tải, home: file cuối)"""
+    paths = {}
+    for item in opts['values'].get('-P', []) + opts['values'].get('--paths', []):
+        prefix, sep, rest = item.partition(':')
+        if sep and prefix in ('home', 'temp'):
+            paths[prefix] = rest
+        else:
+            paths['home'] = item
+    if os.path.isabs(name):
+        return name
+    return os.path.join(paths.get(kind) or paths.get('home') or '', name)
+
+
+def print_to_files(opts, stage, info, text):
+    for template, path in opts['print_to_file']:
+        when, _, field = template.rpartition(':') if ':' in template else ('video', '', template)
+        if (when or 'video') != stage:
+            continue
+        with open(path, 'a', encoding='utf-8') as out:
+            out.write((render_template(field, info) if re.search(r'%\(\w+\)', field) else text(field)) + '\n')
+
+
+def process_video(info, opts):
+    archive_path = value(opts, '--download-archive')
+    archive_id = f"{info['extractor_key'].lower()} {info['id']}"
+    if archive_path and os.path.exists(archive_path):
+        with open(archive_path, 'r', encoding='utf-8') as archive:
+            if archive_id in {line.strip() for line in archive}:
+                log(opts, f"[download] {info['id']}: has already been recorded in the archive")
+                return
+    print_to_files(opts, 'video', info, lambda field: json.dumps(info) if field == '%()j' else str(info.get(field, 'NA')))
+    if '--write-thumbnail' in opts['flags'] and info.get('thumbnail'):
+        write_thumbnail(info, opts)
+    if '--skip-download' in opts['flags']:
+        return
+    if not info.get('formats'):
+        raise YtdlpError(f"[{info['extractor']}] {info['id']}: Requested format is not available. "
+                         f"Use --list-formats for a list of available formats (only images are available)")
+    if scenario_of(info['webpage_url'])[0] == 'throttle' and time.time() < float(
+            os.getenv('FAKE_YTDLP_THROTTLE_UNTIL') or 'inf'):
+        raise YtdlpError('unable to download video data: HTTP Error 429: Too Many Requests')
+    chosen = select_formats(info['formats'], value(opts, '-f'))
+    if not chosen:
+        raise YtdlpError(f"[{info['extractor']}] {info['id']}: Requested format is not available. "
+                         f"Use --list-formats for a list of available formats")
+    template = output_template(opts)
+    log(opts, f"[info] {info['id']}: Downloading 1 format(s): {'+'.join(f['format_id'] for f in chosen)}")
+    if len(chosen) == 1:
+        name = render_template(template, dict(info, format_id=chosen[0]['format_id']), chosen[0]['ext'])
+        final_path = output_path(opts, name, 'temp')
+        os.makedirs(os.path.dirname(final_path) or '.', exist_ok=True)
+        download_format(chosen[0], final_path, opts)
+    else:
+        name = render_template(template, info, value(opts, '--merge-output-format', 'mp4'))
+        final_path = output_path(opts, name, 'temp')
+        os.makedirs(os.path.dirname(final_path) or '.', exist_ok=True)
+        root = final_path.rsplit('.', 1)[0]
+        parts = []
+        for f in chosen:
+            part = f"{root}.f{f['format_id']}.{f['ext']}"
+            download_format(f, part, opts)
+            parts.append(part)
+        log(opts, f'[Merger] Merging formats into "{final_path}"')
+        with open(final_path, 'wb') as out:
+            for part in parts:
+                with open(part, 'rb') as src:
+                    out.write(src.read())
+                os.remove(part)
+    if '--extract-audio' in opts['flags']:
+        mp3_path = final_path.rsplit('.', 1)[0] + '.mp3'
+        log(opts, f'[ExtractAudio] Destination: {mp3_path}')
+        os.replace(final_path, mp3_path)
+        final_path = mp3_path
+        name = name.rsplit('.', 1)[0] + '.mp3'
+    # File xong ở thư mục temp: chuyển sang thư mục home như MoveFilesAfterDownload của yt-dlp
+    home_path = output_path(opts, name)
+    if home_path != final_path:
+        log(opts, f'[MoveFiles] Moving file "{final_path}" to "{home_path}"')
+        os.makedirs(os.path.dirname(home_path) or '.', exist_ok=True)
+        os.replace(final_path, home_path)
+        final_path = home_path
+    print_to_files(opts, 'after_move', info, lambda field: final_path if field == 'filepath' else str(info.get(field, 'NA')))
+    if archive_path:
+        with open(archive_path, 'a', encoding='utf-8') as archive:
+            archive.write(archive_id + '\n')
+
+
+def export_cookies(opts):
+    """Chỉ có --cookies-from-browser + --cookies, không URL: ghi jar khi đóng như yt-dlp (rồi báo thiếu URL)"""
+    browser = value(opts, '--cookies-from-browser')
+    if os.getenv('FAKE_YTDLP_COOKIES_LOCKED') == '1':
+        print('ERROR: Could not copy Chrome cookie database. See  https://github.com/yt-dlp/yt-dlp/issues/7271',
+              file=sys.stderr, flush=True)
+        return 1
+    print(f'Extracting cookies from {browser}', flush=True)
+    with open(value(opts, '--cookies'), 'w', encoding='utf-8') as jar:
+        jar.write('# Netscape HTTP Cookie File\n')
+        for domain, name in SAMPLE_COOKIES:
+            flag = 'TRUE' if domain.startswith('.') else 'FALSE'
+            jar.write(f'{domain}\t{flag}\t/\tTRUE\t{int(time.time()) + 86400}\t{name}\tbench\n')
+    print(f'Extracted {len(SAMPLE_COOKIES)} cookies from {browser}', flush=True)
+    print('yt-dlp: error: You must provide at least one URL.', flush=True)
+    return 2
+
+
+def run_ytdlp(argv):
+    opts = parse_args(argv)
+    if '--version' in opts['flags']:
+        print('2025.01.01')
+        return 0, 'version', None
+    if '-U' in opts['flags'] or '--update' in opts['flags']:
+        print('Latest version: stable@2025.01.01\nyt-dlp is up to date (stable@2025.01.01)')
+        return 0, 'update', None
+    info_path = value(opts, '--load-info-json')
+    if not opts['urls'] and not info_path:
+        if '--cookies-from-browser' in opts['values'] and '--cookies' in opts['values']:
+            return export_cookies(opts), 'export', None
+        print('yt-dlp: error: You must provide at least one URL.', flush=True)
+        return 2, 'usage', None
+
+    base = os.getenv('FAKE_YTDLP_MEDIA', 'http://127.0.0.1:8000').rstrip('/')
+    urls = opts['urls'] or [None]
+    if len(urls) > 1:
+        scenario = 'batch'
+    else:
+        scenario = scenario_of(urls[0])[0] if urls[0] else 'load-info-json'
+    if {'-J', '--dump-single-json'} & opts['flags']:
+        mode = 'probe'
+    elif '--flat-playlist' in opts['flags']:
+        mode = 'list'
+    elif '--skip-download' in opts['flags']:
+        mode = 'thumbnail'
+    else:
+        mode = 'download'
+    # Nhiều URL (--batch-file): lỗi của một URL chỉ dừng cả lần chạy khi không có --ignore-errors
+    rc = 0
+    for url in urls:
+        try:
+            run_url(url, info_path, mode, opts, base)
+        except YtdlpError as e:
+            print(f'ERROR: {e}', file=sys.stderr, flush=True)
+            rc = 1
+            if not {'-i', '--ignore-errors'} & opts['flags']:
+                break
+    return rc, mode, scenario
+
+
+def run_url(url, info_path, mode, opts, base):
+    if info_path:
+        with open(info_path, 'r', encoding='utf-8') as f:
+            info = json.load(f)
+    else:
+        info = extract(url, opts, base)
+    if mode == 'probe':
+        # Như yt-dlp: info của video đơn lẻ kèm filename tính theo -o
+        if info.get('_type') != 'playlist':
+            info = dict(info, filename=render_template(output_template(opts), info))
+        print(json.dumps(info), flush=True)
+        return
+    entries = info.get('entries') if info.get('_type') == 'playlist' else None
+    if entries is not None and mode == 'list':
+        match = re.search(r'\{([^}]*)\}', value(opts, '--print') or '')
+        fields = re.findall(r'\w+', match.group(1)) if match else ['id', 'url', 'title']
+        for entry in entries:
+            print(json.dumps({key: entry.get(key) for key in fields}), flush=True)
+        return
+    for entry in entries if entries is not None else [None]:
+        process_video(extract(entry['webpage_url'], opts, base) if entry else info, opts)
+
+
+def run_ffmpeg(argv):
+    """ffmpeg giả: nối các file -i vào file output"""
+    inputs = [argv[i + 1] for i, arg in enumerate(argv[:-1]) if arg == '-i']
+    with open(argv[-1], 'wb') as out:
+        for path in inputs:
+            with open(path, 'rb') as src:
+                out.write(src.read())
+    return 0, 'ffmpeg', None
+
+
+def main():
+    started = time.time()
+    time.sleep(float(os.getenv('FAKE_YTDLP_STARTUP', '0')))
+    tool = 'ffmpeg' if os.path.basename(sys.argv[0]).lower().startswith('ffmpeg') else 'yt-dlp'
+    if tool == 'ffmpeg':
+        rc, mode, scenario = run_ffmpeg(sys.argv[1:])
+    else:
+        rc, mode, scenario = run_ytdlp(sys.argv[1:])
+    log_path = os.getenv('FAKE_YTDLP_LOG')
+    if log_path:
+        with open(log_path, 'a', encoding='utf-8') as log:
+            log.write(json.dumps({'tool': tool, 'mode': mode, 'scenario': scenario, 'rc': rc,
+                                  'start': started, 'end': time.time()}) + '\n')
+    return rc
+
+
+if __name__ == '__main__':
+    sys.exit(main())
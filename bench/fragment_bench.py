@@ -0,0 +1,170 @@
+"""
+Benchmark --concurrent-fragments: dựng một server HLS cục bộ (N fragment, độ trễ mỗi request, giới hạn băng thông
+mỗi kết nối) rồi tải cùng một playlist với các mức fragment song song khác nhau và in bảng thông lượng.
+
+Ví dụ:
+    python bench/fragment_bench.py --fragments 60 --latency 0.05 --conn-rate-kb 512
+    python bench/fragment_bench.py --yt-dlp resources/yt-dlp.exe --levels 1,4,16 --json bench_result.json
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FragmentServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, fragments, fragment_kb, latency, conn_rate_kb):
+        super().__init__(('127.0.0.1', 0), FragmentHandler)
+        self.fragments = fragments
+        self.payload = os.urandom(fragment_kb * 1024)
+        self.latency = latency
+        self.conn_rate = conn_rate_kb * 1024
+        self.max_inflight = 0
+        self._inflight = 0
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/index.m3u8"
+
+    def playlist(self):
+        lines = ['#EXTM3U', '#EXT-X-VERSION:3', '#EXT-X-TARGETDURATION:2', '#EXT-X-MEDIA-SEQUENCE:0']
+        for i in range(self.fragments):
+            lines += ['#EXTINF:2.0,', f'seg{i}.ts']
+        lines.append('#EXT-X-ENDLIST')
+        return ('\n'.join(lines) + '\n').encode()
+
+
+class FragmentHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        if self.path.endswith('.m3u8'):
+            body = server.playlist()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/vnd.apple.mpegurl')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        if not self.path.startswith('/seg'):
+            self.send_error(404)
+            return
+        with server._lock:
+            server._inflight += 1
+            server.max_inflight = max(server.max_inflight, server._inflight)
+        self._counted = False
+        try:
+            time.sleep(server.latency)
+            self.send_response(200)
+            self.send_header('Content-Type', 'video/mp2t')
+            self.send_header('Content-Length', str(len(server.payload)))
+            self.end_headers()
+            # Giới hạn băng thông theo từng kết nối (giống CDN), nên tải song song mới tăng được thông lượng
+            chunk = 16 * 1024
+            last = len(server.payload) - chunk
+            for offset in range(0, len(server.payload), chunk):
+                if offset >= last:
+                    # Hết đếm trước khi gửi chunk cuối, để client mở request kế tiếp không bị tính trùng
+                    self._done()
+                self.wfile.write(server.payload[offset:offset + chunk])
+                if server.conn_rate:
+                    time.sleep(chunk / server.conn_rate)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            self._done()
+
+    def _done(self):
+        if getattr(self, '_counted', True):
+            return
+        self._counted = True
+        with self.server._lock:
+            self.server._inflight -= 1
+
+
+def ytdlp_command(ytdlp_path):
+    if ytdlp_path:
+        return [ytdlp_path]
+    return [sys.executable, '-m', 'yt_dlp']
+
+
+def run_level(server, base_cmd, level, work_dir):
+    out_dir = tempfile.mkdtemp(prefix=f'frag{level}_', dir=work_dir)
+    server.max_inflight = 0
+    cmd = base_cmd + [
+        '--ignore-config', '--no-part', '--no-progress', '--quiet', '--fixup', 'never',
+        '--downloader', 'native', '--hls-prefer-native',
+        '--concurrent-fragments', str(level),
+        '-o', os.path.join(out_dir, 'bench.%(ext)s'),
+        server.url,
+    ]
+    started = time.perf_counter()
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    elapsed = time.perf_counter() - started
+    size = sum(os.path.getsize(os.path.join(out_dir, name)) for name in os.listdir(out_dir))
+    shutil.rmtree(out_dir, ignore_errors=True)
+    if proc.returncode != 0:
+        raise RuntimeError(f"yt-dlp lỗi ở mức {level}: {proc.stdout.strip()[-500:]}")
+    return {
+        'fragments': level,
+        'seconds': round(elapsed, 3),
+        'bytes': size,
+        'mib_per_s': round(size / elapsed / 1024 ** 2, 3),
+        'max_inflight': server.max_inflight,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark thông lượng theo --concurrent-fragments")
+    parser.add_argument('--yt-dlp', help="Đường dẫn yt-dlp(.exe); mặc định dùng python -m yt_dlp")
+    parser.add_argument('--levels', default='1,2,4,8,16', help="Các mức fragment song song, ngăn bởi dấu phẩy")
+    parser.add_argument('--fragments', type=int, default=40, help="Số fragment trong playlist")
+    parser.add_argument('--fragment-kb', type=int, default=256, help="Kích thước mỗi fragment (KB)")
+    parser.add_argument('--latency', type=float, default=0.05, help="Độ trễ mỗi request fragment (giây)")
+    parser.add_argument('--conn-rate-kb', type=int, default=1024, help="Băng thông mỗi kết nối (KB/s, 0 = không giới hạn)")
+    parser.add_argument('--repeat', type=int, default=1, help="Số lần chạy mỗi mức (lấy trung vị)")
+    parser.add_argument('--json', help="Ghi kết quả ra file JSON")
+    args = parser.parse_args()
+
+    levels = [int(level) for level in args.levels.split(',') if level.strip()]
+    server = FragmentServer(args.fragments, args.fragment_kb, args.latency, args.conn_rate_kb)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_cmd = ytdlp_command(args.yt_dlp)
+    results = []
+    work_dir = tempfile.mkdtemp(prefix='fragment_bench_')
+    try:
+        for level in levels:
+            runs = sorted((run_level(server, base_cmd, level, work_dir) for _ in range(args.repeat)),
+                          key=lambda r: r['mib_per_s'])
+            results.append(runs[len(runs) // 2])
+    finally:
+        server.shutdown()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print(f"{'fragments':>9} {'seconds':>8} {'MiB/s':>8} {'inflight':>8}")
+    for r in results:
+        print(f"{r['fragments']:>9} {r['seconds']:>8.2f} {r['mib_per_s']:>8.2f} {r['max_inflight']:>8}")
+    report = {
+        'config': {key: getattr(args, key) for key in ('fragments', 'fragment_kb', 'latency', 'conn_rate_kb', 'repeat')},
+        'results': results,
+        'best': max(results, key=lambda r: r['mib_per_s'])['fragments'] if results else None,
+    }
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
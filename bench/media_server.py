@@ -0,0 +1,166 @@
+"""
+Media server cục bộ cho bench/: phục vụ media tổng hợp (không cần mạng) cho yt-dlp giả (bench/fake_ytdlp.py).
+
+    /progressive/<height>.mp4           file MP4 liền (hỗ trợ Range)
+    /hls/master.m3u8                    HLS master, /hls/<height>/index.m3u8 + /hls/<height>/seg<i>.ts
+    /dash/manifest.mpd                  DASH (SegmentList), /dash/<representation>/seg<i>.m4s
+    /thumb.webp                         thumbnail
+
+Độ trễ mỗi request và băng thông mỗi kết nối cấu hình được để mô phỏng CDN.
+
+Ví dụ (chạy riêng để thử bằng yt-dlp thật):
+    python bench/media_server.py --port 8000 --media-kb 4096 --segments 20
+"""
+import argparse
+import os
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+VIDEO_HEIGHTS = (360, 720, 1080)
+AUDIO_BITRATES = (64, 128)
+
+
+class MediaServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=0, media_kb=2048, segments=10, latency=0.0, conn_rate_kb=0):
+        super().__init__(('127.0.0.1', port), MediaHandler)
+        self.media_size = media_kb * 1024
+        self.segments = segments
+        self.latency = latency
+        self.conn_rate = conn_rate_kb * 1024
+        # Một khối byte ngẫu nhiên dùng chung, cắt theo kích thước cần phục vụ
+        self.payload = os.urandom(self.media_size)
+        self.requests = 0
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def segment_size(self):
+        return max(1, self.media_size // self.segments)
+
+    def hls_master(self):
+        lines = ['#EXTM3U', '#EXT-X-VERSION:3']
+        for height in VIDEO_HEIGHTS:
+            lines += [f'#EXT-X-STREAM-INF:BANDWIDTH={height * 2000},RESOLUTION={height * 16 // 9}x{height}',
+                      f'{height}/index.m3u8']
+        return '\n'.join(lines) + '\n'
+
+    def hls_playlist(self):
+        lines = ['#EXTM3U', '#EXT-X-VERSION:3', '#EXT-X-TARGETDURATION:4', '#EXT-X-MEDIA-SEQUENCE:0']
+        for i in range(self.segments):
+            lines += ['#EXTINF:4.0,', f'seg{i}.ts']
+        lines.append('#EXT-X-ENDLIST')
+        return '\n'.join(lines) + '\n'
+
+    def dash_manifest(self):
+        def segment_list(rep):
+            urls = ''.join(f'<SegmentURL media="{rep}/seg{i}.m4s"/>' for i in range(self.segments))
+            return f'<SegmentList duration="4" timescale="1">{urls}</SegmentList>'
+
+        video = ''.join(
+            f'<Representation id="v{h}" bandwidth="{h * 2000}" width="{h * 16 // 9}" height="{h}" '
+            f'codecs="avc1.64001f" mimeType="video/mp4">{segment_list(f"v{h}")}</Representation>'
+            for h in VIDEO_HEIGHTS)
+        audio = ''.join(
+            f'<Representation id="a{kbps}" bandwidth="{kbps * 1000}" codecs="mp4a.40.2" mimeType="audio/mp4">'
+            f'{segment_list(f"a{kbps}")}</Representation>'
+            for kbps in AUDIO_BITRATES)
+        return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<MPD xmlns="urn:mpeg:dash:schema:mpd:2011" type="static" mediaPresentationDuration="PT40S">'
+                f'<Period><AdaptationSet contentType="video">{video}</AdaptationSet>'
+                f'<AdaptationSet contentType="audio" lang="en">{audio}</AdaptationSet></Period></MPD>\n')
+
+
+class MediaHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        with server._lock:
+            server.requests += 1
+        if server.latency:
+            time.sleep(server.latency)
+        path = self.path.split('?', 1)[0]
+        if path == '/hls/master.m3u8':
+            return self._send_text(server.hls_master(), 'application/vnd.apple.mpegurl')
+        if re.fullmatch(r'/hls/\d+/index\.m3u8', path):
+            return self._send_text(server.hls_playlist(), 'application/vnd.apple.mpegurl')
+        if path == '/dash/manifest.mpd':
+            return self._send_text(server.dash_manifest(), 'application/dash+xml')
+        if re.fullmatch(r'/(?:hls/\d+/seg\d+\.ts|dash/[va]\d+/seg\d+\.m4s)', path):
+            return self._send_bytes(server.segment_size(), 'video/mp2t' if path.endswith('.ts') else 'video/mp4')
+        if re.fullmatch(r'/progressive/\d+\.mp4', path):
+            return self._send_bytes(server.media_size, 'video/mp4', ranged=True)
+        if path == '/thumb.webp':
+            return self._send_bytes(16 * 1024, 'image/webp')
+        self.send_error(404)
+
+    def _send_text(self, text, content_type):
+        body = text.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_bytes(self, size, content_type, ranged=False):
+        start, end = 0, size - 1
+        match = re.fullmatch(r'bytes=(\d+)-(\d*)', self.headers.get('Range') or '') if ranged else None
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2)) if match.group(2) else end, size - 1)
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(end - start + 1))
+        if ranged:
+            self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+        # Giới hạn băng thông theo từng kết nối (giống CDN)
+        chunk = 64 * 1024
+        try:
+            for offset in range(start, end + 1, chunk):
+                data = self.server.payload[offset:min(offset + chunk, end + 1)]
+                self.wfile.write(data)
+                with self.server._lock:
+                    self.server.bytes_sent += len(data)
+                if self.server.conn_rate:
+                    time.sleep(len(data) / self.server.conn_rate)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Media server tổng hợp (MP4/HLS/DASH) cho bench")
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--media-kb', type=int, default=2048, help="Kích thước mỗi file/stream (KB)")
+    parser.add_argument('--segments', type=int, default=10, help="Số segment HLS/DASH mỗi stream")
+    parser.add_argument('--latency', type=float, default=0.0, help="Độ trễ mỗi request (giây)")
+    parser.add_argument('--conn-rate-kb', type=int, default=0, help="Băng thông mỗi kết nối (KB/s, 0 = không giới hạn)")
+    args = parser.parse_args()
+    server = MediaServer(args.port, args.media_kb, args.segments, args.latency, args.conn_rate_kb)
+    print(f"Media server: {server.url}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,443 @@
+"""
+Bộ benchmark offline cho downloader.py: chạy wrapper thật với yt-dlp/ffmpeg giả (bench/fake_ytdlp.py) và media server
+cục bộ (bench/media_server.py), không cần mạng. Mỗi kịch bản được lặp --repeat lần, kết quả in thành bảng và ghi JSON
+(--json) để theo dõi hồi quy giữa các commit.
+
+Mỗi lần chạy dùng một sandbox riêng: thư mục resources (yt-dlp.exe, ffmpeg giả), LOCALAPPDATA (state, profile
+Chrome/Edge giả), PATH có deno giả (không tải Node.js). Thời gian yt-dlp/ffmpeg giả tự ghi lại, nên
+overhead = thời gian tổng - thời gian có ít nhất một tiến trình yt-dlp/ffmpeg đang chạy.
+
+Kịch bản:
+    cold-mp4               state trống (dò runtime, kiểm tra cập nhật, extract)
+    warm-mp4/hls/dash      state đã có từ lần chạy trước; dash đi qua format plan + tải song song video/audio + merge
+    worker-mp4             job gửi cho tiến trình --worker thường trú (giống app)
+    cascade-152            YouTube lỗi 152-18 -> thử cookies trình duyệt -> fallback player_client=web
+    cascade-status0        TikTok status code 0 -> các cấu hình fallback
+    cascade-cookie-locked  cookie DB bị khóa, không dùng cookie jar (--cookie-jar-ttl 0)
+    cookie-jar             TikTok với cookie jar đã xuất sẵn
+    cascade-thumbonly      chỉ có ảnh -> fallback tải thumbnail
+    playlist-fanout        --list-entries rồi tải từng entry qua --workers worker
+    concurrent-queue       --jobs job (mp4/hls/dash) qua --workers worker + pool hậu xử lý, như hàng đợi của app
+    batch-file             --jobs clip YouTube + 3 clip TikTok + 1 clip lỗi 152 trong một lần chạy --url-file
+
+Ví dụ (chỉ Linux/macOS: yt-dlp.exe/ffmpeg giả là script có shebang):
+    python bench/run_bench.py
+    python bench/run_bench.py --scenarios warm-mp4,cascade-152 --repeat 5 --json bench_result.json
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+DOWNLOADER = os.path.join(REPO_DIR, 'downloader.py')
+sys.path.insert(0, BENCH_DIR)
+
+from media_server import MediaServer  # noqa: E402
+
+JOB_TIMEOUT = 300
+
+
+class Sandbox:
+    """Thư mục tạm cho một kịch bản: resources giả, LOCALAPPDATA (state + profile trình duyệt giả), thư mục lưu"""
+
+    def __init__(self, root, server_url, args):
+        self.root = root
+        self.resources = os.path.join(root, 'resources')
+        self.local_appdata = os.path.join(root, 'localappdata')
+        self.save_path = os.path.join(root, 'downloads')
+        self.log_path = os.path.join(root, 'fake-calls.jsonl')
+        bin_dir = os.path.join(root, 'bin')
+        for path in (self.resources, self.local_appdata, self.save_path, bin_dir):
+            os.makedirs(path, exist_ok=True)
+
+        with open(os.path.join(BENCH_DIR, 'fake_ytdlp.py'), 'r', encoding='utf-8') as f:
+            fake_source = f.read().split('\n', 1)[1]
+        for name in ('yt-dlp.exe', 'ffmpeg'):
+            self._write_script(os.path.join(self.resources, name), f'#!{sys.executable}\n{fake_source}')
+        self._write_script(os.path.join(bin_dir, 'deno'), '#!/bin/sh\necho "deno 2.1.0 (stable, release)"\n')
+        for profile in (('Google', 'Chrome', 'User Data'), ('Microsoft', 'Edge', 'User Data')):
+            cookie_dir = os.path.join(self.local_appdata, *profile, 'Default', 'Network')
+            os.makedirs(cookie_dir, exist_ok=True)
+            open(os.path.join(cookie_dir, 'Cookies'), 'wb').close()
+
+        self.env = dict(os.environ)
+        self.env.update({
+            'LOCALAPPDATA': self.local_appdata,
+            'APPDATA': self.local_appdata,
+            'PATH': bin_dir + os.pathsep + os.environ.get('PATH', ''),
+            'PYTHONIOENCODING': 'utf-8',
+            'FAKE_YTDLP_MEDIA': server_url,
+            'FAKE_YTDLP_LOG': self.log_path,
+            'FAKE_YTDLP_STARTUP': str(args.ytdlp_startup),
+            'FAKE_YTDLP_EXTRACT': str(args.extract_delay),
+        })
+        self.env.pop('FAKE_YTDLP_COOKIES_LOCKED', None)
+
+    @staticmethod
+    def _write_script(path, content):
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(content)
+        os.chmod(path, 0o755)
+
+    def reset_state(self):
+        shutil.rmtree(os.path.join(self.local_appdata, 'RedbiVideoDownloader'), ignore_errors=True)
+
+    def reset_log(self):
+        if os.path.exists(self.log_path):
+            os.remove(self.log_path)
+
+    def read_log(self):
+        if not os.path.exists(self.log_path):
+            return []
+        with open(self.log_path, 'r', encoding='utf-8') as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def job_args(self, url, *extra, app=False):
+        args = ['--url', url, '--save-path', self.save_path, '--resources-path', self.resources,
+                '--quality', 'best', '--format', 'video', '--no-playlist', '--events', 'json']
+        if app:
+            args.append('--defer-postprocess')
+        return args + list(extra)
+
+    def run_once(self, args, env=None):
+        """Chạy downloader.py một lần (giống chế độ không worker), trả về (exit code, thời gian, output)"""
+        started = time.perf_counter()
+        proc = subprocess.run([sys.executable, DOWNLOADER, *args], env=env or self.env, stdout=subprocess.PIPE,
+                              stderr=subprocess.STDOUT, text=True, encoding='utf-8', errors='replace',
+                              timeout=JOB_TIMEOUT)
+        return proc.returncode, time.perf_counter() - started, proc.stdout
+
+
+class Worker:
+    """Tiến trình downloader.py --worker thường trú, giao tiếp bằng JSON lines giống main.js"""
+
+    def __init__(self, sandbox):
+        self.proc = subprocess.Popen([sys.executable, DOWNLOADER, '--worker'], env=sandbox.env,
+                                     stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                     text=True, encoding='utf-8', errors='replace', bufsize=1)
+        for line in self.proc.stdout:
+            if line.startswith('WORKER_READY'):
+                break
+        else:
+            raise RuntimeError("Worker thoát trước khi sẵn sàng")
+        self.next_id = 0
+
+    def run(self, args):
+        """Gửi một job, chờ JOB_RESULT; trả về (exit code, thời gian, các bước hậu xử lý được hoãn lại)"""
+        self.next_id += 1
+        job_id = self.next_id
+        started = time.perf_counter()
+        self.proc.stdin.write(json.dumps({'id': job_id, 'args': args}) + '\n')
+        self.proc.stdin.flush()
+        specs = []
+        for line in self.proc.stdout:
+            if line.startswith('JOB_RESULT: '):
+                result = json.loads(line[len('JOB_RESULT: '):])
+                if result.get('id') == job_id:
+                    return result['exit_code'], time.perf_counter() - started, specs
+            elif line.startswith('{'):
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    continue
+                if event.get('event') == 'postprocess':
+                    specs.append(event['spec'])
+        raise RuntimeError("Worker thoát giữa chừng")
+
+    def close(self):
+        try:
+            self.proc.stdin.write(json.dumps({'action': 'shutdown'}) + '\n')
+            self.proc.stdin.close()
+            self.proc.wait(timeout=30)
+        except (OSError, subprocess.TimeoutExpired):
+            self.proc.kill()
+
+
+def external_busy_seconds(calls):
+    """Tổng thời gian có ít nhất một tiến trình yt-dlp/ffmpeg giả đang chạy (hợp các khoảng thời gian)"""
+    busy, current_start, current_end = 0.0, None, None
+    for call in sorted(calls, key=lambda c: c['start']):
+        if current_end is None or call['start'] > current_end:
+            if current_end is not None:
+                busy += current_end - current_start
+            current_start, current_end = call['start'], call['end']
+        else:
+            current_end = max(current_end, call['end'])
+    if current_end is not None:
+        busy += current_end - current_start
+    return busy
+
+
+def run_queue(sandbox, workers, jobs, postprocess_workers):
+    """
+    Mô phỏng hàng đợi của app: `workers` worker thường trú lấy job từ hàng đợi chung; các bước hậu xử lý
+    được hoãn lại chạy bằng pool riêng (--run-postprocess) để slot tải được nhả ngay.
+    Trả về dict số liệu (exit codes, thời gian chờ trong hàng đợi và thời gian chạy của từng job).
+    """
+    pending = list(enumerate(jobs))
+    lock = threading.Lock()
+    results = []
+    queued_at = time.perf_counter()
+    postprocess_pool = ThreadPoolExecutor(max_workers=postprocess_workers)
+    postprocess_runs = []
+
+    def run_postprocess(spec):
+        return sandbox.run_once(['--run-postprocess', json.dumps(spec), '--resources-path', sandbox.resources,
+                                 '--events', 'json'])[0]
+
+    def drain(worker):
+        while True:
+            with lock:
+                if not pending:
+                    return
+                index, args = pending.pop(0)
+            wait = time.perf_counter() - queued_at
+            rc, duration, specs = worker.run(args)
+            with lock:
+                results.append({'index': index, 'rc': rc, 'queue_wait': wait, 'duration': duration})
+                postprocess_runs.extend(postprocess_pool.submit(run_postprocess, spec) for spec in specs)
+
+    pool = [Worker(sandbox) for _ in range(workers)]
+    try:
+        threads = [threading.Thread(target=drain, args=(worker,)) for worker in pool]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        postprocess_rcs = [future.result() for future in postprocess_runs]
+    finally:
+        postprocess_pool.shutdown()
+        for worker in pool:
+            worker.close()
+    if not results:
+        return {'rc': 1, 'jobs': 0, 'postprocess': 0}
+    return {
+        'rc': max([r['rc'] for r in results] + postprocess_rcs, default=0),
+        'jobs': len(results),
+        'postprocess': len(postprocess_rcs),
+        'queue_wait_p50': round(statistics.median(r['queue_wait'] for r in results), 3),
+        'job_seconds_p50': round(statistics.median(r['duration'] for r in results), 3),
+        'job_seconds_max': round(max(r['duration'] for r in results), 3),
+    }
+
+
+# ID video duy nhất cho mỗi job: ID YouTube 11 ký tự / ID TikTok dạng số, để cache metadata, format plan và
+# download archive của wrapper hoạt động như với video thật (không job nào trùng khóa với job khác)
+_VIDEO_SEQ = itertools.count(1)
+
+
+def youtube(scenario):
+    return f'https://www.youtube.com/watch?v=b{next(_VIDEO_SEQ):010d}&bench={scenario}'
+
+
+def youtube_playlist(scenario):
+    return f'https://www.youtube.com/playlist?list=PLb{next(_VIDEO_SEQ):08d}&bench={scenario}'
+
+
+def tiktok(scenario):
+    return f'https://www.tiktok.com/@{scenario}/video/{7400000000000000000 + next(_VIDEO_SEQ)}'
+
+
+class Scenarios:
+    """Mỗi kịch bản: setup (không đo) + run(rep) trả về dict có 'rc' (và số liệu riêng nếu có)"""
+
+    def __init__(self, sandbox, args):
+        self.sandbox = sandbox
+        self.args = args
+        self.worker = None
+
+    def prime(self):
+        """Làm ấm state: dò runtime, cache kiểm tra cập nhật, thống kê transfer"""
+        self.sandbox.run_once(self.sandbox.job_args(youtube('ok-mp4')))
+
+    def setup(self, name):
+        if name != 'cold-mp4':
+            self.prime()
+        if name == 'worker-mp4':
+            self.worker = Worker(self.sandbox)
+            self.worker.run(self.sandbox.job_args(youtube('ok-mp4')))
+        if name == 'cookie-jar':
+            self.sandbox.run_once(self.sandbox.job_args(tiktok('ok-mp4')))
+
+    def teardown(self):
+        if self.worker:
+            self.worker.close()
+            self.worker = None
+
+    def run(self, name):
+        sandbox = self.sandbox
+        if name == 'cold-mp4':
+            sandbox.reset_state()
+            return {'rc': sandbox.run_once(sandbox.job_args(youtube('ok-mp4')))[0]}
+        if name.startswith('warm-'):
+            return {'rc': sandbox.run_once(sandbox.job_args(youtube(f"ok-{name.split('-', 1)[1]}")))[0]}
+        if name == 'worker-mp4':
+            return {'rc': self.worker.run(sandbox.job_args(youtube('ok-mp4')))[0]}
+        if name == 'cascade-152':
+            return {'rc': sandbox.run_once(sandbox.job_args(youtube('yt152-mp4')))[0]}
+        if name == 'cascade-status0':
+            return {'rc': sandbox.run_once(sandbox.job_args(tiktok('status0-mp4')))[0]}
+        if name == 'cascade-cookie-locked':
+            env = dict(sandbox.env, FAKE_YTDLP_COOKIES_LOCKED='1')
+            return {'rc': sandbox.run_once(sandbox.job_args(tiktok('ok-mp4'), '--cookie-jar-ttl', '0'), env)[0]}
+        if name == 'cookie-jar':
+            return {'rc': sandbox.run_once(sandbox.job_args(tiktok('ok-mp4')))[0]}
+        if name == 'cascade-thumbonly':
+            return {'rc': sandbox.run_once(sandbox.job_args(youtube('thumbonly')))[0]}
+        if name == 'playlist-fanout':
+            rc, _, output = sandbox.run_once(['--url', youtube_playlist(f'fanout-{self.args.entries}-hls'),
+                                              '--save-path', sandbox.save_path, '--resources-path', sandbox.resources,
+                                              '--list-entries', '--events', 'json'])
+            urls = [event['url'] for event in map(_parse_event, output.splitlines())
+                    if event and event.get('event') == 'entry']
+            stats = run_queue(sandbox, self.args.workers, [sandbox.job_args(url, app=True) for url in urls],
+                              self.args.postprocess_workers)
+            return dict(stats, rc=max(rc, stats['rc']), entries=len(urls))
+        if name == 'batch-file':
+            # Lô clip ngắn qua --url-file: YouTube và TikTok được gom theo platform, một URL lỗi 152 chỉ mình nó
+            # được thử lại bằng các nhánh fallback
+            urls = [youtube('ok-mp4') for _ in range(self.args.jobs)] + [tiktok('ok-mp4') for _ in range(3)]
+            urls.insert(len(urls) // 2, youtube('yt152-mp4'))
+            url_file = os.path.join(sandbox.root, 'urls.txt')
+            with open(url_file, 'w', encoding='utf-8') as f:
+                f.write('\n'.join(urls) + '\n')
+            rc, _, output = sandbox.run_once(['--url-file', url_file, '--save-path', sandbox.save_path,
+                                              '--resources-path', sandbox.resources, '--no-playlist',
+                                              '--events', 'json'])
+            results = [event for event in map(_parse_event, output.splitlines())
+                       if event and event.get('event') == 'batch_result']
+            return {'rc': rc, 'urls': len(urls), 'downloaded': sum(r['status'] == 'downloaded' for r in results),
+                    'via_batch': sum(r['via'] == 'batch' for r in results)}
+        if name == 'concurrent-queue':
+            media = ('mp4', 'hls', 'dash')
+            jobs = [sandbox.job_args(youtube(f'ok-{media[i % 3]}'), app=True) for i in range(self.args.jobs)]
+            return run_queue(sandbox, self.args.workers, jobs, self.args.postprocess_workers)
+        raise ValueError(f"Không có kịch bản: {name}")
+
+
+def _parse_event(line):
+    try:
+        return json.loads(line) if line.startswith('{') else None
+    except ValueError:
+        return None
+
+
+SCENARIOS = ('cold-mp4', 'warm-mp4', 'warm-hls', 'warm-dash', 'worker-mp4', 'cascade-152', 'cascade-status0',
+             'cascade-cookie-locked', 'cookie-jar', 'cascade-thumbonly', 'playlist-fanout', 'concurrent-queue',
+             'batch-file')
+
+
+def run_scenario(name, server, args):
+    root = tempfile.mkdtemp(prefix=f'bench_{name}_')
+    try:
+        sandbox = Sandbox(root, server.url, args)
+        scenarios = Scenarios(sandbox, args)
+        scenarios.setup(name)
+        runs = []
+        try:
+            for _ in range(args.repeat):
+                sandbox.reset_log()
+                started = time.perf_counter()
+                metrics = scenarios.run(name)
+                wall = time.perf_counter() - started
+                calls = sandbox.read_log()
+                modes = {}
+                for call in calls:
+                    key = f"{call['tool']}:{call['mode']}"
+                    modes[key] = modes.get(key, 0) + 1
+                busy = external_busy_seconds(calls)
+                runs.append(dict(metrics, wall=wall, external=busy, overhead=wall - busy, calls=len(calls),
+                                 modes=modes))
+        finally:
+            scenarios.teardown()
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    walls = [r['wall'] for r in runs]
+    extra = {key: value for key, value in runs[-1].items()
+             if key not in ('wall', 'external', 'overhead', 'calls', 'modes', 'rc')}
+    return dict(extra, **{
+        'runs': len(runs),
+        'rc': max(r['rc'] for r in runs),
+        'wall_median': round(statistics.median(walls), 3),
+        'wall_min': round(min(walls), 3),
+        'wall_max': round(max(walls), 3),
+        'overhead_median': round(statistics.median(r['overhead'] for r in runs), 3),
+        'ytdlp_calls': runs[-1]['calls'],
+        'calls_by_mode': runs[-1]['modes'],
+    })
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark offline downloader.py với yt-dlp giả và media server cục bộ")
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help="Các kịch bản, ngăn bởi dấu phẩy")
+    parser.add_argument('--repeat', type=int, default=3, help="Số lần chạy mỗi kịch bản (lấy trung vị)")
+    parser.add_argument('--ytdlp-startup', type=float, default=0.2, help="Giây khởi động giả lập của mỗi lần gọi yt-dlp")
+    parser.add_argument('--extract-delay', type=float, default=0.3, help="Giây giả lập cho mỗi lần extract")
+    parser.add_argument('--media-kb', type=int, default=2048, help="Kích thước mỗi file/stream (KB)")
+    parser.add_argument('--segments', type=int, default=10, help="Số segment HLS/DASH mỗi stream")
+    parser.add_argument('--latency', type=float, default=0.01, help="Độ trễ mỗi request HTTP (giây)")
+    parser.add_argument('--conn-rate-kb', type=int, default=0, help="Băng thông mỗi kết nối (KB/s, 0 = không giới hạn)")
+    parser.add_argument('--workers', type=int, default=3, help="Số worker cho playlist-fanout/concurrent-queue")
+    parser.add_argument('--postprocess-workers', type=int, default=2, help="Số tiến trình hậu xử lý song song")
+    parser.add_argument('--jobs', type=int, default=9, help="Số job của concurrent-queue / số clip YouTube của batch-file")
+    parser.add_argument('--entries', type=int, default=6, help="Số video trong playlist của playlist-fanout")
+    parser.add_argument('--json', help="Ghi kết quả ra file JSON")
+    args = parser.parse_args()
+
+    names = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"kịch bản không hợp lệ: {', '.join(unknown)} (có: {', '.join(SCENARIOS)})")
+
+    server = MediaServer(media_kb=args.media_kb, segments=args.segments, latency=args.latency,
+                         conn_rate_kb=args.conn_rate_kb).start()
+    results = {}
+    try:
+        for name in names:
+            print(f"... {name}", file=sys.stderr, flush=True)
+            results[name] = run_scenario(name, server, args)
+    finally:
+        server.shutdown()
+
+    print(f"{'scenario':<22} {'rc':>3} {'wall(s)':>8} {'min':>7} {'max':>7} {'overhead':>9} {'calls':>6}")
+    for name, r in results.items():
+        print(f"{name:<22} {r['rc']:>3} {r['wall_median']:>8.3f} {r['wall_min']:>7.3f} {r['wall_max']:>7.3f} "
+              f"{r['overhead_median']:>9.3f} {r['ytdlp_calls']:>6}")
+    report = {
+        'revision': git_revision(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': {key: getattr(args, key) for key in ('repeat', 'ytdlp_startup', 'extract_delay', 'media_kb',
+                                                       'segments', 'latency', 'conn_rate_kb', 'workers',
+                                                       'postprocess_workers', 'jobs', 'entries')},
+        'scenarios': results,
+    }
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+    return 1 if any(r['rc'] for r in results.values()) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,6 +4,17 @@ import os
 import sys
 import io
 import shutil
+import json
+import re
+import time
+import random
+import contextlib
+import copy
+import hashlib
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import urllib.parse
 import urllib.request
 
 if sys.stdout.encoding.lower() != 'utf-8':
@@ -11,6 +22,81 @@ if sys.stdout.encoding.lower() != 'utf-8':
 if sys.stderr.encoding.lower() != 'utf-8':
     sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding='utf-8')
 
+APP_DIR_NAME = 'RedbiVideoDownloader'
+
+# Cờ ẩn cửa sổ console của tiến trình con; chỉ có trên Windows (Linux/macOS dùng 0, ví dụ khi chạy bench/)
+CREATE_NO_WINDOW = getattr(subprocess, 'CREATE_NO_WINDOW', 0)
+
+# Thời gian (giờ) giữa hai lần chạy `yt-dlp -U`; 0 = kiểm tra mỗi lần tải
+DEFAULT_UPDATE_TTL_HOURS = 24
+
+# Thời gian (phút) giữ info JSON đã extract để dùng lại; ngắn vì URL media có chữ ký sẽ hết hạn
+DEFAULT_METADATA_TTL_MINUTES = 30
+
+# Trạng thái đã xác định được giữ trong bộ nhớ (có ích khi chạy --worker: các job sau không phải đọc lại từ đĩa)
+_WARM_STATE = {}
+
+
+def get_user_state_dir():
+    """Thư mục lưu trạng thái/bộ nhớ đệm dùng chung giữa các lần chạy (ưu tiên LOCALAPPDATA, fallback APPDATA)"""
+    base = os.getenv('LOCALAPPDATA') or os.getenv('APPDATA')
+    if not base:
+        return None
+    state_dir = os.path.join(base, APP_DIR_NAME, 'state')
+    os.makedirs(state_dir, exist_ok=True)
+    return state_dir
+
+
+def load_json_file(path, default):
+    """Đọc file JSON, trả về default nếu file chưa có hoặc bị hỏng"""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+def save_json_file(path, data):
+    """Ghi file JSON theo kiểu atomic (ghi file tạm rồi os.replace) để tiến trình khác không đọc phải file dở dang"""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+
+@contextlib.contextmanager
+def file_lock(lock_path, timeout=120, stale_after=600):
+    """
+    Khóa liên tiến trình bằng file tạo với O_EXCL (single-flight giữa nhiều downloader chạy song song).
+    Lock cũ hơn stale_after giây được coi là của tiến trình đã chết và bị xóa.
+    Ném TimeoutError nếu không lấy được lock trong timeout giây.
+    """
+    deadline = time.time() + timeout
+    while True:
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            os.write(fd, str(os.getpid()).encode('ascii'))
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock_path) > stale_after:
+                    os.remove(lock_path)
+                    continue
+            except OSError:
+                continue
+            if time.time() > deadline:
+                raise TimeoutError(f"Không lấy được lock: {lock_path}")
+            time.sleep(0.1)
+    try:
+        yield
+    finally:
+        os.close(fd)
+        try:
+            os.remove(lock_path)
+        except OSError:
+            pass
+
+
 def get_user_ytdlp_path():
     """Lấy đường dẫn yt-dlp trong thư mục AppData của người dùng"""
     appdata = os.getenv('APPDATA')
@@ -76,7 +162,7 @@ def check_deno_runtime():
                 stderr=subprocess.PIPE,
                 text=True,
                 timeout=5,
-                creationflags=subprocess.CREATE_NO_WINDOW
+                creationflags=CREATE_NO_WINDOW
             )
             if result.returncode == 0:
                 return deno_path
@@ -128,50 +214,2719 @@ def ensure_js_runtime():
     
     return None, None, None
 
-def update_ytdlp(yt_dlp_exe_path):
-    """Cố gắng cập nhật yt-dlp, nếu thất bại thì tải về AppData"""
-    print("STATUS: Đang kiểm tra và cập nhật yt-dlp...")
-    
-    # Thử cập nhật tại vị trí gốc trước
+
+# Thư mục profile trình duyệt (tương đối với LOCALAPPDATA) dùng cho --cookies-from-browser, theo thứ tự ưu tiên
+BROWSER_PROFILE_DIRS = {
+    'chrome': ('Google', 'Chrome', 'User Data'),
+    'edge': ('Microsoft', 'Edge', 'User Data'),
+}
+
+
+def get_browser_profile_path(browser):
+    """Đường dẫn thư mục 'User Data' của trình duyệt trong LOCALAPPDATA"""
+    return os.path.join(os.getenv('LOCALAPPDATA', ''), *BROWSER_PROFILE_DIRS[browser])
+
+
+def find_ffmpeg_location(resources_path):
+    """Thư mục chứa ffmpeg cho --ffmpeg-location: ưu tiên bản đi kèm app, sau đó ffmpeg trong PATH"""
+    for name in ('ffmpeg.exe', 'ffmpeg'):
+        if os.path.exists(os.path.join(resources_path, name)):
+            return resources_path
+    system_ffmpeg = shutil.which('ffmpeg')
+    if system_ffmpeg:
+        return os.path.dirname(system_ffmpeg)
+    return resources_path
+
+
+def _path_mtime(path):
+    try:
+        return os.path.getmtime(path) if path else None
+    except OSError:
+        return None
+
+
+# Lần dò tìm không có JS runtime (vd tải Node.js thất bại) chỉ được dùng lại trong khoảng này (giây), sau đó thử lại
+DISCOVERY_NEGATIVE_TTL = 600
+
+
+def _discovery_fingerprint(resources_path, result):
+    """
+    Dấu vân tay của môi trường: PATH, LOCALAPPDATA, mtime của runtime/ffmpeg và các trình duyệt có profile.
+    Profile trình duyệt chỉ xét có/không (trình duyệt ghi vào profile liên tục khi đang mở).
+    Chỉ dùng os.stat nên không tốn subprocess nào.
+    """
+    watched = [result.get('js_runtime_path'), result.get('ffmpeg_location')]
+    return {
+        'PATH': os.getenv('PATH', ''),
+        'LOCALAPPDATA': os.getenv('LOCALAPPDATA', ''),
+        'resources_path': resources_path,
+        'mtimes': {p: _path_mtime(p) for p in watched if p},
+        'browsers': [b for b in BROWSER_PROFILE_DIRS if os.path.isdir(get_browser_profile_path(b))],
+    }
+
+
+def discover_runtime(resources_path, force=False):
+    """
+    Xác định JS runtime (Deno/Node), thư mục ffmpeg và các trình duyệt có profile để lấy cookies.
+    Kết quả được cache trong state/runtime_discovery.json và chỉ bị tính lại khi PATH, LOCALAPPDATA
+    hoặc mtime của các file liên quan thay đổi (hoặc khi force=True / --rediscover); kết quả không tìm thấy
+    JS runtime chỉ được giữ DISCOVERY_NEGATIVE_TTL giây.
+    Trả về dict: js_runtime_type, js_runtime_path, js_prepend, ffmpeg_location, browser_cookie_sources.
+    """
+    state_dir = get_user_state_dir()
+    cache_path = os.path.join(state_dir, 'runtime_discovery.json') if state_dir else None
+
+    if cache_path and not force:
+        cached = _WARM_STATE.get(cache_path) or load_json_file(cache_path, {})
+        result = cached.get('result')
+        negative_expired = (result and not result.get('js_runtime_type')
+                            and time.time() - cached.get('discovered_at', 0) >= DISCOVERY_NEGATIVE_TTL)
+        if (result and not negative_expired
+                and cached.get('fingerprint') == _discovery_fingerprint(resources_path, result)):
+            _WARM_STATE[cache_path] = cached
+            print("STATUS: Dùng kết quả dò tìm runtime đã lưu (cache HIT).")
+            return result
+
+    js_runtime_type, js_runtime_path, js_prepend = ensure_js_runtime()
+    result = {
+        'js_runtime_type': js_runtime_type,
+        'js_runtime_path': js_runtime_path,
+        'js_prepend': js_prepend,
+        'ffmpeg_location': find_ffmpeg_location(resources_path),
+        'browser_cookie_sources': [b for b in BROWSER_PROFILE_DIRS if os.path.exists(get_browser_profile_path(b))],
+    }
+    if cache_path:
+        cached = {
+            'fingerprint': _discovery_fingerprint(resources_path, result),
+            'result': result,
+            'discovered_at': time.time(),
+        }
+        _WARM_STATE[cache_path] = cached
+        try:
+            save_json_file(cache_path, cached)
+        except OSError as e:
+            print(f"WARNING: Không ghi được cache dò tìm runtime: {e}")
+    print("STATUS: Đã dò tìm lại runtime (cache MISS).")
+    return result
+
+
+# Cookie jar xuất sẵn từ trình duyệt cho TikTok/Douyin: truyền --cookies <jar> thay vì --cookies-from-browser
+# (yt-dlp phải copy + giải mã cả cookie DB ở mỗi job, chậm và lỗi khi trình duyệt đang khóa DB)
+DEFAULT_COOKIE_JAR_TTL_MINUTES = 360
+COOKIE_JARS = {'ttl': DEFAULT_COOKIE_JAR_TTL_MINUTES * 60}
+COOKIE_JAR_RETRY_AFTER = 300
+COOKIE_JAR_DOMAINS = {
+    'tiktok': ('tiktok.com',),
+    'douyin': ('douyin.com', 'iesdouyin.com'),
+}
+BROWSER_COOKIE_DB_FILES = (('Network', 'Cookies'), ('Cookies',))
+
+
+def _browser_cookie_db_mtime(browser, profile=None):
+    """
+    mtime mới nhất của cookie DB (SQLite) trong profile; không chỉ định profile thì xét mọi profile,
+    giống cách yt-dlp tự chọn profile dùng gần nhất. None nếu không tìm thấy.
+    """
+    user_data = get_browser_profile_path(browser)
+    profiles = [profile] if profile else (os.listdir(user_data) if os.path.isdir(user_data) else [])
+    mtimes = [_path_mtime(os.path.join(user_data, name, *parts)) for name in profiles for parts in BROWSER_COOKIE_DB_FILES]
+    mtimes = [m for m in mtimes if m is not None]
+    return max(mtimes) if mtimes else None
+
+
+def _filter_cookie_jar(src, dst, domains):
+    """Chép các cookie thuộc domains (kể cả subdomain) từ file Netscape src sang dst, trả về số cookie giữ lại"""
+    kept = []
+    with open(src, 'r', encoding='utf-8', errors='replace') as f:
+        for line in f:
+            fields = line.rstrip('\r\n').split('\t')
+            if len(fields) != 7:
+                continue
+            domain = fields[0]
+            if domain.startswith('#HttpOnly_'):
+                domain = domain[len('#HttpOnly_'):]
+            elif domain.startswith('#'):
+                continue
+            domain = domain.lstrip('.').lower()
+            if any(domain == d or domain.endswith('.' + d) for d in domains):
+                kept.append('\t'.join(fields) + '\n')
+    tmp_path = f"{dst}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write('# Netscape HTTP Cookie File\n')
+        f.writelines(kept)
+    os.replace(tmp_path, dst)
+    return len(kept)
+
+
+def export_browser_cookies(yt_dlp_exe_path, browser_spec, jar_path, domains):
+    """
+    Xuất cookies trình duyệt ra jar_path (Netscape cookies.txt, chỉ giữ cookie của domains) bằng chính yt-dlp:
+    chạy --cookies-from-browser kèm --cookies nhưng không có URL - yt-dlp đọc cookie DB rồi ghi jar khi đóng
+    (mã thoát báo thiếu URL được bỏ qua). Trả về (số cookie, classifier); số cookie là None nếu xuất thất bại.
+    """
+    raw_path = f"{jar_path}.{os.getpid()}.raw"
+    classifier = ErrorClassifier()
+    try:
+        proc = subprocess.run(
+            [yt_dlp_exe_path, '--ignore-config', '--no-update', '--cookies-from-browser', browser_spec,
+             '--cookies', raw_path],
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, encoding='utf-8', errors='replace',
+            timeout=120, creationflags=CREATE_NO_WINDOW,
+        )
+        for line in proc.stdout.splitlines():
+            classifier.feed(line.strip())
+        if not os.path.exists(raw_path):
+            return None, classifier
+        return _filter_cookie_jar(raw_path, jar_path, domains), classifier
+    except (OSError, subprocess.SubprocessError) as e:
+        classifier.feed(f"ERROR: {e}")
+        return None, classifier
+    finally:
+        # File thô chứa cookies của mọi trang web: không để lại trên đĩa
+        try:
+            os.remove(raw_path)
+        except OSError:
+            pass
+
+
+def get_cookie_jar(yt_dlp_exe_path, browser_spec, platform):
+    """
+    Đường dẫn cookie jar đã xuất sẵn cho (trình duyệt, profile, nhóm domain của platform), hoặc None.
+    Jar được xuất lại khi quá COOKIE_JARS['ttl'] hoặc cookie DB của trình duyệt đổi mtime; việc xuất là
+    single-flight giữa các worker (file_lock), worker đến sau chờ rồi dùng luôn jar vừa xuất.
+    Không xuất lại được (DB bị khóa, DPAPI...) thì vẫn dùng jar cũ nếu có.
+    """
+    domains = COOKIE_JAR_DOMAINS.get(platform)
+    browser, _, profile = browser_spec.partition(':')
+    state_dir = get_user_state_dir()
+    if not domains or not state_dir or COOKIE_JARS['ttl'] <= 0 or browser not in BROWSER_PROFILE_DIRS:
+        return None
+    jar_dir = os.path.join(state_dir, 'cookie_jars')
+    os.makedirs(jar_dir, exist_ok=True)
+    name = re.sub(r'[^\w.+-]+', '_', f"{browser}-{profile or 'default'}-{'+'.join(domains)}")
+    jar_path = os.path.join(jar_dir, f"{name}.txt")
+    meta_path = os.path.join(jar_dir, f"{name}.json")
+
+    def _is_fresh():
+        meta = load_json_file(meta_path, {})
+        if not os.path.exists(jar_path):
+            return False
+        # Vừa xuất lại thất bại (DB bị khóa...): dùng tiếp jar cũ một lúc thay vì thử lại ở mỗi job
+        if time.time() - meta.get('failed_at', 0) < COOKIE_JAR_RETRY_AFTER:
+            return True
+        return (time.time() - meta.get('exported_at', 0) < COOKIE_JARS['ttl']
+                and meta.get('source_mtime') == _browser_cookie_db_mtime(browser, profile))
+
+    if _is_fresh():
+        print(f"STATUS: Dùng cookies {browser.capitalize()} đã xuất sẵn (cache HIT).")
+        return jar_path
+    try:
+        with file_lock(jar_path + '.lock', timeout=90, stale_after=180):
+            if _is_fresh():
+                print(f"STATUS: Dùng cookies {browser.capitalize()} do tiến trình khác vừa xuất.")
+                return jar_path
+            source_mtime = _browser_cookie_db_mtime(browser, profile)
+            if source_mtime is None and not os.path.exists(jar_path):
+                return None
+            print(f"STATUS: Đang xuất cookies từ {browser.capitalize()} (cache MISS)...", flush=True)
+            count, out = export_browser_cookies(yt_dlp_exe_path, browser_spec, jar_path, domains)
+            if count is not None:
+                save_json_file(meta_path, {'exported_at': time.time(), 'source_mtime': source_mtime,
+                                           'browser': browser_spec, 'domains': list(domains), 'cookies': count})
+                print(f"STATUS: Đã xuất {count} cookies {'/'.join(domains)} từ {browser.capitalize()}.")
+                return jar_path
+            if out.has('cookie_locked'):
+                reason = "trình duyệt đang khóa cookie DB"
+            elif out.has('dpapi'):
+                reason = "không giải mã được cookies (DPAPI)"
+            else:
+                reason = out.last_error or "yt-dlp không ghi được cookies"
+            if os.path.exists(jar_path):
+                save_json_file(meta_path, {**load_json_file(meta_path, {}), 'failed_at': time.time()})
+    except TimeoutError:
+        reason = "tiến trình khác đang xuất cookies quá lâu"
+    except OSError as e:
+        reason = str(e)
+    if os.path.exists(jar_path):
+        print(f"WARNING: Không xuất lại được cookies {browser.capitalize()} ({reason}), dùng jar đã lưu.")
+        return jar_path
+    print(f"WARNING: Không xuất được cookies {browser.capitalize()} ({reason}).")
+    return None
+
+
+def use_cookie_jar(command, yt_dlp_exe_path, platform):
+    """Đổi --cookies-from-browser <browser> trong command thành --cookies <jar> nếu có jar; trả về True nếu đã đổi"""
+    if '--cookies-from-browser' not in command or '--cookies' in command:
+        return False
+    index = command.index('--cookies-from-browser')
+    jar_path = get_cookie_jar(yt_dlp_exe_path, command[index + 1], platform)
+    if not jar_path:
+        return False
+    command[index:index + 2] = ['--cookies', jar_path]
+    return True
+
+def update_ytdlp(yt_dlp_exe_path):
+    """Cố gắng cập nhật yt-dlp, nếu thất bại thì tải về AppData"""
+    print("STATUS: Đang kiểm tra và cập nhật yt-dlp...")
+    
+    # Thử cập nhật tại vị trí gốc trước
+    try:
+        update_process = subprocess.Popen(
+            [yt_dlp_exe_path, "-U"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            encoding='utf-8',
+            errors='replace',
+            creationflags=CREATE_NO_WINDOW
+        )
+        output_lines = []
+        for line in iter(update_process.stdout.readline, ''):
+            line = line.strip()
+            if line:
+                print(line, flush=True)
+                output_lines.append(line)
+        update_process.wait()
+        
+        if update_process.returncode == 0:
+            print("STATUS: yt-dlp đã được cập nhật thành công tại vị trí gốc.")
+            return yt_dlp_exe_path
+        else:
+            # Kiểm tra xem có phải lỗi quyền không
+            output_text = '\n'.join(output_lines)
+            if 'administrator' in output_text.lower() or 'permission' in output_text.lower():
+                print("WARNING: Không có quyền cập nhật tại vị trí gốc. Đang thử tải về thư mục người dùng...")
+            else:
+                print(f"WARNING: Cập nhật thất bại với mã lỗi {update_process.returncode}. Đang thử tải về thư mục người dùng...")
+    except Exception as e:
+        print(f"WARNING: Lỗi khi cố gắng cập nhật yt-dlp: {e}. Đang thử tải về thư mục người dùng...")
+    
+    # Nếu cập nhật thất bại, thử tải về AppData
+    user_ytdlp_path = get_user_ytdlp_path()
+    if user_ytdlp_path and download_latest_ytdlp(user_ytdlp_path):
+        print("STATUS: Đã tải phiên bản mới nhất của yt-dlp vào thư mục người dùng.")
+        return user_ytdlp_path
+    else:
+        print("WARNING: Không thể cập nhật yt-dlp. Sẽ sử dụng phiên bản hiện có.")
+        return yt_dlp_exe_path
+
+def get_ytdlp_version(yt_dlp_exe_path):
+    """Lấy chuỗi phiên bản của yt-dlp (vd: 2025.01.15), None nếu không xác định được"""
+    try:
+        result = subprocess.run(
+            [yt_dlp_exe_path, "--version"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+            timeout=30,
+            creationflags=CREATE_NO_WINDOW
+        )
+        if result.returncode == 0:
+            return result.stdout.strip() or None
+    except Exception:
+        pass
+    return None
+
+
+def update_ytdlp_cached(yt_dlp_exe_path, ttl_hours=DEFAULT_UPDATE_TTL_HOURS, force=False):
+    """
+    Bọc update_ytdlp() bằng bộ nhớ đệm trên đĩa (state/ytdlp_update.json).
+    Trong thời gian TTL, trả luôn đường dẫn yt-dlp đã xác định lần trước mà không chạy `yt-dlp -U`.
+    Khi hết TTL, chỉ một tiến trình được cập nhật (file lock), các tiến trình khác chờ rồi dùng kết quả đó.
+    Trả về đường dẫn yt-dlp cần dùng.
+    """
+    state_dir = get_user_state_dir()
+    if not state_dir or ttl_hours <= 0:
+        return update_ytdlp(yt_dlp_exe_path)
+
+    state_path = os.path.join(state_dir, 'ytdlp_update.json')
+    ttl_seconds = ttl_hours * 3600
+
+    def _is_fresh(state):
+        binary = state.get('binary')
+        return (
+            not force
+            and state.get('source') == yt_dlp_exe_path
+            and binary and os.path.exists(binary)
+            and time.time() - state.get('checked_at', 0) < ttl_seconds
+        )
+
+    def _report_hit(state):
+        # Bộ đếm hit nằm ở file riêng (lock riêng, chờ ngắn): không ghi đè state/ytdlp_update.json
+        # mà tiến trình đang cập nhật có thể vừa ghi, và không phải chờ lock của lần cập nhật
+        hits_path = os.path.join(state_dir, 'ytdlp_update_hits.json')
+        try:
+            with file_lock(hits_path + '.lock', timeout=2):
+                counters = load_json_file(hits_path, {})
+                counters['hits'] = counters.get('hits', 0) + 1
+                save_json_file(hits_path, counters)
+        except (OSError, TimeoutError):
+            counters = load_json_file(hits_path, {})
+        age_minutes = int((time.time() - state.get('checked_at', 0)) / 60)
+        print(
+            f"STATUS: Bỏ qua kiểm tra cập nhật yt-dlp (cache HIT, phiên bản {state.get('version') or '?'}, "
+            f"kiểm tra lần cuối {age_minutes} phút trước) — hits={counters.get('hits', 0)}, "
+            f"misses={state.get('misses', 0)}",
+            flush=True
+        )
+        return state['binary']
+
+    state = _WARM_STATE.get(state_path) or load_json_file(state_path, {})
+    if _is_fresh(state):
+        _WARM_STATE[state_path] = state
+        return _report_hit(state)
+
+    try:
+        with file_lock(state_path + '.lock'):
+            # Đọc lại: tiến trình khác có thể vừa cập nhật xong trong lúc chờ lock
+            state = load_json_file(state_path, {})
+            if _is_fresh(state):
+                return _report_hit(state)
+
+            binary = update_ytdlp(yt_dlp_exe_path)
+            state.update({
+                'source': yt_dlp_exe_path,
+                'binary': binary,
+                'version': get_ytdlp_version(binary),
+                'checked_at': time.time(),
+                'misses': state.get('misses', 0) + 1,
+            })
+            save_json_file(state_path, state)
+    except TimeoutError:
+        print("WARNING: Tiến trình khác đang cập nhật yt-dlp quá lâu. Dùng phiên bản hiện có.")
+        state = load_json_file(state_path, {})
+        binary = state.get('binary')
+        return binary if binary and os.path.exists(binary) else yt_dlp_exe_path
+    except OSError as e:
+        print(f"WARNING: Không ghi được bộ nhớ đệm cập nhật yt-dlp: {e}")
+        return update_ytdlp(yt_dlp_exe_path)
+
+    _WARM_STATE[state_path] = state
+    print(
+        f"STATUS: Đã kiểm tra cập nhật yt-dlp (cache MISS, phiên bản {state.get('version') or '?'}) "
+        f"— hits={load_json_file(os.path.join(state_dir, 'ytdlp_update_hits.json'), {}).get('hits', 0)}, "
+        f"misses={state['misses']}",
+        flush=True
+    )
+    return state['binary']
+
+# Tùy chọn yt-dlp chỉ ảnh hưởng tới bước tải/hậu xử lý (giá trị = số tham số đi kèm).
+# Hai lệnh chỉ khác nhau ở các tùy chọn này có thể dùng lại cùng một kết quả extract (info dict).
+DOWNLOAD_SIDE_OPTIONS = {
+    '-f': 1,
+    '--format-sort': 1,
+    '-o': 1,
+    '--merge-output-format': 1,
+    '--postprocessor-args': 1,
+    '--ffmpeg-location': 1,
+    '--downloader': 1,
+    '--concurrent-fragments': 1,
+    '--retries': 1,
+    '--fragment-retries': 1,
+    '--audio-format': 1,
+    '--audio-quality': 1,
+    '--extract-audio': 0,
+    '--write-thumbnail': 0,
+    '--skip-download': 0,
+    '--windows-filenames': 0,
+    '--no-write-auto-subs': 0,
+    '--no-update': 0,
+    '--limit-rate': 1,
+    '--continue': 0,
+    '--download-archive': 1,
+    '--print-to-file': 2,
+    '--newline': 0,
+    '--progress-template': 1,
+    '--http-chunk-size': 1,
+    '--paths': 1,
+    '--sleep-requests': 1,
+}
+
+# Info dict đã extract trong tiến trình này, theo extraction_key() + URL (dùng cho engine 'python'):
+# key -> (thời điểm lưu, hạn của URL đã ký hoặc None, info). Có giới hạn số mục vì --worker sống qua nhiều job;
+# hết hạn theo cùng TTL/expire= như cache trên đĩa (find_cached_info).
+_INFO_CACHE = OrderedDict()
+INFO_CACHE_MAX_ENTRIES = 16
+
+# Cấu hình bộ nhớ đệm info JSON trên đĩa; main() đặt lại theo --metadata-ttl (0 = tắt)
+METADATA_CACHE = {'ttl': DEFAULT_METADATA_TTL_MINUTES * 60}
+
+# Thống kê của job hiện tại, được reset ở đầu main()
+JOB_STATS = {'extractions': 0, 'info_reuses': 0, 'archive_skips': 0, 'duplicates': 0}
+
+# Kết quả từng URL của lần tải nhóm gần nhất (download_batch): URL -> True nếu đã tải xong
+BATCH_RESULTS = {}
+
+# Tốc độ đo được ở các fragment/cập nhật tiến độ đầu tiên của lần chạy yt-dlp hiện tại (bytes/s)
+TRANSFER_SAMPLES = deque(maxlen=30)
+
+
+class PhaseTimer:
+    """
+    Đo thời gian từng pha của job hiện tại (cập nhật yt-dlp, dò runtime, cookies, extract, từng lần thử/fallback,
+    từng stream, merge, hậu xử lý). Mỗi pha kết thúc in một dòng
+        METRIC: {"phase": "attempt:client:web", "start": 1.52, "seconds": 3.1, "ok": true, ...}
+    và summary() gộp lại thành bản tổng kết của job (dòng METRIC_SUMMARY:). Pha lồng trong pha khác
+    (stream/merge trong một lần thử) có trường 'parent' và không được cộng vào tổng theo loại pha.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.loaded = time.perf_counter()
+        self.jobs = 0
+        self.reset()
+
+    def reset(self):
+        """Bắt đầu đo cho một job mới"""
+        self.started = time.perf_counter()
+        # Job đầu tiên của tiến trình: kèm thời gian từ lúc nạp module (import, parse tham số) tới khi vào job
+        self.startup = round(self.started - self.loaded, 3) if self.jobs == 1 else None
+        self.jobs += 1
+        self.phases = []
+        self.stack = []
+        self.ytdlp_runs = []
+
+    def _finish(self, record, started, seconds):
+        record['start'] = round(started - self.started, 3)
+        record['seconds'] = round(seconds, 3)
+        with self.lock:
+            self.phases.append(record)
+        print("METRIC: " + json.dumps(record, ensure_ascii=False), flush=True)
+
+    @contextlib.contextmanager
+    def phase(self, name, **fields):
+        """Khối with được đo thành pha `name`; có thể gán thêm trường (vd: record['ok']) qua giá trị trả về"""
+        record = {'phase': name, **fields}
+        if self.stack:
+            record['parent'] = self.stack[-1]['phase']
+        started = time.perf_counter()
+        self.stack.append(record)
+        try:
+            yield record
+        except BaseException:
+            record['ok'] = False
+            raise
+        finally:
+            self.stack.remove(record)
+            self._finish(record, started, time.perf_counter() - started)
+
+    def record(self, name, started, ended, **fields):
+        """Ghi một pha đã đo sẵn bằng time.perf_counter() (vd: tiến trình chạy trong thread khác)"""
+        record = {'phase': name, **fields}
+        if self.stack and 'parent' not in record:
+            record['parent'] = self.stack[-1]['phase']
+        self._finish(record, started, ended - started)
+
+    def note_ytdlp_startup(self, seconds):
+        """Thời gian từ lúc spawn yt-dlp tới dòng output đầu tiên (chi phí khởi động tiến trình + import)"""
+        with self.lock:
+            self.ytdlp_runs.append(seconds)
+            if self.stack:
+                self.stack[-1]['ytdlp_startup'] = round(self.stack[-1].get('ytdlp_startup', 0) + seconds, 3)
+
+    def summary(self, **fields):
+        total = time.perf_counter() - self.started
+        totals = {}
+        for record in self.phases:
+            if 'parent' not in record:
+                kind = record['phase'].split(':', 1)[0]
+                totals[kind] = round(totals.get(kind, 0) + record['seconds'], 3)
+        totals['other'] = round(max(0.0, total - sum(totals.values())), 3)
+        summary = {'total': round(total, 3), 'totals': totals, 'ytdlp_runs': len(self.ytdlp_runs),
+                   'ytdlp_startup': round(sum(self.ytdlp_runs), 3), 'phases': self.phases, **fields}
+        if self.startup is not None:
+            summary['startup'] = self.startup
+        return summary
+
+    def print_summary(self, **fields):
+        print("METRIC_SUMMARY: " + json.dumps(self.summary(**fields), ensure_ascii=False), flush=True)
+
+
+# Thời gian từng pha của job hiện tại, được reset ở đầu main()
+PHASES = PhaseTimer()
+
+
+def extraction_key(command):
+    """
+    Khóa đại diện cho phần "extract" của một lệnh yt-dlp: bỏ đường dẫn exe và các tùy chọn phía tải về,
+    giữ lại cookies, headers, extractor-args, client... (những thứ quyết định kết quả extract).
+    """
+    key = []
+    i = 1
+    while i < len(command):
+        arg = command[i]
+        if arg in DOWNLOAD_SIDE_OPTIONS:
+            i += 1 + DOWNLOAD_SIDE_OPTIONS[arg]
+            continue
+        key.append(arg)
+        i += 1
+    return json.dumps(key, ensure_ascii=False)
+
+
+def info_cache_key(command):
+    """
+    Khóa bộ nhớ đệm info JSON: phần extract của lệnh (URL, cookies, headers, extractor-args...)
+    cộng với mtime của cookies file - cookies được xuất lại thì phải extract lại.
+    """
+    key = extraction_key(command)
+    for i, arg in enumerate(command[:-1]):
+        if arg == '--cookies':
+            key += f"|{_path_mtime(command[i + 1])}"
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def get_info_cache_dir():
+    state_dir = get_user_state_dir()
+    if not state_dir:
+        return None
+    cache_dir = os.path.join(state_dir, 'info_cache')
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+
+# URL media đã ký (YouTube expire=..., TikTok x-expires=..., CloudFront Expires=...) hết hạn theo thời điểm ghi trong URL.
+# Info JSON/format plan không được dùng lại quá thời điểm này (trừ đi một khoảng an toàn cho lúc tải).
+_SIGNED_EXPIRY_RE = re.compile(r'(?:[?&/]|\\u0026)(?:x-)?expires?[=/](\d{10})(?!\d)', re.IGNORECASE)
+SIGNED_URL_EXPIRY_MARGIN = 300
+
+
+def signed_url_expiry(text):
+    """Thời điểm hết hạn sớm nhất (epoch) của các URL đã ký trong info JSON (chuỗi), None nếu không có"""
+    expiries = [int(value) for value in _SIGNED_EXPIRY_RE.findall(text or '')]
+    return min(expiries) if expiries else None
+
+
+def find_cached_info(command):
+    """Đường dẫn info JSON còn hạn cho lệnh này, None nếu chưa có/đã hết hạn/URL đã ký sắp hết hạn/cache bị tắt"""
+    ttl = METADATA_CACHE['ttl']
+    cache_dir = get_info_cache_dir() if ttl > 0 else None
+    if not cache_dir:
+        return None
+    path = os.path.join(cache_dir, info_cache_key(command) + '.json')
+    mtime = _path_mtime(path)
+    if mtime is None or time.time() - mtime >= ttl:
+        return None
+    try:
+        with open(path + '.expires', 'r', encoding='utf-8') as f:
+            if time.time() >= int(f.read().strip()) - SIGNED_URL_EXPIRY_MARGIN:
+                return None
+    except (OSError, ValueError):
+        pass
+    return path
+
+
+def get_memory_info(key):
+    """Info dict còn hạn trong _INFO_CACHE, None nếu chưa có/đã hết hạn/cache bị tắt"""
+    entry = _INFO_CACHE.get(key)
+    if entry is None:
+        return None
+    stored_at, expiry, info = entry
+    now = time.time()
+    if (now - stored_at >= METADATA_CACHE['ttl']
+            or (expiry is not None and now >= expiry - SIGNED_URL_EXPIRY_MARGIN)):
+        del _INFO_CACHE[key]
+        return None
+    _INFO_CACHE.move_to_end(key)
+    return info
+
+
+def put_memory_info(key, info, info_text):
+    """Lưu info dict vào _INFO_CACHE (bỏ mục cũ nhất khi vượt INFO_CACHE_MAX_ENTRIES)"""
+    if METADATA_CACHE['ttl'] <= 0:
+        return
+    _INFO_CACHE[key] = (time.time(), signed_url_expiry(info_text), info)
+    _INFO_CACHE.move_to_end(key)
+    while len(_INFO_CACHE) > INFO_CACHE_MAX_ENTRIES:
+        _INFO_CACHE.popitem(last=False)
+
+
+def store_cached_info(command, info_text):
+    """Lưu info JSON (chuỗi) vào cache, đồng thời dọn các file đã hết hạn"""
+    ttl = METADATA_CACHE['ttl']
+    cache_dir = get_info_cache_dir() if ttl > 0 else None
+    if not cache_dir:
+        return None
+    now = time.time()
+    for name in os.listdir(cache_dir):
+        old_path = os.path.join(cache_dir, name)
+        mtime = _path_mtime(old_path)
+        if mtime is not None and now - mtime >= ttl:
+            try:
+                os.remove(old_path)
+            except OSError:
+                pass
+    path = os.path.join(cache_dir, info_cache_key(command) + '.json')
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(info_text)
+    os.replace(tmp_path, path)
+    expiry = signed_url_expiry(info_text)
+    if expiry:
+        with open(path + '.expires', 'w', encoding='utf-8') as f:
+            f.write(str(expiry))
+    elif os.path.exists(path + '.expires'):
+        os.remove(path + '.expires')
+    return path
+
+
+# Nhận ID video từ URL để kiểm tra download archive trước khi chạy yt-dlp (không cần mạng).
+# Khóa archive giống yt-dlp: "<extractor key viết thường> <id>".
+ARCHIVE_URL_PATTERNS = [
+    ('youtube', re.compile(r'(?:youtube\.com/(?:watch\?(?:.*&)?v=|shorts/|live/|embed/)|youtu\.be/)([0-9A-Za-z_-]{11})')),
+    ('tiktok', re.compile(r'tiktok\.com/@[^/?#]+/video/(\d+)')),
+    ('douyin', re.compile(r'douyin\.com/(?:share/)?video/(\d+)')),
+    ('twitter', re.compile(r'(?:twitter|x)\.com/[^/?#]+/status/(\d+)')),
+    ('vimeo', re.compile(r'vimeo\.com/(\d+)')),
+]
+
+
+def get_download_archive_path():
+    """File --download-archive dùng chung cho mọi job/worker (None nếu không có thư mục trạng thái)"""
+    state_dir = get_user_state_dir()
+    if not state_dir:
+        return None
+    return os.path.join(state_dir, 'download_archive.txt')
+
+
+def archive_id_from_url(url):
+    """Khóa archive của video đơn lẻ suy ra từ URL, None nếu không nhận ra"""
+    for extractor, pattern in ARCHIVE_URL_PATTERNS:
+        match = pattern.search(url or '')
+        if match:
+            return f"{extractor} {match.group(1)}"
+    return None
+
+
+def is_in_download_archive(archive_id):
+    path = get_download_archive_path()
+    if not archive_id or not path:
+        return False
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return any(line.strip() == archive_id for line in f)
+    except OSError:
+        return False
+
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def record_downloaded_files(paths, platform):
+    """
+    Ghi sha256 của các file vừa tải vào chỉ mục nội dung (state/content_index.json).
+    File trùng nội dung với một file đã tải trước đó (vd: video reup trên nền tảng khác) được báo qua STATUS.
+    """
+    state_dir = get_user_state_dir()
+    paths = [p for p in dict.fromkeys(paths) if os.path.isfile(p)]
+    if not state_dir or not paths:
+        return
+    # Hash (có thể vài GB) được tính trước khi lấy lock: lock chỉ giữ trong lúc đọc-sửa-ghi chỉ mục
+    digests = []
+    for path in paths:
+        try:
+            digests.append((path, file_sha256(path), os.path.getsize(path)))
+        except OSError as e:
+            print(f"WARNING: Không tính được hash của {path}: {e}")
+    if not digests:
+        return
+    index_path = os.path.join(state_dir, 'content_index.json')
+    try:
+        with file_lock(os.path.join(state_dir, 'content_index.lock'), timeout=30):
+            index = load_json_file(index_path, {})
+            for path, digest, size in digests:
+                previous = index.get(digest)
+                if previous and os.path.normcase(previous.get('path', '')) != os.path.normcase(path) \
+                        and os.path.exists(previous.get('path', '')):
+                    JOB_STATS['duplicates'] += 1
+                    print(f"STATUS: File trùng nội dung với file đã tải trước đó ({previous.get('platform')}): "
+                          f"{previous['path']}")
+                    continue
+                index[digest] = {'path': path, 'platform': platform, 'size': size, 'at': time.time()}
+            save_json_file(index_path, index)
+    except (OSError, TimeoutError) as e:
+        print(f"WARNING: Không ghi được chỉ mục nội dung: {e}")
+
+
+def append_download_archive(archive_path, archive_id):
+    """Ghi một video vào download archive (cùng định dạng dòng "<extractor> <id>" của yt-dlp)"""
+    if archive_path and archive_id:
+        with open(archive_path, 'a', encoding='utf-8') as f:
+            f.write(archive_id + '\n')
+
+
+# Staging (--scratch-dir): yt-dlp ghi .part, fragment và file trung gian (--paths temp:) cùng file hoàn chỉnh
+# (--paths home:) vào một thư mục trên ổ nhanh; xong job mới chuyển file hoàn chỉnh vào save_path (thường là ổ
+# mạng/HDD chậm). Thư mục staging cố định theo save_path + URL để --resume tìm lại được file .part.
+STAGE_DIR_PREFIX = 'redbi-stage-'
+STAGE_DIR_MAX_AGE = 48 * 3600
+# Chừa thêm khi kiểm tra dung lượng trống (filesize_approx chỉ là ước lượng, còn metadata/thumbnail...)
+DISK_SPACE_MARGIN = 64 * 1024 * 1024
+
+
+def prepare_stage_dir(scratch_dir, key):
+    """Thư mục staging của job trong scratch_dir, đồng thời dọn các thư mục staging bỏ dở quá STAGE_DIR_MAX_AGE"""
+    os.makedirs(scratch_dir, exist_ok=True)
+    now = time.time()
+    for name in os.listdir(scratch_dir):
+        old_dir = os.path.join(scratch_dir, name)
+        mtime = _path_mtime(old_dir)
+        if name.startswith(STAGE_DIR_PREFIX) and mtime is not None and now - mtime >= STAGE_DIR_MAX_AGE:
+            shutil.rmtree(old_dir, ignore_errors=True)
+    stage_dir = os.path.join(os.path.abspath(scratch_dir),
+                             STAGE_DIR_PREFIX + hashlib.sha1(key.encode('utf-8')).hexdigest()[:16])
+    os.makedirs(os.path.join(stage_dir, '.tmp'), exist_ok=True)
+    return stage_dir
+
+
+def remove_stage_dir_if_done(stage_dir):
+    """Xóa thư mục staging khi không còn file nào chờ xử lý hay file .part để tải tiếp"""
+    if not os.path.basename(stage_dir).startswith(STAGE_DIR_PREFIX):
+        return
+    try:
+        if (all(name == '.tmp' for name in os.listdir(stage_dir))
+                and not os.listdir(os.path.join(stage_dir, '.tmp'))):
+            shutil.rmtree(stage_dir, ignore_errors=True)
+    except OSError:
+        pass
+
+
+def check_free_space(requirements):
+    """
+    Kiểm tra dung lượng trống trước khi tải. requirements: [(thư mục, số byte sẽ ghi)], gộp theo ổ đĩa.
+    Trả về None nếu đủ chỗ, nếu không là mô tả ổ bị thiếu.
+    """
+    volumes = {}
+    for directory, needed in requirements:
+        probe = os.path.abspath(directory)
+        while not os.path.exists(probe) and os.path.dirname(probe) != probe:
+            probe = os.path.dirname(probe)
+        try:
+            volumes.setdefault(os.stat(probe).st_dev, [probe, 0])[1] += needed
+        except OSError:
+            continue
+    for probe, needed in volumes.values():
+        try:
+            free = shutil.disk_usage(probe).free
+        except OSError:
+            continue
+        if free < needed + DISK_SPACE_MARGIN:
+            return f"{probe} cần khoảng {_format_bytes(needed)}, chỉ còn trống {_format_bytes(free)}"
+    return None
+
+
+def move_file_atomic(src, dest_dir):
+    """
+    Chuyển file đã hoàn chỉnh vào dest_dir mà không để lộ file dở dang dưới tên cuối: cùng ổ thì đổi tên
+    (os.replace), khác ổ thì chép theo luồng vào file tạm trong dest_dir, fsync rồi mới đổi tên. Trả về đường dẫn mới.
+    """
+    dest = os.path.join(dest_dir, os.path.basename(src))
+    if os.stat(src).st_dev == os.stat(dest_dir).st_dev:
+        os.replace(src, dest)
+        return dest
+    tmp_path = os.path.join(dest_dir, f".{os.path.basename(src)}.{os.getpid()}.tmp")
+    try:
+        with open(src, 'rb') as fin, open(tmp_path, 'wb') as fout:
+            shutil.copyfileobj(fin, fout, 8 * 1024 * 1024)
+            fout.flush()
+            os.fsync(fout.fileno())
+        shutil.copystat(src, tmp_path)
+        os.replace(tmp_path, dest)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    os.remove(src)
+    return dest
+
+
+def finalize_staged_outputs(stage_dir, save_path, files_list_path):
+    """
+    Chuyển các file hoàn chỉnh trong thư mục staging vào save_path (move_file_atomic) và cập nhật danh sách file
+    đã tải. Đầu vào của các bước hậu xử lý còn chờ (phần video/audio chờ merge, file gốc chờ chuyển mp3) ở lại
+    thư mục staging, đầu ra của chúng được đổi sang save_path.
+    """
+    def norm(path):
+        return os.path.normcase(os.path.abspath(path))
+
+    paths = []
+    if files_list_path and os.path.exists(files_list_path):
+        with open(files_list_path, 'r', encoding='utf-8') as f:
+            paths = [ln.strip() for ln in f if ln.strip()]
+    pending = {norm(path) for spec in POSTPROCESS['specs'] for path in spec['inputs']}
+    if POSTPROCESS['mp3']:
+        pending.update(norm(path) for path in paths if not path.lower().endswith('.mp3'))
+
+    os.makedirs(save_path, exist_ok=True)
+    moved = {}
+    with PHASES.phase('finalize') as metric:
+        for name in sorted(os.listdir(stage_dir)):
+            src = os.path.join(stage_dir, name)
+            if os.path.isfile(src) and norm(src) not in pending and not name.endswith(('.part', '.ytdl')):
+                moved[norm(src)] = move_file_atomic(src, save_path)
+        metric['files'] = len(moved)
+    for spec in POSTPROCESS['specs']:
+        if norm(os.path.dirname(spec['output'])) == norm(stage_dir):
+            spec['output'] = os.path.join(save_path, os.path.basename(spec['output']))
+    if files_list_path and paths:
+        with open(files_list_path, 'w', encoding='utf-8') as f:
+            f.writelines(moved.get(norm(path), path) + '\n' for path in paths)
+    if not pending:
+        shutil.rmtree(stage_dir, ignore_errors=True)
+    if moved:
+        print(f"STATUS: Đã chuyển {len(moved)} file hoàn chỉnh từ thư mục tạm vào {save_path}", flush=True)
+
+
+# Hậu xử lý tách khỏi bước tải (--defer-postprocess): job tải chỉ tải file gốc rồi in các bước
+# "POSTPROCESS: {...}" để app chạy bằng pool hậu xử lý riêng (--run-postprocess), slot tải được nhả ngay.
+# Reset ở đầu main(); specs là các bước đã có sẵn đầu vào (vd: merge của chế độ tải song song video/audio).
+POSTPROCESS = {'defer': False, 'mp3': False, 'archive_id': None, 'specs': []}
+
+# Tham số ffmpeg (sau các -i, trước file đích) cho từng loại bước hậu xử lý
+POSTPROCESS_FFMPEG_ARGS = {
+    'merge': ['-map', '0:v:0', '-map', '1:a:0', '-c', 'copy', '-movflags', '+faststart'],
+    # Tương đương --extract-audio --audio-format mp3 --audio-quality 0 của yt-dlp
+    'mp3': ['-vn', '-c:a', 'libmp3lame', '-q:a', '0'],
+    'thumbnail': ['-frames:v', '1', '-update', '1'],
+}
+
+
+def run_ffmpeg_task(ffmpeg, kind, inputs, output):
+    """Chạy ffmpeg cho một bước hậu xử lý, ghi ra file tạm rồi đổi tên. Trả về None nếu thành công, nếu không là lỗi"""
+    root, ext = os.path.splitext(output)
+    temp_path = f"{root}.temp{ext}"
+    args = [ffmpeg, '-y', '-loglevel', 'error']
+    for path in inputs:
+        args.extend(['-i', path])
+    proc = subprocess.run(
+        args + POSTPROCESS_FFMPEG_ARGS[kind] + [temp_path],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        encoding='utf-8',
+        errors='replace',
+        creationflags=CREATE_NO_WINDOW
+    )
+    if proc.returncode != 0:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        return proc.stdout.strip()[-300:] or f"ffmpeg thoát với mã {proc.returncode}"
+    os.replace(temp_path, output)
+    return None
+
+
+def emit_deferred_postprocess(paths, thumbnail, platform, output_dir=None):
+    """
+    Kết thúc job tải ở chế độ --defer-postprocess: file gốc cần chuyển sang mp3 và thumbnail cần đổi sang jpg
+    được in thành các dòng POSTPROCESS: cho pool hậu xử lý của app. File không cần xử lý thêm được ghi
+    vào chỉ mục nội dung ngay. output_dir: nơi ghi file mp3 (mặc định cạnh file gốc; staging: save_path).
+    """
+    specs = POSTPROCESS['specs']
+    outputs = [spec['output'] for spec in specs]
+    finished = []
+    for path in paths:
+        if POSTPROCESS['mp3'] and not path.lower().endswith('.mp3'):
+            output = os.path.join(output_dir or os.path.dirname(path),
+                                  os.path.splitext(os.path.basename(path))[0] + '.mp3')
+            specs.append({'kind': 'mp3', 'inputs': [path], 'output': output,
+                          'archive_id': POSTPROCESS['archive_id'], 'platform': platform})
+        else:
+            output = path
+            finished.append(path)
+        outputs.append(output)
+    if finished:
+        record_downloaded_files(finished, platform)
+    if thumbnail:
+        for output in outputs:
+            base = os.path.splitext(output)[0]
+            for ext in ('.webp', '.png'):
+                if os.path.exists(base + ext):
+                    specs.append({'kind': 'thumbnail', 'inputs': [base + ext], 'output': base + '.jpg'})
+    for spec in specs:
+        print("POSTPROCESS: " + json.dumps(spec, ensure_ascii=False), flush=True)
+    if specs:
+        print(f"STATUS: Đã tải xong, chuyển {len(specs)} bước hậu xử lý sang hàng chờ xử lý riêng.", flush=True)
+
+
+def run_postprocess(spec_text, resources_path, use_archive=True):
+    """
+    Chạy một bước hậu xử lý (--run-postprocess '<json>'): merge video/audio, chuyển mp3 hoặc đổi thumbnail
+    sang jpg. Thành công thì xóa file gốc, ghi download archive và chỉ mục nội dung cho file kết quả.
+    """
+    emit_event('phase', phase='postprocess')
+    PHASES.reset()
+    try:
+        spec = json.loads(spec_text)
+        kind, inputs, output = spec['kind'], spec['inputs'], spec['output']
+    except (ValueError, KeyError, TypeError) as e:
+        print(f"ERROR: Bước hậu xử lý không hợp lệ: {e}")
+        return 1
+    if kind not in POSTPROCESS_FFMPEG_ARGS:
+        print(f"ERROR: Không hỗ trợ bước hậu xử lý: {kind}")
+        return 1
+    missing = [path for path in inputs if not os.path.exists(path)]
+    if missing:
+        print(f"ERROR: Không tìm thấy file cần xử lý: {', '.join(missing)}")
+        return 1
+    ffmpeg = _find_ffmpeg_exe(find_ffmpeg_location(resources_path))
+    if not ffmpeg:
+        print("ERROR: Không tìm thấy ffmpeg để hậu xử lý.")
+        return 1
+
+    labels = {'merge': 'Merge video và audio', 'mp3': 'Chuyển sang MP3', 'thumbnail': 'Chuyển thumbnail sang JPG'}
+    print(f"STATUS: {labels[kind]}: {output}", flush=True)
+    started = time.time()
+    with PHASES.phase(f"postprocess:{kind}") as metric:
+        error = run_ffmpeg_task(ffmpeg, kind, inputs, output)
+        metric['ok'] = not error
+    if error:
+        print(f"ERROR: {labels[kind]} thất bại: {error}")
+        return 1
+    for path in inputs:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    # Đầu vào nằm trong thư mục staging (--scratch-dir): dọn luôn thư mục nếu đã hết việc
+    remove_stage_dir_if_done(os.path.dirname(os.path.abspath(inputs[0])))
+    if use_archive and spec.get('archive_id'):
+        append_download_archive(get_download_archive_path(), spec['archive_id'])
+    if kind != 'thumbnail':
+        try:
+            record_downloaded_files([output], spec.get('platform') or 'generic')
+        except (OSError, TimeoutError) as e:
+            print(f"WARNING: Không cập nhật được chỉ mục nội dung: {e}")
+    print(f"SUCCESS: {labels[kind]} xong ({time.time() - started:.1f}s).")
+    return 0
+
+
+# Fallback thumbnail cho video chỉ có ảnh: tải thẳng từ URL thumbnail trong metadata đã extract nếu có, nếu không
+# thì chạy song song các player client (client đầu tiên thành công thắng). Thumbnail được cache theo ID video
+# (state/thumbnail_cache/<id>/) để lần yêu cầu sau với cùng video không cần chạy yt-dlp.
+THUMBNAIL_CACHE_MAX_AGE = 6 * 3600
+THUMBNAIL_EXTS = ('.webp', '.jpg', '.jpeg', '.png')
+# Đổi thumbnail sang jpg chạy nền trong tiến trình tải (khi hậu xử lý không tách sang pool của app)
+THUMBNAIL_JOBS = {'executor': None, 'futures': []}
+
+
+def get_thumbnail_cache_dir():
+    state_dir = get_user_state_dir()
+    if not state_dir:
+        return None
+    cache_dir = os.path.join(state_dir, 'thumbnail_cache')
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+
+def _thumbnail_cache_slot(video_key):
+    cache_dir = get_thumbnail_cache_dir()
+    return os.path.join(cache_dir, re.sub(r'[^\w-]+', '_', video_key)) if cache_dir else None
+
+
+def restore_cached_thumbnail(video_key, save_path, prefer_jpg=False):
+    """
+    Chép thumbnail đã cache của video (chưa quá THUMBNAIL_CACHE_MAX_AGE) vào save_path, ưu tiên bản jpg nếu
+    prefer_jpg. Trả về đường dẫn file trong save_path, None nếu chưa có.
+    """
+    slot = _thumbnail_cache_slot(video_key)
+    mtime = _path_mtime(slot) if slot else None
+    if mtime is None or time.time() - mtime >= THUMBNAIL_CACHE_MAX_AGE:
+        return None
+    try:
+        names = sorted(name for name in os.listdir(slot) if name.lower().endswith(THUMBNAIL_EXTS))
+        jpgs = [name for name in names if name.lower().endswith(('.jpg', '.jpeg'))]
+        others = [name for name in names if name not in jpgs]
+        choices = (jpgs if prefer_jpg else []) + others + jpgs
+        if not choices:
+            return None
+        dest = os.path.join(save_path, choices[0])
+        if not os.path.exists(dest):
+            os.makedirs(save_path, exist_ok=True)
+            shutil.copyfile(os.path.join(slot, choices[0]), dest)
+        return dest
+    except OSError:
+        return None
+
+
+def cache_thumbnail(video_key, path):
+    """Lưu bản sao thumbnail vào cache theo ID video, đồng thời dọn các video đã quá hạn"""
+    slot = _thumbnail_cache_slot(video_key)
+    if not slot:
+        return
+    cache_dir = os.path.dirname(slot)
+    now = time.time()
+    for name in os.listdir(cache_dir):
+        old_slot = os.path.join(cache_dir, name)
+        mtime = _path_mtime(old_slot)
+        if mtime is not None and now - mtime >= THUMBNAIL_CACHE_MAX_AGE:
+            shutil.rmtree(old_slot, ignore_errors=True)
+    os.makedirs(slot, exist_ok=True)
+    target = os.path.join(slot, os.path.basename(path))
+    tmp_path = f"{target}.{os.getpid()}.tmp"
+    shutil.copyfile(path, tmp_path)
+    os.replace(tmp_path, target)
+
+
+def fetch_thumbnail_from_info(info, save_path, timeout=30):
+    """
+    Tải thumbnail thẳng từ URL trong info dict đã extract (không chạy yt-dlp), tên file theo filename yt-dlp đã tính.
+    Trả về đường dẫn file, None nếu info thiếu thông tin hoặc tải thất bại.
+    """
+    filename = info.get('filename') or info.get('_filename')
+    # yt-dlp xếp thumbnails theo độ ưu tiên tăng dần: thử từ cái tốt nhất
+    thumbs = [thumb for thumb in reversed(info.get('thumbnails') or []) if thumb.get('url')]
+    if not thumbs and info.get('thumbnail'):
+        thumbs = [{'url': info['thumbnail']}]
+    if not filename or not thumbs:
+        return None
+    root = os.path.join(save_path, os.path.splitext(os.path.basename(filename))[0])
+    os.makedirs(save_path, exist_ok=True)
+    for thumb in thumbs[:3]:
+        ext = os.path.splitext(urllib.parse.urlparse(thumb['url']).path)[1].lower()
+        path = root + (ext if ext in THUMBNAIL_EXTS else '.jpg')
+        headers = dict(info.get('http_headers') or {}, **(thumb.get('http_headers') or {}))
+        try:
+            request = urllib.request.Request(thumb['url'], headers=headers)
+            with urllib.request.urlopen(request, timeout=timeout) as response, open(path + '.part', 'wb') as f:
+                shutil.copyfileobj(response, f)
+            os.replace(path + '.part', path)
+            return path
+        except (OSError, ValueError) as e:
+            print(f"WARNING: Không tải được thumbnail từ metadata ({thumb['url'][:80]}): {e}", flush=True)
+            try:
+                os.remove(path + '.part')
+            except OSError:
+                pass
+    return None
+
+
+def race_thumbnail_clients(platform, base_command, url, clients, env, save_path, name_template,
+                           max_workers=3, timeout=60):
+    """
+    Chạy song song `yt-dlp --write-thumbnail --skip-download` với từng player client, mỗi client ghi vào thư mục tạm
+    riêng. Client đầu tiên lấy được thumbnail thắng: các tiến trình còn lại bị dừng, file được chuyển vào save_path.
+    Trả về (client, đường dẫn thumbnail), hoặc None nếu tất cả đều thất bại.
+    """
+    ordered = [name.split(':', 1)[1] for name in order_strategies(platform, [f'thumbnail:{c}' for c in clients])]
+    print(f"STATUS: Thử song song {len(ordered)} client để lấy thumbnail ({', '.join(ordered)})...", flush=True)
+
+    temp_root = os.path.join(get_thumbnail_cache_dir() or save_path, f".tmp-{os.getpid()}-{time.time_ns()}")
+    done = threading.Event()
+    lock = threading.Lock()
+    running = {}
+    result = {}
+
+    def attempt(client):
+        if done.is_set():
+            return client, 'cancelled', 0.0, None
+        budget = acquire_host_budget(platform, urllib.parse.urlparse(url).hostname)
+        if done.is_set():
+            return client, 'cancelled', 0.0, None
+        client_dir = os.path.join(temp_root, client)
+        cmd = base_command + ['--extractor-args', f'youtube:player_client={client}',
+                              '-o', os.path.join(client_dir, name_template), url]
+        started = time.time()
+        proc = subprocess.Popen(
+            cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            encoding='utf-8',
+            errors='replace',
+            creationflags=CREATE_NO_WINDOW,
+            env=env
+        )
+        with lock:
+            JOB_STATS['extractions'] += 1
+            running[client] = proc
+            if done.is_set():
+                proc.kill()
+        try:
+            out, _ = proc.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.communicate()
+            return client, 'timeout', time.time() - started, None
+        finally:
+            with lock:
+                running.pop(client, None)
+        elapsed = time.time() - started
+
+        files = []
+        if proc.returncode == 0 and os.path.isdir(client_dir):
+            files = [os.path.join(client_dir, name) for name in sorted(os.listdir(client_dir))
+                     if name.lower().endswith(THUMBNAIL_EXTS)]
+        if files:
+            with lock:
+                if not done.is_set():
+                    done.set()
+                    result.update(client=client, path=files[0])
+                    for other in running.values():
+                        other.kill()
+                    return client, 'won', elapsed, None
+        if done.is_set():
+            return client, 'cancelled', elapsed, None
+        report_host_throttle(platform, urllib.parse.urlparse(url).hostname, budget, out or '')
+        errors = [ln.strip() for ln in (out or '').splitlines() if ln.strip().startswith('ERROR')]
+        return client, 'failed', elapsed, errors[-1] if errors else None
+
+    status_text = {'won': 'THẮNG', 'failed': 'thất bại', 'timeout': 'quá thời gian', 'cancelled': 'đã hủy'}
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            futures = [executor.submit(attempt, client) for client in ordered]
+            for future in as_completed(futures):
+                client, status, elapsed, error = future.result()
+                if status in ('won', 'failed', 'timeout'):
+                    record_strategy_result(platform, f'thumbnail:{client}', status == 'won', elapsed)
+                    emit_event('strategy', platform=platform, strategy=f'thumbnail:{client}', ok=status == 'won',
+                               duration=round(elapsed, 3))
+                print(f"STATUS: [thumbnail] {client}: {status_text[status]} ({elapsed:.1f}s)", flush=True)
+                if error:
+                    print(f"   {error}", flush=True)
+        if not result:
+            return None
+        dest = os.path.join(save_path, os.path.basename(result['path']))
+        os.makedirs(save_path, exist_ok=True)
+        shutil.move(result['path'], dest)
+        return result['client'], dest
+    finally:
+        shutil.rmtree(temp_root, ignore_errors=True)
+
+
+def queue_thumbnail_conversion(path, resources_path, video_key=None):
+    """
+    Đổi thumbnail (webp/png) sang jpg mà không chặn job: ở pool hậu xử lý của app (--defer-postprocess, in dòng
+    POSTPROCESS:) hoặc ở pool nền của tiến trình này (main() chờ ở wait_thumbnail_conversions()).
+    """
+    if path.lower().endswith(('.jpg', '.jpeg')):
+        return
+    output = os.path.splitext(path)[0] + '.jpg'
+    if POSTPROCESS['defer']:
+        POSTPROCESS['specs'].append({'kind': 'thumbnail', 'inputs': [path], 'output': output})
+        return
+    ffmpeg = _find_ffmpeg_exe(find_ffmpeg_location(resources_path))
+    if not ffmpeg:
+        print("WARNING: Không tìm thấy ffmpeg, giữ nguyên thumbnail chưa chuyển sang JPG.", flush=True)
+        return
+    if THUMBNAIL_JOBS['executor'] is None:
+        THUMBNAIL_JOBS['executor'] = ThreadPoolExecutor(max_workers=2)
+    THUMBNAIL_JOBS['futures'].append(
+        THUMBNAIL_JOBS['executor'].submit(_convert_thumbnail, ffmpeg, path, output, video_key))
+
+
+def _convert_thumbnail(ffmpeg, path, output, video_key):
+    started = time.perf_counter()
+    error = run_ffmpeg_task(ffmpeg, 'thumbnail', [path], output)
+    ended = time.perf_counter()
+    if not error:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        if video_key:
+            try:
+                cache_thumbnail(video_key, output)
+            except OSError:
+                pass
+    return output, error, started, ended
+
+
+def wait_thumbnail_conversions():
+    """Chờ các lần đổi thumbnail chạy nền của job hiện tại, in kết quả và ghi thời gian vào PHASES"""
+    futures, THUMBNAIL_JOBS['futures'] = THUMBNAIL_JOBS['futures'], []
+    for future in futures:
+        output, error, started, ended = future.result()
+        # Chạy song song với phần còn lại của job nên không cộng vào tổng theo loại pha
+        PHASES.record('postprocess:thumbnail', started, ended, ok=not error, parent='background')
+        if error:
+            print(f"WARNING: Chuyển thumbnail sang JPG thất bại ({output}): {error}", flush=True)
+        else:
+            print(f"STATUS: Đã chuyển thumbnail sang JPG: {output}", flush=True)
+
+
+# Chế độ --events json: mọi dòng stdout của job được chuyển thành một event JSON trên một dòng
+PROGRESS_MARKER = '__PROGRESS__ '
+PROGRESS_FIELDS = ('status', 'downloaded_bytes', 'total_bytes', 'total_bytes_estimate', 'speed', 'eta',
+                   'fragment_index', 'fragment_count')
+# yt-dlp in tiến độ qua --progress-template thay cho dòng [download] xx% (mỗi lần cập nhật một dòng nhờ --newline)
+EVENT_PROGRESS_ARGS = ['--newline', '--progress-template',
+                       'download:' + PROGRESS_MARKER + '%(progress.{' + ','.join(PROGRESS_FIELDS) + '})j']
+EVENTS = {'stream': None}
+
+# Dòng log của yt-dlp báo hiệu chuyển giai đoạn
+YTDLP_PHASE_PREFIXES = (
+    ('[download] Destination:', 'download'),
+    ('[Merger]', 'merge'),
+    ('[ExtractAudio]', 'postprocess'),
+    ('[VideoConvertor]', 'postprocess'),
+    ('[FixupM3u8]', 'postprocess'),
+    ('[Metadata]', 'postprocess'),
+)
+
+# Bảng luật nhận diện lỗi trong output của yt-dlp: (cờ, regex trên dòng đã lower(), có phải lỗi chốt hay không).
+# Gặp dòng "ERROR:" khớp luật chốt thì yt-dlp sắp thoát: dừng đọc ngay để chuyển sang fallback.
+ERROR_RULES = (
+    ('cookie_locked', r'could not copy (?:chrome|edge) cookie database', True),
+    ('dpapi', r'failed to decrypt with dpapi', True),
+    ('yt_152', r'error code: 152|watch video on youtube', True),
+    ('age_restricted', r'confirm your age|age-restricted', False),
+    ('yt_unavailable', r'video is unavailable', False),
+    ('removed', r'video unavailable|has been removed', False),
+    ('tiktok_status0', r'video not available|status code 0', True),
+    ('no_formats', r'requested format is not available', True),
+    ('only_images', r'only images are available', True),
+    ('challenge_failed', r'challenge solving failed', False),
+    ('bot_check', r'sign in.*bot', False),
+    ('cookies_required', r'from-browser.*cookies', False),
+    ('auth_required', r'authentication.*required', False),
+    ('members_only', r'members only|private video|login to confirm', False),
+    ('rate_limited', r'http error 429|too many requests', False),
+    ('geo_blocked', r'not available in your country|geo[ -]restrict', False),
+    ('forbidden', r'http error 403', False),
+    ('network', r'timed out|connection reset|unable to download webpage|getaddrinfo failed|'
+                r'network is unreachable', False),
+    ('archive_skip', r'has already been recorded in the archive', False),
+    ('disk_full', r'no space left on device|not enough space on the disk', True),
+)
+_COMPILED_ERROR_RULES = tuple((flag, re.compile(pattern), fatal) for flag, pattern, fatal in ERROR_RULES)
+# Lọc nhanh: phần lớn dòng log không khớp luật nào, chỉ cần một lần search
+_ANY_ERROR_RULE = re.compile('|'.join(f'(?:{pattern})' for _, pattern, _ in ERROR_RULES))
+
+# Nhóm lỗi (theo thứ tự ưu tiên) gửi cho app qua event error
+ERROR_CLASS_FLAGS = (
+    ('cookies', ('cookie_locked', 'dpapi')),
+    ('auth', ('bot_check', 'cookies_required', 'auth_required', 'members_only', 'age_restricted')),
+    ('rate_limit', ('rate_limited',)),
+    ('geo', ('geo_blocked',)),
+    ('unavailable', ('yt_152', 'yt_unavailable', 'removed', 'tiktok_status0')),
+    ('format', ('no_formats', 'only_images')),
+    ('forbidden', ('forbidden',)),
+    ('network', ('network',)),
+    ('disk', ('disk_full',)),
+)
+
+
+class ErrorClassifier:
+    """
+    Phân loại output của yt-dlp theo từng dòng ngay khi nhận được. Chỉ giữ cờ lỗi, số lần khớp
+    và một ring buffer các dòng gần nhất nên bộ nhớ không tăng theo độ dài log (playlist dài, HLS...).
+    """
+
+    def __init__(self, max_recent=200):
+        self.flags = set()
+        self.counts = {}
+        self.recent = deque(maxlen=max_recent)
+        self.last_error = None
+        self.fatal = False
+
+    def feed(self, line):
+        self.recent.append(line)
+        is_error = line.startswith('ERROR:')
+        if is_error:
+            self.last_error = line
+        lower = line.lower()
+        if not _ANY_ERROR_RULE.search(lower):
+            return
+        for flag, pattern, fatal in _COMPILED_ERROR_RULES:
+            if pattern.search(lower):
+                self.flags.add(flag)
+                self.counts[flag] = self.counts.get(flag, 0) + 1
+                if fatal and is_error:
+                    self.fatal = True
+
+    def has(self, *flags):
+        return any(flag in self.flags for flag in flags)
+
+    def merge(self, other):
+        """Gộp kết quả của một lần thử khác (fallback/retry) để các nhánh chẩn đoán phía sau dùng chung"""
+        self.flags |= other.flags
+        for flag, count in other.counts.items():
+            self.counts[flag] = self.counts.get(flag, 0) + count
+        self.recent.extend(other.recent)
+        self.last_error = other.last_error or self.last_error
+
+    def error_class(self):
+        for error_class, flags in ERROR_CLASS_FLAGS:
+            if self.has(*flags):
+                return error_class
+        return 'unknown'
+
+
+class JsonEventStream(io.TextIOBase):
+    """
+    Thay sys.stdout trong một job chạy với --events json. Mỗi dòng in ra được đổi thành event:
+        {"event": "log"|"status"|"phase"|"progress"|"entry"|"postprocess"|"strategy"|"metric"|"metric_summary"|
+                  "batch_result"|"error"|"result", ...}
+    Event progress được gộp lại, tối đa `rate` event mỗi giây (trừ lúc kết thúc một file),
+    để các bản HLS/DASH nhiều fragment không làm ngập stdout và kênh IPC của app.
+    """
+
+    def __init__(self, target, rate=5.0):
+        super().__init__()
+        self.target = target
+        self.min_interval = 1.0 / rate if rate > 0 else 0.0
+        self.buffer = ''
+        self.last_progress = 0.0
+        self.pending_progress = None
+        self.phase = None
+        self.lock = threading.RLock()
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        with self.lock:
+            self.buffer += text
+            *lines, self.buffer = self.buffer.split('\n')
+            for line in lines:
+                self._handle_line(line.rstrip('\r'))
+        return len(text)
+
+    def flush(self):
+        self.target.flush()
+
+    def emit(self, event):
+        with self.lock:
+            self.target.write(json.dumps(event, ensure_ascii=False) + '\n')
+            self.target.flush()
+
+    def set_phase(self, phase):
+        with self.lock:
+            if phase != self.phase:
+                self.phase = phase
+                self.emit({'event': 'phase', 'phase': phase})
+
+    def finish(self):
+        """Đẩy nốt phần còn trong buffer khi job kết thúc"""
+        with self.lock:
+            if self.buffer:
+                self._handle_line(self.buffer)
+                self.buffer = ''
+            self._flush_progress()
+
+    def _flush_progress(self):
+        if self.pending_progress is not None:
+            self.emit(self.pending_progress)
+            self.pending_progress = None
+            self.last_progress = time.time()
+
+    def _handle_progress(self, data):
+        event = {'event': 'progress'}
+        event.update({k: data.get(k) for k in PROGRESS_FIELDS})
+        total = data.get('total_bytes') or data.get('total_bytes_estimate')
+        if total and data.get('downloaded_bytes') is not None:
+            event['percent'] = round(data['downloaded_bytes'] * 100 / total, 1)
+        self.pending_progress = event
+        if data.get('status') != 'downloading' or time.time() - self.last_progress >= self.min_interval:
+            self._flush_progress()
+
+    def _handle_line(self, line):
+        if not line.strip():
+            return
+        if line.startswith(PROGRESS_MARKER):
+            try:
+                self._handle_progress(json.loads(line[len(PROGRESS_MARKER):]))
+                return
+            except ValueError:
+                pass
+        # Dòng khác: đẩy progress đang chờ trước để thứ tự event đúng
+        self._flush_progress()
+        if line.startswith('ENTRY: '):
+            try:
+                self.emit({'event': 'entry', **json.loads(line[len('ENTRY: '):])})
+                return
+            except ValueError:
+                pass
+        if line.startswith('POSTPROCESS: '):
+            try:
+                self.emit({'event': 'postprocess', 'spec': json.loads(line[len('POSTPROCESS: '):])})
+                return
+            except ValueError:
+                pass
+        for prefix, event_type in (('METRIC: ', 'metric'), ('METRIC_SUMMARY: ', 'metric_summary'),
+                                   ('BATCH_RESULT: ', 'batch_result')):
+            if line.startswith(prefix):
+                try:
+                    self.emit({'event': event_type, **json.loads(line[len(prefix):])})
+                    return
+                except ValueError:
+                    pass
+        for prefix, phase in YTDLP_PHASE_PREFIXES:
+            if line.startswith(prefix):
+                self.set_phase(phase)
+                break
+        if line.startswith('STATUS: '):
+            self.emit({'event': 'status', 'message': line[len('STATUS: '):]})
+            return
+        stripped = line.lstrip()
+        if stripped.startswith('ERROR:'):
+            level = 'error'
+        elif stripped.startswith('WARNING:'):
+            level = 'warning'
+        elif 'SUCCESS:' in stripped:
+            level = 'success'
+        else:
+            level = 'info'
+        self.emit({'event': 'log', 'level': level, 'message': line})
+
+
+def emit_event(event_type, **fields):
+    """Phát event có kiểu (chỉ khi chạy --events json; chế độ text không in gì thêm)"""
+    stream = EVENTS['stream']
+    if stream is None:
+        return
+    if event_type == 'phase':
+        stream.set_phase(fields['phase'])
+    else:
+        stream.emit({'event': event_type, **fields})
+
+
+@contextlib.contextmanager
+def job_event_output(mode, rate):
+    """Trong khối with, --events json: thay sys.stdout bằng JsonEventStream"""
+    if mode != 'json':
+        yield
+        return
+    old_stdout = sys.stdout
+    stream = JsonEventStream(old_stdout, rate)
+    sys.stdout = stream
+    EVENTS['stream'] = stream
+    try:
+        yield
+    finally:
+        stream.finish()
+        EVENTS['stream'] = None
+        sys.stdout = old_stdout
+
+
+def _format_bytes(num):
+    if not num:
+        return 'N/A'
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if num < 1024:
+            return f"{num:.2f}{unit}"
+        num /= 1024
+    return f"{num:.2f}TiB"
+
+
+class _YtdlpLogger:
+    """Logger cho yt_dlp.YoutubeDL: in log giống bản exe và đưa từng dòng qua ErrorClassifier để chẩn đoán lỗi"""
+
+    def __init__(self, classifier):
+        self.classifier = classifier
+
+    def _emit(self, message):
+        for line in str(message).splitlines():
+            line = line.strip()
+            if line:
+                print(line, flush=True)
+                self.classifier.feed(line)
+
+    def debug(self, message):
+        # yt-dlp gửi cả log thông thường qua debug(); chỉ bỏ các dòng [debug] thực sự
+        if not message.startswith('[debug] '):
+            self._emit(message)
+
+    def info(self, message):
+        self._emit(message)
+
+    def warning(self, message):
+        self._emit(f"WARNING: {message}")
+
+    def error(self, message):
+        self._emit(message)
+
+
+def _make_progress_hook(interval=0.5):
+    """Progress hook in tiến độ theo định dạng dòng [download] của yt-dlp (tối đa 1 dòng mỗi interval giây)"""
+    last_print = [0.0]
+
+    def hook(d):
+        if d.get('status') == 'downloading':
+            record_transfer_speed(d.get('speed'))
+        if EVENTS['stream'] is not None:
+            # JsonEventStream tự gộp tiến độ theo --events-rate
+            print(PROGRESS_MARKER + json.dumps({k: d.get(k) for k in PROGRESS_FIELDS}), flush=True)
+            return
+        now = time.time()
+        if d.get('status') == 'downloading' and now - last_print[0] < interval:
+            return
+        last_print[0] = now
+        total = d.get('total_bytes') or d.get('total_bytes_estimate')
+        downloaded = d.get('downloaded_bytes') or 0
+        if d.get('status') == 'finished':
+            print(f"[download] 100% of {_format_bytes(total or downloaded)}", flush=True)
+            return
+        if d.get('status') != 'downloading':
+            return
+        percent = f"{downloaded * 100 / total:5.1f}%" if total else '  N/A%'
+        speed = f"{_format_bytes(d.get('speed'))}/s" if d.get('speed') else 'N/A'
+        eta = d.get('eta')
+        eta_text = f"{int(eta) // 60:02d}:{int(eta) % 60:02d}" if eta is not None else 'N/A'
+        print(f"[download] {percent} of {_format_bytes(total)} at {speed} ETA {eta_text}", flush=True)
+
+    return hook
+
+
+def _import_yt_dlp():
+    try:
+        import yt_dlp
+        return yt_dlp
+    except ImportError:
+        return None
+
+
+def _run_ytdlp_inprocess(yt_dlp, command, env):
+    """
+    Chạy lệnh yt-dlp bằng thư viện yt_dlp trong cùng tiến trình.
+    argv được dịch sang params của YoutubeDL bằng chính parser của yt-dlp (yt_dlp.parse_options)
+    nên mọi tùy chọn (-f, --format-sort, cookies, headers, extractor-args, -o...) giữ nguyên ý nghĩa.
+    Info dict được cache theo extraction_key() để các lần fallback chỉ khác tùy chọn tải không phải extract lại.
+    Trả về None nếu thư viện không hỗ trợ lệnh này (khi đó dùng bản exe).
+    """
+    try:
+        parsed = yt_dlp.parse_options(command[1:])
+    except SystemExit:
+        # optparse báo lỗi tùy chọn (thư viện cũ hơn exe): quay về exe
+        return None
+
+    classifier = ErrorClassifier()
+    logger = _YtdlpLogger(classifier)
+    ydl_opts = dict(parsed.ydl_opts)
+    ydl_opts.update({
+        'logger': logger,
+        'noprogress': True,
+        'progress_hooks': [_make_progress_hook()],
+    })
+    # JS runtime không kèm đường dẫn (node portable nằm trong PATH của env): tìm theo PATH đó và truyền qua params,
+    # không sửa os.environ vì các luồng tải song song (download_streams_parallel) dùng chung tiến trình
+    runtimes = ydl_opts.get('js_runtimes')
+    if isinstance(runtimes, dict):
+        runtimes = ydl_opts['js_runtimes'] = dict(runtimes)
+        for name, config in runtimes.items():
+            if not (config or {}).get('path'):
+                found = shutil.which(name, path=env.get('PATH'))
+                if found:
+                    runtimes[name] = {**(config or {}), 'path': found}
+    key = extraction_key(command)
+
+    try:
+        ydl = yt_dlp.YoutubeDL(ydl_opts)
+    except Exception as e:
+        print(f"WARNING: Không khởi tạo được yt-dlp trong tiến trình ({e}). Dùng yt-dlp.exe.", flush=True)
+        return None
+
+    returncode = 0
+    with ydl:
+        for url in parsed.urls:
+            try:
+                info = get_memory_info((key, url))
+                cached_path = find_cached_info(command) if info is None and len(parsed.urls) == 1 else None
+                if cached_path:
+                    info = load_json_file(cached_path, None)
+                if info is None:
+                    JOB_STATS['extractions'] += 1
+                    info = ydl.extract_info(url, download=False)
+                    if info is None:
+                        returncode = 1
+                        continue
+                    info = ydl.sanitize_info(info)
+                    info_text = json.dumps(info, ensure_ascii=False)
+                    put_memory_info((key, url), info, info_text)
+                    if len(parsed.urls) == 1:
+                        store_cached_info(command, info_text)
+                else:
+                    JOB_STATS['info_reuses'] += 1
+                    print("STATUS: Dùng lại metadata đã extract, bỏ qua bước extract.", flush=True)
+                ydl.process_ie_result(copy.deepcopy(info), download=True)
+            except yt_dlp.utils.DownloadError:
+                # Thông báo lỗi đã được gửi qua logger.error()
+                returncode = 1
+            except Exception as e:
+                logger.error(f"ERROR: {e}")
+                returncode = 1
+    return returncode, classifier
+
+
+def _run_ytdlp_exe(command, env, stop_on_fatal=True):
+    """
+    Chạy yt-dlp.exe, in từng dòng log ra stdout và trả về (returncode, ErrorClassifier).
+    Gặp lỗi chốt (ERROR: khớp luật fatal trong ERROR_RULES) thì dừng tiến trình ngay, không chờ yt-dlp dọn dẹp
+    (trừ khi stop_on_fatal=False: lần chạy nhiều URL, lỗi của một video không được dừng các video còn lại).
+    """
+    spawned = time.perf_counter()
+    process = subprocess.Popen(
+        command,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        encoding='utf-8',
+        errors='replace',
+        creationflags=CREATE_NO_WINDOW,
+        env=env
+    )
+
+    classifier = ErrorClassifier()
+    first_output = True
+    for line in iter(process.stdout.readline, ''):
+        line = line.strip()
+        if line:
+            if first_output:
+                first_output = False
+                PHASES.note_ytdlp_startup(time.perf_counter() - spawned)
+            print(line, flush=True)
+            # Dòng tiến độ (--events json) không cần đưa qua bộ phân loại lỗi
+            if line.startswith(PROGRESS_MARKER):
+                try:
+                    record_transfer_speed(json.loads(line[len(PROGRESS_MARKER):]).get('speed'))
+                except ValueError:
+                    pass
+            else:
+                record_transfer_speeds_from_line(line)
+                classifier.feed(line)
+                if classifier.fatal and stop_on_fatal:
+                    process.kill()
+                    break
+
+    process.stdout.close()
+    process.wait()
+    if classifier.fatal and stop_on_fatal:
+        return 1, classifier
+    return process.returncode, classifier
+
+
+def _run_ytdlp_exe_with_info_cache(command, env, stop_on_fatal=True):
+    """
+    Chạy yt-dlp.exe có tận dụng info JSON trên đĩa:
+    - Nếu đã có info còn hạn cho cùng phần extract của lệnh: thay URL bằng --load-info-json, không extract lại.
+    - Nếu chưa có: chạy bình thường kèm --print-to-file "video:%()j" để yt-dlp ghi info sau khi extract
+      (cùng tiến trình, không tốn thêm lần chạy -J). Info được lưu kể cả khi bước tải sau đó thất bại,
+      để các lần fallback chỉ đổi tùy chọn tải dùng lại được.
+    stop_on_fatal: xem _run_ytdlp_exe.
+    """
+    url = command[-1]
+    cache_dir = get_info_cache_dir() if METADATA_CACHE['ttl'] > 0 else None
+    if not cache_dir or url.startswith('-') or '--load-info-json' in command:
+        JOB_STATS['extractions'] += 1
+        return _run_ytdlp_exe(command, env, stop_on_fatal)
+
+    cached_path = find_cached_info(command)
+    if cached_path:
+        JOB_STATS['info_reuses'] += 1
+        print("STATUS: Dùng lại metadata đã extract (--load-info-json), bỏ qua bước extract.", flush=True)
+        return _run_ytdlp_exe(command[:-1] + ['--load-info-json', cached_path], env, stop_on_fatal)
+
+    dump_path = os.path.join(cache_dir, f"dump-{os.getpid()}-{time.time_ns()}.jsonl")
+    JOB_STATS['extractions'] += 1
+    try:
+        result = _run_ytdlp_exe(command[:-1] + ['--print-to-file', 'video:%()j', dump_path, url], env, stop_on_fatal)
+        try:
+            with open(dump_path, 'r', encoding='utf-8') as f:
+                lines = [ln for ln in f.read().splitlines() if ln.strip()]
+        except OSError:
+            lines = []
+        # Chỉ cache video đơn lẻ; playlist ghi nhiều dòng (mỗi entry một dòng)
+        if len(lines) == 1:
+            try:
+                store_cached_info(command, lines[0])
+            except OSError as e:
+                print(f"WARNING: Không lưu được metadata vào cache: {e}")
+        return result
+    finally:
+        try:
+            os.remove(dump_path)
+        except OSError:
+            pass
+
+
+def run_ytdlp(command, env, engine='exe', stop_on_fatal=True):
+    """
+    Chạy một lệnh yt-dlp (argv, phần tử đầu là đường dẫn yt-dlp.exe).
+    engine='python': dùng thư viện yt_dlp trong tiến trình nếu import được, nếu không thì dùng exe.
+    stop_on_fatal=False cho lệnh tải nhiều video (playlist/kênh): lỗi chốt của một video không dừng cả lần chạy.
+    Cả hai engine đều dùng chung bộ nhớ đệm info JSON trên đĩa (xem METADATA_CACHE).
+    Trả về (returncode, ErrorClassifier).
+    """
+    if EVENTS['stream'] is not None and not command[-1].startswith('-'):
+        command = command[:-1] + EVENT_PROGRESS_ARGS + command[-1:]
+    if engine == 'python':
+        yt_dlp = _import_yt_dlp()
+        if yt_dlp is not None:
+            result = _run_ytdlp_inprocess(yt_dlp, command, env)
+            if result is not None:
+                return result
+    return _run_ytdlp_exe_with_info_cache(command, env, stop_on_fatal)
+
+
+def _find_ffmpeg_exe(ffmpeg_location):
+    for name in ('ffmpeg.exe', 'ffmpeg'):
+        path = os.path.join(ffmpeg_location or '', name)
+        if os.path.isfile(path):
+            return path
+    return shutil.which('ffmpeg')
+
+
+def _merge_output_ext(command, paths):
+    """
+    Đuôi file merge: theo --merge-output-format của lệnh (giá trị đầu nếu có dạng mp4/mkv), nếu không có thì chọn
+    như yt-dlp: mp4 khi các phần đều là mp4/m4a, webm khi đều là webm/weba, còn lại mkv.
+    """
+    if '--merge-output-format' in command:
+        return command[command.index('--merge-output-format') + 1].split('/')[0]
+    exts = {os.path.splitext(path)[1].lower().lstrip('.') for path in paths}
+    if exts <= {'mp4', 'm4a', 'm4v'}:
+        return 'mp4'
+    if exts <= {'webm', 'weba'}:
+        return 'webm'
+    return 'mkv'
+
+
+def download_streams_parallel(command, formats, env, ffmpeg_location, archive_path=None, files_list_path=None,
+                              platform=None):
+    """
+    Tải format video và audio (formats = [video_id, audio_id]) bằng hai tiến trình yt-dlp chạy song song thay vì
+    tuần tự như khi yt-dlp tự xử lý 'video+audio', rồi merge bằng ffmpeg (-c copy) ngay khi cả hai xong.
+    Cần info JSON đã cache (cả hai tiến trình dùng --load-info-json, không extract lại), nếu không trả về lỗi ngay.
+    Tiến độ của hai luồng được cộng lại thành một tổng chung. Ở chế độ --defer-postprocess bước merge được
+    giao cho pool hậu xử lý của app thay vì chạy ngay. Trả về (returncode, ErrorClassifier).
+    """
+    cached_path = find_cached_info(command)
+    state_dir = get_user_state_dir()
+    if not cached_path or not state_dir:
+        classifier = ErrorClassifier()
+        classifier.feed("WARNING: Không có info JSON đã cache, không tải song song video/audio được.")
+        return 1, classifier
+    output_template = command[command.index('-o') + 1]
+    # Đặt tên giống file tạm của yt-dlp khi merge (<tên>.f<format_id>.<ext>): nếu phải quay về cách tải thông thường,
+    # yt-dlp nhận ra các phần đã tải xong và không tải lại
+    part_template = (output_template[:-len('.%(ext)s')] if output_template.endswith('.%(ext)s')
+                     else output_template) + '.f%(format_id)s.%(ext)s'
+    base = command[:-1]
+    for flag, nargs in (('-f', 1), ('-o', 1), ('--format-sort', 1), ('--merge-output-format', 1),
+                        ('--postprocessor-args', 1), ('--download-archive', 1), ('--print-to-file', 2)):
+        base = _strip_option(base, flag, nargs)
+
+    parts = []
+    for index, format_id in enumerate(formats):
+        part_cmd = base if index == 0 else _strip_option(base, '--write-thumbnail', 0)
+        list_path = os.path.join(state_dir, f"part-{os.getpid()}-{time.time_ns()}-{index}.txt")
+        part_cmd = part_cmd + ['-f', format_id, '-o', part_template, '-o', f"thumbnail:{output_template}",
+                               '--print-to-file', 'after_move:filepath', list_path,
+                               *EVENT_PROGRESS_ARGS, '--load-info-json', cached_path]
+        parts.append({'format_id': format_id, 'command': part_cmd, 'list_path': list_path,
+                      'classifier': ErrorClassifier(), 'progress': {}})
+
+    print(f"STATUS: Tải song song video ({formats[0]}) và audio ({formats[1]}), merge khi cả hai xong...", flush=True)
+    JOB_STATS['info_reuses'] += 1
+    lock = threading.Lock()
+    hook = _make_progress_hook()
+
+    def report_progress():
+        states = [part['progress'] for part in parts]
+        downloaded = sum(s.get('downloaded_bytes') or 0 for s in states)
+        total = sum(s.get('total_bytes') or s.get('total_bytes_estimate') or 0 for s in states)
+        speed = sum(s.get('speed') or 0 for s in states if s.get('status') == 'downloading')
+        done = all(s.get('status') == 'finished' for s in states)
+        hook({'status': 'finished' if done else 'downloading', 'downloaded_bytes': downloaded,
+              'total_bytes': total or None, 'speed': speed or None,
+              'eta': (total - downloaded) / speed if speed and total else None})
+
+    def pump(part):
+        process = part['process']
+        for line in iter(process.stdout.readline, ''):
+            line = line.strip()
+            if not line:
+                continue
+            part.setdefault('first_output', time.perf_counter())
+            with lock:
+                if line.startswith(PROGRESS_MARKER):
+                    try:
+                        part['progress'] = json.loads(line[len(PROGRESS_MARKER):])
+                        # Mẫu tốc độ cho tự điều chỉnh fragment và trần băng thông theo host (như _run_ytdlp_exe)
+                        record_transfer_speed(part['progress'].get('speed'))
+                        report_progress()
+                        continue
+                    except ValueError:
+                        pass
+                print(line, flush=True)
+                part['classifier'].feed(line)
+                if part['classifier'].fatal:
+                    for other in parts:
+                        other['process'].kill()
+        process.stdout.close()
+        part['returncode'] = process.wait()
+        part['ended'] = time.perf_counter()
+
+    stream_platform, stream_host = command_host(command)
+    try:
+        for part in parts:
+            part['budget'] = acquire_host_budget(stream_platform, stream_host)
+            part['started'] = time.perf_counter()
+            part['process'] = subprocess.Popen(
+                part['command'],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                text=True,
+                encoding='utf-8',
+                errors='replace',
+                creationflags=CREATE_NO_WINDOW,
+                env=env
+            )
+        threads = [threading.Thread(target=pump, args=(part,), daemon=True) for part in parts]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        classifier = ErrorClassifier()
+        for part in parts:
+            classifier.merge(part['classifier'])
+            if 'first_output' in part:
+                PHASES.note_ytdlp_startup(part['first_output'] - part['started'])
+            PHASES.record(f"stream:{part['format_id']}", part['started'], part['ended'], ok=part['returncode'] == 0)
+            if part['returncode'] != 0:
+                report_host_throttle(stream_platform, stream_host, part['budget'], part['classifier'])
+        if any(part['returncode'] != 0 for part in parts):
+            return 1, classifier
+
+        paths = []
+        for part in parts:
+            with open(part['list_path'], 'r', encoding='utf-8') as f:
+                lines = f.read().strip().splitlines()
+            # yt-dlp thoát 0 nhưng không tải gì (vd bị archive bỏ qua): để cách tải thông thường xử lý
+            if not lines:
+                classifier.feed(f"WARNING: Luồng {part['format_id']} không tạo ra file nào.")
+                print(classifier.recent[-1], flush=True)
+                return 1, classifier
+            paths.append(lines[-1])
+        final_path = re.sub(r'\.f[^.\\/]+\.[^.\\/]+$', f".{_merge_output_ext(command, paths)}", paths[0])
+        info = load_json_file(cached_path, {})
+        archive_id = (f"{info['extractor_key'].lower()} {info['id']}"
+                      if info.get('id') and info.get('extractor_key') else None)
+        if POSTPROCESS['defer']:
+            POSTPROCESS['specs'].append({'kind': 'merge', 'inputs': paths, 'output': final_path,
+                                         'archive_id': archive_id if archive_path else None, 'platform': platform})
+            return 0, classifier
+        ffmpeg = _find_ffmpeg_exe(ffmpeg_location)
+        if not ffmpeg:
+            classifier.feed("ERROR: Không tìm thấy ffmpeg để merge video và audio.")
+            print(classifier.last_error, flush=True)
+            return 1, classifier
+        print(f'[Merger] Merging formats into "{final_path}"', flush=True)
+        with PHASES.phase('merge') as metric:
+            error = run_ffmpeg_task(ffmpeg, 'merge', paths, final_path)
+            metric['ok'] = not error
+        if error:
+            classifier.feed(f"ERROR: Merge bằng ffmpeg thất bại: {error}")
+            print(classifier.last_error, flush=True)
+            return 1, classifier
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+        append_download_archive(archive_path, archive_id)
+        if files_list_path:
+            with open(files_list_path, 'a', encoding='utf-8') as f:
+                f.write(final_path + '\n')
+        return 0, classifier
+    except OSError as e:
+        for part in parts:
+            if part.get('process') and part['process'].poll() is None:
+                part['process'].kill()
+        classifier = ErrorClassifier()
+        classifier.feed(f"ERROR: Tải song song video/audio thất bại: {e}")
+        print(classifier.last_error, flush=True)
+        return 1, classifier
+    finally:
+        for part in parts:
+            try:
+                os.remove(part['list_path'])
+            except OSError:
+                pass
+
+
+def download_batch(command, env, urls, platform):
+    """
+    Tải một nhóm URL (cùng platform, cùng tùy chọn) bằng một lần chạy yt-dlp: URL được ghi vào --batch-file thay cho
+    URL cuối của command, --ignore-errors để video lỗi không dừng cả nhóm, và yt-dlp ghi original_url của từng video
+    đã tải xong (after_move) để biết kết quả của từng URL. Kết quả ghi vào BATCH_RESULTS; trả về 0 nếu tải xong cả nhóm.
+    """
+    BATCH_RESULTS.clear()
+    state_dir = get_user_state_dir()
+    if not state_dir:
+        print("ERROR: Không có thư mục trạng thái để ghi danh sách URL cho yt-dlp.")
+        BATCH_RESULTS.update((url, False) for url in urls)
+        return 1
+    stamp = f"{os.getpid()}-{time.time_ns()}"
+    batch_path = os.path.join(state_dir, f"batch-{stamp}.txt")
+    done_path = os.path.join(state_dir, f"batch-done-{stamp}.txt")
+    cmd = command[:-1] + ['--ignore-errors', '--print-to-file', 'after_move:%(original_url)s', done_path]
+    if EVENTS['stream'] is not None:
+        cmd += EVENT_PROGRESS_ARGS
+    cmd += ['--batch-file', batch_path]
+    print(f"STATUS: Tải {len(urls)} URL {platform} bằng một lần chạy yt-dlp...", flush=True)
+    JOB_STATS['extractions'] += len(urls)
+    try:
+        with open(batch_path, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(urls) + '\n')
+        batch_platform, batch_host = command_host(command)
+        budget = acquire_host_budget(batch_platform, batch_host)
+        with PHASES.phase('batch', urls=len(urls)) as metric:
+            _, output = _run_ytdlp_exe(cmd, env, stop_on_fatal=False)
+            report_host_throttle(batch_platform, batch_host, budget, output)
+            try:
+                with open(done_path, 'r', encoding='utf-8') as f:
+                    done = {line.strip() for line in f if line.strip()}
+            except OSError:
+                done = set()
+            BATCH_RESULTS.update((url, url in done) for url in urls)
+            metric.update(ok=all(BATCH_RESULTS.values()), downloaded=sum(BATCH_RESULTS.values()))
+    finally:
+        for path in (batch_path, done_path):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+    return 0 if all(BATCH_RESULTS.values()) else 1
+
+
+# Biến thể client theo platform dùng cho chế độ race (tên strategy -> giá trị --extractor-args)
+RACE_CLIENT_VARIANTS = {
+    'youtube': [
+        ('client:web', 'youtube:player_client=web'),
+        ('client:tv_embedded', 'youtube:player_client=tv_embedded'),
+    ],
+    'tiktok': [
+        ('client:android', 'tiktok:player_client=android,app_info=1,download_api=1'),
+        ('client:ios', 'tiktok:player_client=ios'),
+    ],
+}
+
+
+def _strip_option(cmd, flag, nargs=1):
+    """Bỏ mọi lần xuất hiện của flag (kèm nargs tham số) khỏi lệnh"""
+    out = []
+    i = 0
+    while i < len(cmd):
+        if cmd[i] == flag:
+            i += 1 + nargs
+            continue
+        out.append(cmd[i])
+        i += 1
+    return out
+
+
+def _insert_before_url(cmd, *args):
+    """Chèn tham số vào trước URL (phần tử cuối của lệnh)"""
+    return cmd[:-1] + list(args) + cmd[-1:]
+
+
+def _replace_extractor_args(cmd, platform, value):
+    """Thay --extractor-args của platform (vd: 'youtube:...') bằng value, giữ nguyên extractor-args khác"""
+    out = []
+    i = 0
+    while i < len(cmd):
+        if cmd[i] == '--extractor-args' and i + 1 < len(cmd) and cmd[i + 1].startswith(f'{platform}:'):
+            i += 2
+            continue
+        out.append(cmd[i])
+        i += 1
+    return _insert_before_url(out, '--extractor-args', value)
+
+
+def build_race_strategies(platform, command, browser_sources, cookies_path):
+    """
+    Các cấu hình ứng viên cho chế độ race, dạng [(tên strategy, lệnh yt-dlp)].
+    Chỉ khác nhau ở phía extract: nguồn cookies và player client.
+    """
+    strategies = [('default', list(command))]
+    without_browser = _strip_option(command, '--cookies-from-browser')
+    current_browser = command[command.index('--cookies-from-browser') + 1] if '--cookies-from-browser' in command else None
+    for browser in browser_sources:
+        if browser == current_browser:
+            continue
+        strategies.append((f'cookies:{browser}', _insert_before_url(without_browser, '--cookies-from-browser', browser)))
+    if cookies_path and os.path.exists(cookies_path):
+        strategies.append(('cookies-file', _insert_before_url(_strip_option(without_browser, '--cookies'),
+                                                              '--cookies', cookies_path)))
+    if platform in ('tiktok', 'douyin'):
+        strategies.append(('no-cookies', _strip_option(without_browser, '--cookies')))
+    for name, value in RACE_CLIENT_VARIANTS.get(platform, []):
+        strategies.append((name, _replace_extractor_args(command, platform, value)))
+
+    unique = []
+    seen = set()
+    for name, cmd in strategies:
+        if tuple(cmd) not in seen:
+            seen.add(tuple(cmd))
+            unique.append((name, cmd))
+    return unique
+
+
+# Chu kỳ bán rã (giờ) của thống kê strategy: kết quả cũ giảm dần trọng số để thích nghi khi site thay đổi
+STRATEGY_STATS_HALF_LIFE_HOURS = 72
+
+
+def _strategy_stats_path():
+    state_dir = get_user_state_dir()
+    return os.path.join(state_dir, 'strategy_stats.json') if state_dir else None
+
+
+def _decayed(entry, now):
+    """Số lần thành công/thất bại của một strategy sau khi áp dụng suy giảm theo thời gian"""
+    age_hours = max(0.0, now - entry.get('updated_at', now)) / 3600
+    factor = 0.5 ** (age_hours / STRATEGY_STATS_HALF_LIFE_HOURS)
+    return entry.get('success', 0.0) * factor, entry.get('failure', 0.0) * factor
+
+
+def record_strategy_result(platform, strategy, success, latency=None):
+    """
+    Ghi kết quả một lần thử strategy (state/strategy_stats.json):
+    số lần thành công/thất bại (có suy giảm theo thời gian) và độ trễ trung bình (EWMA) của các lần thành công.
+    """
+    path = _strategy_stats_path()
+    if not path:
+        return
+    try:
+        with file_lock(path + '.lock', timeout=10):
+            stats = load_json_file(path, {})
+            entry = stats.setdefault(platform, {}).setdefault(strategy, {})
+            now = time.time()
+            succ, fail = _decayed(entry, now)
+            if success:
+                succ += 1
+                if latency is not None:
+                    prev = entry.get('latency')
+                    entry['latency'] = latency if prev is None else 0.7 * prev + 0.3 * latency
+            else:
+                fail += 1
+            entry.update(success=succ, failure=fail, updated_at=now)
+            save_json_file(path, stats)
+    except (OSError, TimeoutError) as e:
+        print(f"WARNING: Không ghi được thống kê strategy: {e}")
+
+
+def _strategy_rank(entry, now):
+    """Khóa sắp xếp: tỉ lệ thành công gần đây (có prior 1/2) giảm dần, sau đó độ trễ tăng dần"""
+    if not entry:
+        return (-0.5, float('inf'))
+    succ, fail = _decayed(entry, now)
+    rate = (succ + 1) / (succ + fail + 2)
+    latency = entry.get('latency')
+    return (-rate, latency if latency is not None else float('inf'))
+
+
+def order_strategies(platform, names):
+    """
+    Sắp xếp các strategy của platform theo thống kê gần đây. Sort ổn định: strategy chưa có dữ liệu
+    hoặc ngang điểm giữ nguyên thứ tự mặc định.
+    """
+    path = _strategy_stats_path()
+    stats = load_json_file(path, {}).get(platform, {}) if path else {}
+    if not stats:
+        return list(names)
+    now = time.time()
+    return sorted(names, key=lambda name: _strategy_rank(stats.get(name), now))
+
+
+def order_browsers(platform, browsers):
+    """Thứ tự trình duyệt lấy cookies theo thống kê của strategy 'cookies:<browser>'"""
+    return [name.split(':', 1)[1] for name in order_strategies(platform, [f'cookies:{b}' for b in browsers])]
+
+
+def strategy_name_of(command):
+    """Tên strategy (theo nguồn cookies) của một lệnh yt-dlp, dùng khi ghi thống kê"""
+    if '--cookies-from-browser' in command:
+        return f"cookies:{command[command.index('--cookies-from-browser') + 1]}"
+    if '--cookies' in command:
+        return 'cookies-file'
+    return 'default'
+
+
+def print_strategy_report():
+    """In bảng thống kê strategy theo platform (--strategy-report)"""
+    path = _strategy_stats_path()
+    stats = load_json_file(path, {}) if path else {}
+    if not stats:
+        print("Chưa có thống kê strategy nào.")
+        return
+    now = time.time()
+    print(f"{'Platform':<10} {'Strategy':<22} {'OK':>6} {'Lỗi':>6} {'Tỉ lệ':>6} {'Độ trễ':>8}  Lần cuối")
+    for platform in sorted(stats):
+        names = order_strategies(platform, sorted(stats[platform]))
+        for name in names:
+            entry = stats[platform][name]
+            succ, fail = _decayed(entry, now)
+            rate = succ / (succ + fail) if succ + fail else 0.0
+            latency = f"{entry['latency']:.1f}s" if entry.get('latency') is not None else '-'
+            last = time.strftime('%Y-%m-%d %H:%M', time.localtime(entry.get('updated_at', now)))
+            print(f"{platform:<10} {name:<22} {succ:>6.1f} {fail:>6.1f} {rate:>6.0%} {latency:>8}  {last}")
+
+
+# Tự điều chỉnh --concurrent-fragments / --http-chunk-size theo (platform, host).
+# start: mức thử đầu tiên, ceiling: trần an toàn (TikTok/Douyin dễ bị 429 khi tải quá nhiều fragment song song),
+# chunk: --http-chunk-size cho các format tải qua HTTP thường (YouTube giới hạn tốc độ khi không chia nhỏ).
+FRAGMENT_LEVELS = (1, 2, 4, 8, 16)
+PLATFORM_TRANSFER_TUNING = {
+    'youtube': {'start': 8, 'ceiling': 16, 'chunk': '10M'},
+    'tiktok': {'start': 2, 'ceiling': 4, 'chunk': None},
+    'douyin': {'start': 2, 'ceiling': 4, 'chunk': None},
+}
+DEFAULT_TRANSFER_TUNING = {'start': 4, 'ceiling': 8, 'chunk': None}
+# Cứ sau số lần tải này thì thử mức cao hơn mức tốt nhất một lần (nếu còn dưới trần)
+TRANSFER_EXPLORE_EVERY = 10
+# Trần đã hạ do 429 được nâng lại một mức sau số lần tải liên tiếp không bị chặn này,
+# và hết hiệu lực hẳn nếu không bị chặn lại trong TRANSFER_CEILING_EXPIRE giây
+TRANSFER_CEILING_RECOVERY_RUNS = 5
+TRANSFER_CEILING_EXPIRE = 24 * 3600
+_SPEED_RE = re.compile(r'\bat\s+([\d.]+)\s*([KMGT]?)i?B/s')
+_SPEED_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+
+def _transfer_stats_path():
+    state_dir = get_user_state_dir()
+    return os.path.join(state_dir, 'transfer_tuning.json') if state_dir else None
+
+
+def record_transfer_speed(speed):
+    """Ghi một mẫu tốc độ (bytes/s) từ dòng tiến độ; chỉ giữ các mẫu đầu tiên của lần chạy"""
+    if speed and len(TRANSFER_SAMPLES) < TRANSFER_SAMPLES.maxlen:
+        TRANSFER_SAMPLES.append(float(speed))
+
+
+def record_transfer_speeds_from_line(line):
+    """Lấy tốc độ từ dòng [download] ... at 2.50MiB/s (một dòng có thể chứa nhiều lần cập nhật ngăn bởi \\r)"""
+    if len(TRANSFER_SAMPLES) >= TRANSFER_SAMPLES.maxlen or '/s' not in line:
+        return
+    for match in _SPEED_RE.finditer(line):
+        record_transfer_speed(float(match.group(1)) * _SPEED_UNITS[match.group(2)])
+
+
+def _rate_bytes(rate):
+    """Đổi giá trị --limit-rate (vd 500K, 2M, 1048576) sang bytes/s; None nếu không đọc được"""
+    match = re.fullmatch(r'([\d.]+)\s*([KMGT]?)i?B?', str(rate).strip().upper())
+    return int(float(match.group(1)) * _SPEED_UNITS[match.group(2)]) if match else None
+
+
+def median_transfer_speed():
+    """Trung vị các mẫu tốc độ (bytes/s) của lần chạy yt-dlp hiện tại, None nếu chưa có mẫu nào"""
+    speeds = sorted(TRANSFER_SAMPLES)
+    return speeds[len(speeds) // 2] if speeds else None
+
+
+def _transfer_key(platform, host):
+    """
+    Khóa thống kê theo (platform, host của URL trang). Không dùng host CDN của media: mức fragment phải chọn trước
+    khi extract (chưa biết URL media), và host CDN đổi theo từng lần (rr3---sn-....googlevideo.com, v16-webapp...)
+    nên thống kê theo đó không bao giờ tích lũy được; host trang đại diện cho cụm CDN của platform.
+    """
+    return f"{platform}|{host or '-'}"
+
+
+def _transfer_ceiling(entry, tuning):
+    """Trần fragment hiện tại của host: trần của platform, hoặc trần đã hạ do 429 nếu còn hiệu lực"""
+    if 'ceiling' in entry and time.time() - entry.get('throttled_at', 0) < TRANSFER_CEILING_EXPIRE:
+        return min(tuning['ceiling'], entry['ceiling'])
+    return tuning['ceiling']
+
+
+def choose_transfer_settings(platform, host):
+    """
+    Chọn (số fragment song song, http chunk size) cho (platform, host):
+    mức có thông lượng (EWMA) tốt nhất trong lịch sử, thỉnh thoảng thử mức kế tiếp cao hơn,
+    không vượt trần của platform và trần đã hạ xuống khi host trả 429.
+    """
+    tuning = PLATFORM_TRANSFER_TUNING.get(platform, DEFAULT_TRANSFER_TUNING)
+    path = _transfer_stats_path()
+    entry = (load_json_file(path, {}) if path else {}).get(_transfer_key(platform, host), {})
+    ceiling = _transfer_ceiling(entry, tuning)
+    levels = [level for level in FRAGMENT_LEVELS if level <= ceiling] or [1]
+    samples = {int(level): data for level, data in entry.get('levels', {}).items() if int(level) in levels}
+    if not samples:
+        return max(level for level in levels if level <= max(tuning['start'], levels[0])), tuning['chunk']
+    best = max(samples, key=lambda level: samples[level]['throughput'])
+    higher = [level for level in levels if level > best]
+    if higher and (higher[0] not in samples or entry.get('runs', 0) % TRANSFER_EXPLORE_EVERY == 0):
+        return higher[0], tuning['chunk']
+    lower = [level for level in levels if level < best]
+    if lower and lower[-1] not in samples:
+        return lower[-1], tuning['chunk']
+    return best, tuning['chunk']
+
+
+def record_transfer_result(platform, host, fragments, throttled):
+    """
+    Ghi thông lượng đo được (trung vị các mẫu đầu tiên) cho mức fragment đã dùng.
+    Gặp 429 thì hạ trần của host xuống mức thấp hơn để các lần sau không bị chặn nữa; sau
+    TRANSFER_CEILING_RECOVERY_RUNS lần tải không bị chặn thì trần được nâng lại từng mức.
+    """
+    path = _transfer_stats_path()
+    throughput = median_transfer_speed()
+    TRANSFER_SAMPLES.clear()
+    if not path or (not throughput and not throttled):
+        return
+    try:
+        with file_lock(path + '.lock', timeout=10):
+            stats = load_json_file(path, {})
+            entry = stats.setdefault(_transfer_key(platform, host), {})
+            entry['runs'] = entry.get('runs', 0) + 1
+            tuning = PLATFORM_TRANSFER_TUNING.get(platform, DEFAULT_TRANSFER_TUNING)
+            if throttled:
+                lower = [level for level in FRAGMENT_LEVELS if level < fragments]
+                entry['ceiling'] = lower[-1] if lower else 1
+                entry['throttled_at'] = time.time()
+                entry['clean_runs'] = 0
+                entry.get('levels', {}).pop(str(fragments), None)
+                print(f"STATUS: Host bị giới hạn (429): hạ trần fragment song song xuống {entry['ceiling']}.")
+            elif 'ceiling' in entry:
+                # Không bị chặn: sau vài lần liên tiếp thì nâng trần lại một mức (hoặc bỏ hẳn khi đã hết hạn)
+                entry['clean_runs'] = entry.get('clean_runs', 0) + 1
+                ceiling = _transfer_ceiling(entry, tuning)
+                higher = [level for level in FRAGMENT_LEVELS if ceiling < level <= tuning['ceiling']]
+                if not higher:
+                    entry.pop('ceiling')
+                    entry.pop('clean_runs', None)
+                elif entry['clean_runs'] >= TRANSFER_CEILING_RECOVERY_RUNS:
+                    entry['ceiling'] = higher[0]
+                    entry['clean_runs'] = 0
+            if not throttled and throughput:
+                level = entry.setdefault('levels', {}).setdefault(str(fragments), {})
+                prev = level.get('throughput')
+                level['throughput'] = throughput if prev is None else 0.7 * prev + 0.3 * throughput
+                level['count'] = level.get('count', 0) + 1
+            entry['updated_at'] = time.time()
+            save_json_file(path, stats)
+    except (OSError, TimeoutError) as e:
+        print(f"WARNING: Không ghi được thống kê tốc độ tải: {e}")
+
+
+# Giới hạn request theo host, dùng chung giữa mọi job/worker đang chạy (state/host_limits.json, khóa bằng file_lock).
+# Token bucket: mỗi lần chạy yt-dlp tới host (extract -J, race, tải, luồng song song...) lấy một token;
+# một job thường dùng hai token (extract + tải). rate = số token hồi lại mỗi giây, burst = sức chứa.
+# rate tăng dần khi tải thành công và giảm một nửa khi host trả 429 (AIMD) để giữ quanh mức host chịu được;
+# throttle_403: platform trả 403 khi bị giới hạn (không phải lỗi quyền truy cập).
+HOST_RATE_LIMITS = {
+    'youtube': {'rate': 2.0, 'burst': 6, 'throttle_403': False},
+    'tiktok': {'rate': 1.0, 'burst': 4, 'throttle_403': True},
+    'douyin': {'rate': 1.0, 'burst': 4, 'throttle_403': True},
+}
+DEFAULT_HOST_RATE_LIMIT = {'rate': 1.0, 'burst': 4, 'throttle_403': False}
+# rate không giảm dưới tỉ lệ này của mức mặc định; mỗi lần thành công tăng thêm HOST_RATE_STEP * mức mặc định
+HOST_MIN_RATE_FACTOR = 0.05
+HOST_RATE_STEP = 0.1
+# Backoff lũy thừa (giây) sau mỗi lần bị chặn liên tiếp, có jitter để các job không cùng quay lại một lúc
+HOST_BACKOFF_BASE = 5.0
+HOST_BACKOFF_MAX = 600.0
+# Trần --sleep-requests (giây) và băng thông tối thiểu (bytes/s) khi host đang bị hạ budget
+HOST_MAX_SLEEP_REQUESTS = 5.0
+HOST_MIN_BANDWIDTH = 64 * 1024
+# Không bị chặn lại trong khoảng này (giây) thì bỏ trần băng thông của host
+HOST_BANDWIDTH_RECOVERY = 3600
+# Host không có job nào trong khoảng này (giây) thì trạng thái được đặt lại về mặc định
+HOST_STATE_IDLE_RESET = 6 * 3600
+
+
+def _host_limits_path():
+    state_dir = get_user_state_dir()
+    return os.path.join(state_dir, 'host_limits.json') if state_dir else None
+
+
+def _host_entry(stats, platform, host, limits, now):
+    """Trạng thái token bucket của host (tạo mới hoặc đặt lại nếu lâu không dùng), đã hồi token tới thời điểm now"""
+    key = _transfer_key(platform, host)
+    entry = stats.get(key)
+    if not entry or now - entry.get('updated_at', 0) > HOST_STATE_IDLE_RESET:
+        entry = stats[key] = {'rate': limits['rate'], 'tokens': float(limits['burst']), 'strikes': 0,
+                              'updated_at': now}
+    entry['tokens'] = min(float(limits['burst']),
+                          entry['tokens'] + max(0.0, now - entry['updated_at']) * entry['rate'])
+    entry['updated_at'] = now
+    return entry
+
+
+def acquire_host_budget(platform, host, cost=1):
+    """
+    Lấy cost token của host trước khi chạy yt-dlp; chờ nếu host đang trong thời gian backoff hoặc hết token
+    (cost=0: chỉ chờ hết backoff và đọc budget, không chạy yt-dlp ngay).
+    Trả về budget hiện tại của host: sleep_requests (giây giữa các request khi extract),
+    limit_rate (bytes/s hoặc None) và acquired_at (để report_host_result nhận ra lần bị chặn đã được ghi).
+    """
+    path = _host_limits_path()
+    limits = HOST_RATE_LIMITS.get(platform, DEFAULT_HOST_RATE_LIMIT)
+    budget = {'sleep_requests': 0.0, 'limit_rate': None, 'acquired_at': time.time()}
+    if not path or not host:
+        return budget
+    started = time.time()
+    announced = False
+    while True:
+        try:
+            with file_lock(path + '.lock', timeout=10):
+                stats = load_json_file(path, {})
+                now = time.time()
+                entry = _host_entry(stats, platform, host, limits, now)
+                backoff = max(0.0, entry.get('backoff_until', 0) - now)
+                granted = not backoff and entry['tokens'] >= cost
+                if granted:
+                    entry['tokens'] -= cost
+                save_json_file(path, stats)
+        except (OSError, TimeoutError) as e:
+            print(f"WARNING: Không đọc được giới hạn request của host: {e}")
+            return budget
+        if granted:
+            if entry['rate'] < limits['rate']:
+                budget['sleep_requests'] = round(
+                    min(HOST_MAX_SLEEP_REQUESTS, 1.0 / entry['rate'] - 1.0 / limits['rate']), 2)
+            budget['limit_rate'] = entry.get('bandwidth')
+            budget['acquired_at'] = now
+            break
+        wait = backoff or (cost - entry['tokens']) / entry['rate']
+        if not announced and wait >= 1:
+            reason = "đang tạm dừng vì bị giới hạn (429)" if backoff else "đã dùng hết lượt request"
+            print(f"STATUS: Host {host} {reason}, chờ {wait:.0f}s...", flush=True)
+            announced = True
+        # Jitter nhỏ để các job cùng chờ không gửi request đồng thời khi hết backoff
+        time.sleep(min(wait, 30.0) + random.uniform(0, 0.5))
+    if time.time() - started >= 0.1:
+        PHASES.record('host_wait', started, time.time(), host=host)
+    return budget
+
+
+def report_host_result(platform, host, budget, throttled, speed=None):
+    """
+    Cập nhật budget của host sau một lần chạy yt-dlp. Bị chặn (429, hoặc 403 với throttle_403): giảm một nửa rate,
+    hạ trần băng thông xuống dưới tốc độ vừa đo được và đặt backoff lũy thừa có jitter cho mọi job tới host.
+    Lần bị chặn mà job khác đã ghi nhận sau khi job này lấy token thì không tính thêm (tránh hạ budget nhiều lần).
+    Thành công: tăng dần rate về mức mặc định và nới trần băng thông.
+    """
+    path = _host_limits_path()
+    if not path or not host:
+        return
+    limits = HOST_RATE_LIMITS.get(platform, DEFAULT_HOST_RATE_LIMIT)
+    try:
+        with file_lock(path + '.lock', timeout=10):
+            stats = load_json_file(path, {})
+            now = time.time()
+            entry = _host_entry(stats, platform, host, limits, now)
+            if throttled and entry.get('last_throttle', 0) >= budget['acquired_at']:
+                print(f"STATUS: Host {host} đã được đánh dấu bị giới hạn, dùng chung thời gian chờ hiện tại.")
+            elif throttled:
+                entry['strikes'] = entry.get('strikes', 0) + 1
+                entry['rate'] = max(limits['rate'] * HOST_MIN_RATE_FACTOR, entry['rate'] / 2)
+                entry['tokens'] = 0.0
+                backoff = min(HOST_BACKOFF_MAX, HOST_BACKOFF_BASE * 2 ** (entry['strikes'] - 1))
+                backoff = random.uniform(backoff / 2, backoff)
+                entry['backoff_until'] = max(entry.get('backoff_until', 0), now + backoff)
+                entry['last_throttle'] = now
+                if speed:
+                    cap = max(HOST_MIN_BANDWIDTH, speed * 0.75)
+                    entry['bandwidth'] = int(min(entry.get('bandwidth') or cap, cap))
+                print(f"STATUS: Host {host} bị giới hạn (lần {entry['strikes']}): tạm dừng {backoff:.0f}s, "
+                      f"giảm còn {entry['rate']:.2f} lượt/giây.")
+            else:
+                entry['strikes'] = 0
+                entry['rate'] = min(limits['rate'], entry['rate'] + limits['rate'] * HOST_RATE_STEP)
+                if entry.get('bandwidth'):
+                    if now - entry.get('last_throttle', 0) > HOST_BANDWIDTH_RECOVERY:
+                        entry.pop('bandwidth')
+                    else:
+                        entry['bandwidth'] = int(entry['bandwidth'] * 1.25)
+            save_json_file(path, stats)
+    except (OSError, TimeoutError) as e:
+        print(f"WARNING: Không ghi được giới hạn request của host: {e}")
+
+
+def command_host(command):
+    """(platform, host) của URL trong lệnh yt-dlp (URL là tham số cuối)"""
+    url = command[-1] if command else ''
+    return detect_platform(url), urllib.parse.urlparse(url).hostname
+
+
+def is_host_throttled(platform, classifier):
+    """Lần chạy bị host giới hạn: 429, hoặc 403 với platform có throttle_403"""
+    return classifier.has('rate_limited') or (
+        classifier.has('forbidden') and HOST_RATE_LIMITS.get(platform, DEFAULT_HOST_RATE_LIMIT)['throttle_403'])
+
+
+def report_host_throttle(platform, host, budget, output):
+    """
+    Các lần chạy phụ tới host (extract -J, race, luồng tải song song, thumbnail, batch): chỉ báo khi bị giới hạn;
+    tăng budget khi thành công chỉ tính ở lần tải chính (_run_strategy). output: ErrorClassifier hoặc log (chuỗi).
+    """
+    if isinstance(output, str):
+        classifier = ErrorClassifier()
+        for line in output.splitlines():
+            classifier.feed(line.strip())
+        output = classifier
+    if is_host_throttled(platform, output):
+        report_host_result(platform, host, budget, True)
+
+
+def race_strategies(platform, strategies, env, max_workers=3, timeout=60):
+    """
+    Chạy song song bước extract (yt-dlp -J) của các strategy, tối đa max_workers tiến trình cùng lúc.
+    Strategy đầu tiên lấy được danh sách format sẽ thắng; các tiến trình còn lại bị dừng ngay.
+    Strategy được xếp theo thống kê gần đây của platform (order_strategies) và kết quả được ghi lại.
+    Info JSON của strategy thắng được lưu vào cache để bước tải dùng --load-info-json (không extract lại).
+    Trả về (tên, lệnh) của strategy thắng, hoặc None nếu tất cả đều thất bại.
+    """
+    by_name = dict(strategies)
+    ordered = [(name, by_name[name]) for name in order_strategies(platform, [name for name, _ in strategies])]
+
+    print(f"STATUS: Chế độ race: thử song song {len(ordered)} cấu hình "
+          f"({', '.join(name for name, _ in ordered)}), tối đa {max_workers} cùng lúc...", flush=True)
+
+    done = threading.Event()
+    lock = threading.Lock()
+    running = {}
+    result = {}
+
+    def probe(name, cmd):
+        if done.is_set():
+            return name, 'cancelled', 0.0, None
+        budget = acquire_host_budget(*command_host(cmd))
+        if done.is_set():
+            return name, 'cancelled', 0.0, None
+        probe_cmd = _insert_before_url(cmd, '--dump-single-json', '--no-progress')
+        started = time.time()
+        proc = subprocess.Popen(
+            probe_cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+            encoding='utf-8',
+            errors='replace',
+            creationflags=CREATE_NO_WINDOW,
+            env=env
+        )
+        with lock:
+            JOB_STATS['extractions'] += 1
+            running[name] = proc
+            if done.is_set():
+                proc.kill()
+        try:
+            out, err = proc.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.communicate()
+            return name, 'timeout', time.time() - started, None
+        finally:
+            with lock:
+                running.pop(name, None)
+        elapsed = time.time() - started
+        if done.is_set() and name != result.get('name'):
+            return name, 'cancelled', elapsed, None
+
+        info = None
+        if proc.returncode == 0 and out.strip():
+            try:
+                info = json.loads(out)
+            except ValueError:
+                info = None
+        if info and (info.get('formats') or info.get('url') or info.get('requested_formats')):
+            with lock:
+                if not done.is_set():
+                    done.set()
+                    result.update(name=name, command=cmd, info_text=out.strip())
+                    for other in running.values():
+                        other.kill()
+                    return name, 'won', elapsed, None
+            return name, 'cancelled', elapsed, None
+
+        report_host_throttle(*command_host(cmd), budget, err or '')
+        errors = [ln.strip() for ln in (err or '').splitlines() if ln.strip().startswith('ERROR')]
+        return name, 'failed', elapsed, errors[-1] if errors else None
+
+    status_text = {'won': 'THẮNG', 'failed': 'thất bại', 'timeout': 'quá thời gian', 'cancelled': 'đã hủy'}
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        futures = [executor.submit(probe, name, cmd) for name, cmd in ordered]
+        for future in as_completed(futures):
+            name, status, elapsed, error = future.result()
+            if status in ('won', 'failed', 'timeout'):
+                record_strategy_result(platform, name, status == 'won', elapsed)
+            print(f"STATUS: [race] {name}: {status_text[status]} ({elapsed:.1f}s)", flush=True)
+            if error:
+                print(f"   {error}", flush=True)
+
+    if not result:
+        print("WARNING: Không cấu hình nào trong chế độ race lấy được format. Chuyển sang cách thử tuần tự.", flush=True)
+        return None
+
+    try:
+        store_cached_info(result['command'], result['info_text'])
+    except OSError as e:
+        print(f"WARNING: Không lưu được metadata của strategy thắng: {e}")
+    print(f"STATUS: Strategy thắng: {result['name']} — chỉ tải một lần với cấu hình này.", flush=True)
+    return result['name'], result['command']
+
+
+# Format plan: lấy danh sách format một lần cho mỗi video, chọn sẵn format ID theo --quality/--audio-lang
+# và lưu lại (state/format_plans.json) tới khi URL đã ký hết hạn, để các lần fallback/tải lại không phải chọn lại.
+FORMAT_PLAN_MAX_AGE = 6 * 3600
+
+
+def parse_quality(quality, download_format):
+    """'best' / '1080p' / '720' / 'audio' -> ('video', trần chiều cao hoặc None) hoặc ('audio', None)"""
+    value = (quality or '').strip().lower()
+    if download_format.lower() == 'mp3' or value in ('audio', 'bestaudio'):
+        return 'audio', None
+    match = re.match(r'(\d{3,4})p?$', value)
+    return 'video', int(match.group(1)) if match else None
+
+
+def _format_plans_path():
+    state_dir = get_user_state_dir()
+    return os.path.join(state_dir, 'format_plans.json') if state_dir else None
+
+
+def _usable_format(f):
+    return bool(f.get('format_id')) and not f.get('has_drm') and f.get('protocol') != 'mhtml' and f.get('ext') != 'mhtml'
+
+
+def _lang_matches(f, audio_lang):
+    return bool(audio_lang) and (f.get('language') or '').lower().split('-')[0] == audio_lang.split('-')[0]
+
+
+def _format_label(f):
+    parts = []
+    if f.get('vcodec') != 'none' and f.get('height'):
+        parts.append(f"{f['height']}p")
+    for codec in (f.get('vcodec'), f.get('acodec')):
+        if codec and codec != 'none':
+            parts.append(codec.split('.')[0])
+    if f.get('vcodec') == 'none' and f.get('abr'):
+        parts.append(f"{f['abr']:.0f}k")
+    if f.get('language'):
+        parts.append(f['language'])
+    return f"{f['format_id']} ({', '.join(parts) or f.get('ext') or '?'})"
+
+
+def _formats_size(*formats):
+    """Tổng filesize (hoặc filesize_approx) của các format, None nếu có format không rõ kích thước"""
+    sizes = [f.get('filesize') or f.get('filesize_approx') for f in formats]
+    return int(sum(sizes)) if all(sizes) else None
+
+
+def resolve_format_plan(info, mode, height_cap, audio_lang):
+    """
+    Chọn format ID cụ thể từ info dict: video (không vượt trần chiều cao nếu có) + audio (ưu tiên đúng ngôn ngữ,
+    rồi audio gốc), hoặc một format có sẵn cả hình lẫn tiếng nếu tốt hơn. Trả về None nếu không chọn được.
+    """
+    formats = [f for f in info.get('formats') or [] if _usable_format(f)]
+    audios = [f for f in formats if f.get('vcodec') == 'none' and f.get('acodec') not in (None, 'none')]
+    videos = [f for f in formats if f.get('acodec') == 'none' and f.get('vcodec') not in (None, 'none')]
+    combined = [f for f in formats if f.get('vcodec') != 'none' and f.get('acodec') != 'none']
+
+    def audio_rank(f):
+        return (_lang_matches(f, audio_lang), f.get('language_preference') or 0,
+                f.get('abr') or f.get('tbr') or 0, f.get('asr') or 0)
+
+    def video_rank(f):
+        height = f.get('height') or 0
+        within = height_cap is None or height <= height_cap
+        # Trong trần: càng cao càng tốt; vượt trần (không còn lựa chọn nào khác): càng thấp càng tốt
+        return (within, height if within else -height, f.get('fps') or 0, f.get('tbr') or 0)
+
+    if mode == 'audio':
+        best = max(audios or combined, key=audio_rank, default=None)
+        if not best:
+            return None
+        return {'format': best['format_id'], 'summary': _format_label(best), 'size': _formats_size(best)}
+
+    best_combined = max(combined, key=lambda f: (_lang_matches(f, audio_lang),) + video_rank(f), default=None)
+    best_video = max(videos, key=video_rank, default=None)
+    best_audio = max(audios, key=audio_rank, default=None)
+    if best_video and best_audio and (not best_combined or video_rank(best_video) >= video_rank(best_combined)):
+        return {'format': f"{best_video['format_id']}+{best_audio['format_id']}",
+                'summary': f"{_format_label(best_video)} + {_format_label(best_audio)}",
+                'size': _formats_size(best_video, best_audio)}
+    if best_combined:
+        return {'format': best_combined['format_id'], 'summary': _format_label(best_combined),
+                'size': _formats_size(best_combined)}
+    return None
+
+
+def fetch_format_info(command, env, timeout=120):
+    """
+    Info dict của video cho lệnh này: dùng info JSON đã cache nếu còn hạn, nếu không thì extract một lần (-J)
+    và lưu vào cache để bước tải ngay sau đó dùng --load-info-json (không extract lại). None nếu thất bại.
+    """
+    cached_path = find_cached_info(command)
+    if cached_path:
+        try:
+            with open(cached_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            pass
+    JOB_STATS['extractions'] += 1
+    budget = acquire_host_budget(*command_host(command))
     try:
-        update_process = subprocess.Popen(
-            [yt_dlp_exe_path, "-U"],
+        proc = subprocess.run(
+            _insert_before_url(command, '--dump-single-json', '--no-progress'),
             stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
+            stderr=subprocess.PIPE,
             text=True,
             encoding='utf-8',
             errors='replace',
-            creationflags=subprocess.CREATE_NO_WINDOW
+            creationflags=CREATE_NO_WINDOW,
+            env=env,
+            timeout=timeout
         )
-        output_lines = []
-        for line in iter(update_process.stdout.readline, ''):
-            line = line.strip()
-            if line:
-                print(line, flush=True)
-                output_lines.append(line)
-        update_process.wait()
-        
-        if update_process.returncode == 0:
-            print("STATUS: yt-dlp đã được cập nhật thành công tại vị trí gốc.")
-            return yt_dlp_exe_path
-        else:
-            # Kiểm tra xem có phải lỗi quyền không
-            output_text = '\n'.join(output_lines)
-            if 'administrator' in output_text.lower() or 'permission' in output_text.lower():
-                print("WARNING: Không có quyền cập nhật tại vị trí gốc. Đang thử tải về thư mục người dùng...")
-            else:
-                print(f"WARNING: Cập nhật thất bại với mã lỗi {update_process.returncode}. Đang thử tải về thư mục người dùng...")
-    except Exception as e:
-        print(f"WARNING: Lỗi khi cố gắng cập nhật yt-dlp: {e}. Đang thử tải về thư mục người dùng...")
-    
-    # Nếu cập nhật thất bại, thử tải về AppData
-    user_ytdlp_path = get_user_ytdlp_path()
-    if user_ytdlp_path and download_latest_ytdlp(user_ytdlp_path):
-        print("STATUS: Đã tải phiên bản mới nhất của yt-dlp vào thư mục người dùng.")
-        return user_ytdlp_path
-    else:
-        print("WARNING: Không thể cập nhật yt-dlp. Sẽ sử dụng phiên bản hiện có.")
-        return yt_dlp_exe_path
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    if proc.returncode != 0 or not proc.stdout.strip():
+        report_host_throttle(*command_host(command), budget, proc.stderr or '')
+        return None
+    try:
+        info = json.loads(proc.stdout)
+    except ValueError:
+        return None
+    try:
+        store_cached_info(command, proc.stdout.strip())
+    except OSError as e:
+        print(f"WARNING: Không lưu được metadata vào cache: {e}")
+    return info
+
+
+def get_format_plan(command, env, plan_key, mode, height_cap, audio_lang):
+    """
+    Format plan cho video (plan_key): dùng lại plan đã lưu nếu còn hạn, nếu không thì lấy danh sách format
+    (fetch_format_info) và chọn format. Plan hết hạn sớm hơn thời điểm hết hạn của URL đã ký.
+    """
+    path = _format_plans_path()
+    now = time.time()
+    plan = (load_json_file(path, {}) if path else {}).get(plan_key)
+    if plan and plan.get('expires_at', 0) > now:
+        plan['cached'] = True
+        return plan
+
+    info = fetch_format_info(command, env)
+    plan = resolve_format_plan(info, mode, height_cap, audio_lang) if info else None
+    if not plan:
+        return None
+    expiry = signed_url_expiry(json.dumps(info.get('formats') or []))
+    plan.update(expires_at=min(now + FORMAT_PLAN_MAX_AGE, (expiry or float('inf')) - SIGNED_URL_EXPIRY_MARGIN),
+                video_id=info.get('id'), cached=False)
+    if path and plan['expires_at'] > now:
+        try:
+            with file_lock(path + '.lock', timeout=10):
+                plans = {key: value for key, value in load_json_file(path, {}).items()
+                         if value.get('expires_at', 0) > now}
+                plans[plan_key] = {key: value for key, value in plan.items() if key != 'cached'}
+                save_json_file(path, plans)
+        except (OSError, TimeoutError) as e:
+            print(f"WARNING: Không lưu được format plan: {e}")
+    return plan
+
 
 def normalize_douyin_url(url: str) -> str:
     """
@@ -220,7 +2975,88 @@ def detect_platform(url: str) -> str:
     return 'generic'
 
 
-def main(url, save_path, resources_path, cookies_path, quality, thumbnail, no_playlist, download_format, audio_lang):
+def main(url, save_path, resources_path, cookies_path, quality, thumbnail, no_playlist, download_format, audio_lang,
+         update_ttl=DEFAULT_UPDATE_TTL_HOURS, force_update=False, rediscover=False, engine='exe',
+         metadata_ttl=DEFAULT_METADATA_TTL_MINUTES, race=False, race_workers=3, race_timeout=60, limit_rate=None,
+         resume=False, use_archive=True, concurrent_fragments='auto', parallel_streams=True,
+         defer_postprocess=False, cookie_jar_ttl=DEFAULT_COOKIE_JAR_TTL_MINUTES, batch_urls=None, scratch_dir=None):
+    JOB_STATS.update(extractions=0, info_reuses=0, archive_skips=0, duplicates=0)
+    PHASES.reset()
+    POSTPROCESS.update(defer=False, mp3=False, archive_id=None, specs=[])
+    METADATA_CACHE['ttl'] = max(0, metadata_ttl) * 60
+    COOKIE_JARS['ttl'] = max(0, cookie_jar_ttl) * 60
+    # yt-dlp ghi đường dẫn cuối cùng của từng file đã tải vào đây (để cập nhật chỉ mục nội dung)
+    state_dir = get_user_state_dir()
+    files_list_path = os.path.join(state_dir, f"downloaded-{os.getpid()}-{time.time_ns()}.txt") if state_dir else None
+    stage_dir = None
+    if scratch_dir:
+        try:
+            stage_dir = prepare_stage_dir(scratch_dir, f"{os.path.abspath(save_path)}|{url}")
+        except OSError as e:
+            print(f"WARNING: Không dùng được thư mục tạm {scratch_dir} ({e}), tải thẳng vào thư mục lưu.", flush=True)
+    started = time.time()
+    exit_code = 1
+    try:
+        exit_code = _main(url, save_path, resources_path, cookies_path, quality, thumbnail, no_playlist,
+                          download_format, audio_lang, update_ttl, force_update, rediscover, engine,
+                          race, race_workers, race_timeout, limit_rate, resume,
+                          get_download_archive_path() if use_archive else None, files_list_path,
+                          concurrent_fragments, parallel_streams, defer_postprocess, batch_urls, stage_dir)
+        if stage_dir and exit_code == 0 and os.path.isdir(stage_dir):
+            try:
+                finalize_staged_outputs(stage_dir, save_path, files_list_path)
+            except OSError as e:
+                print(f"ERROR: Không chuyển được file từ thư mục tạm vào {save_path}: {e}")
+                emit_event('error', error_class='disk', message=str(e))
+                exit_code = 1
+        elif stage_dir:
+            remove_stage_dir_if_done(stage_dir)
+        return exit_code
+    finally:
+        paths = []
+        if files_list_path and os.path.exists(files_list_path):
+            try:
+                with open(files_list_path, 'r', encoding='utf-8') as f:
+                    paths = [ln.strip() for ln in f if ln.strip()]
+                os.remove(files_list_path)
+            except OSError:
+                pass
+        try:
+            if POSTPROCESS['defer'] and exit_code == 0:
+                emit_deferred_postprocess(paths, thumbnail, detect_platform(url), save_path if stage_dir else None)
+            elif paths:
+                if thumbnail:
+                    # Đổi thumbnail sang jpg ở pool nền, song song với việc băm file cho chỉ mục nội dung
+                    for path in paths:
+                        base = os.path.splitext(path)[0]
+                        for ext in ('.webp', '.png'):
+                            if os.path.exists(base + ext):
+                                queue_thumbnail_conversion(base + ext, resources_path)
+                record_downloaded_files(paths, detect_platform(url))
+        except (OSError, TimeoutError) as e:
+            print(f"WARNING: Không cập nhật được chỉ mục nội dung: {e}")
+        wait_thumbnail_conversions()
+        print(f"STATUS: Số lần extract metadata trong job: {JOB_STATS['extractions']} "
+              f"(dùng lại metadata đã cache: {JOB_STATS['info_reuses']})", flush=True)
+        if JOB_STATS['archive_skips'] or JOB_STATS['duplicates']:
+            print(f"STATUS: Bỏ qua {JOB_STATS['archive_skips']} video đã tải trước đó (download archive), "
+                  f"phát hiện {JOB_STATS['duplicates']} file trùng nội dung", flush=True)
+        # Dung lượng đã tải: file cuối cùng và các phần còn chờ merge ở pool hậu xử lý
+        downloaded_bytes = 0
+        for path in set(paths).union(*(spec['inputs'] for spec in POSTPROCESS['specs'])):
+            try:
+                downloaded_bytes += os.path.getsize(path)
+            except OSError:
+                pass
+        PHASES.print_summary(exit_code=exit_code, platform=detect_platform(url), bytes=downloaded_bytes)
+        emit_event('result', exit_code=exit_code, duration=round(time.time() - started, 3), **JOB_STATS)
+
+
+def _main(url, save_path, resources_path, cookies_path, quality, thumbnail, no_playlist, download_format, audio_lang,
+          update_ttl, force_update, rediscover, engine, race, race_workers, race_timeout, limit_rate,
+          resume, archive_path, files_list_path, concurrent_fragments, parallel_streams, defer_postprocess,
+          batch_urls=None, stage_dir=None):
+    emit_event('phase', phase='prepare')
     print(f"Bắt đầu quá trình tải...")
     print(f"STATUS: Bắt đầu xử lý URL: {url}")
     print(f"STATUS: Sẽ lưu file vào: {save_path}")
@@ -241,27 +3077,67 @@ def main(url, save_path, resources_path, cookies_path, quality, thumbnail, no_pl
             sanitized_url = normalized
             print(f"STATUS: Đã chuyển URL Douyin sang dạng video: {sanitized_url}")
 
+    # Video đơn lẻ đã có trong download archive: bỏ qua luôn, không cần cập nhật yt-dlp hay gọi mạng
+    archive_id = archive_id_from_url(sanitized_url) if archive_path else None
+    if (archive_id and not batch_urls and (no_playlist or 'list=' not in sanitized_url)
+            and is_in_download_archive(archive_id)):
+        JOB_STATS['archive_skips'] += 1
+        print(f"STATUS: Video đã được tải trước đó ({archive_id}), bỏ qua theo download archive.")
+        print("SUCCESS: Video đã có sẵn, không cần tải lại.")
+        return 0
+
+    video_key = archive_id_from_url(sanitized_url)
+    # Nhóm URL của chế độ batch được tải như một lần chạy yt-dlp thông thường (không format plan, không tách hậu xử lý)
+    single_video = bool(no_playlist or (video_key and 'list=' not in sanitized_url)) and not batch_urls
+    # Hậu xử lý tách riêng chỉ áp dụng cho video đơn lẻ (playlist/kênh đã được app tách thành từng video)
+    POSTPROCESS['defer'] = bool(defer_postprocess and single_video)
+    POSTPROCESS['mp3'] = POSTPROCESS['defer'] and download_format.lower() == 'mp3'
+
     yt_dlp_exe_path = os.path.abspath(os.path.join(resources_path, 'yt-dlp.exe'))
     
     if not os.path.exists(yt_dlp_exe_path):
         print("ERROR: Thiếu file thực thi yt-dlp.exe.")
         return 1
 
-    # Cập nhật yt-dlp (thử cập nhật tại chỗ, nếu thất bại thì tải về AppData)
-    yt_dlp_exe_path = update_ytdlp(yt_dlp_exe_path)
+    # Cập nhật yt-dlp (thử cập nhật tại chỗ, nếu thất bại thì tải về AppData).
+    # Kết quả được cache theo TTL để các job liên tiếp không phải chạy `yt-dlp -U` mỗi lần.
+    with PHASES.phase('update'):
+        yt_dlp_exe_path = update_ytdlp_cached(yt_dlp_exe_path, update_ttl, force_update)
 
     # Giới hạn độ dài tên file (tăng lên 200 ký tự) và loại bỏ các ký tự không hợp lệ trên Windows
     # Sử dụng .200s để giữ được tên dài hơn, và yt-dlp sẽ tự động xử lý các ký tự không hợp lệ
     # %(id)s là ID video YouTube (ví dụ: VrSQdgJU3fY) - giúp tránh trùng tên khi nhiều video có cùng tiêu đề
-    output_template = os.path.join(save_path, '%(title).200s.%(ext)s')
+    output_template = os.path.join(save_path, '%(title).200s [%(id)s].%(ext)s')
+    if stage_dir:
+        # Staging: tên file tương đối để --paths home:/temp: có hiệu lực (file hoàn chỉnh chuyển vào save_path sau)
+        output_template = '%(title).200s [%(id)s].%(ext)s'
+        print(f"STATUS: Dùng thư mục tạm (staging): {stage_dir}")
 
     # Chuẩn hóa mã ngôn ngữ audio (ví dụ: 'auto', 'ja', 'ko', 'en')
     audio_lang = (audio_lang or '').strip().lower()
     if audio_lang == '' or audio_lang == 'auto':
         audio_lang = None
 
-    # Kiểm tra và sử dụng JS runtime (ưu tiên Deno, sau đó Node)
-    js_runtime_type, js_runtime_path, js_prepend = ensure_js_runtime()
+    # Chất lượng người dùng chọn: best / 1080p / 720p / audio (mp3 luôn là audio)
+    quality_mode, height_cap = parse_quality(quality, download_format)
+    print(f"STATUS: Chất lượng yêu cầu: {'chỉ audio' if quality_mode == 'audio' else f'tối đa {height_cap}p' if height_cap else 'tốt nhất'}")
+
+    # Kiểm tra và sử dụng JS runtime (ưu tiên Deno, sau đó Node), ffmpeg và profile trình duyệt.
+    # Kết quả được cache theo PATH/LOCALAPPDATA/mtime nên lần chạy sau không cần spawn `deno --version`.
+    with PHASES.phase('runtime'):
+        runtime = discover_runtime(resources_path, force=rediscover)
+    js_runtime_type = runtime['js_runtime_type']
+    js_runtime_path = runtime['js_runtime_path']
+    js_prepend = runtime['js_prepend']
+    ffmpeg_location = runtime['ffmpeg_location']
+    browser_sources = runtime['browser_cookie_sources']
+
+    if engine == 'python':
+        if _import_yt_dlp() is not None:
+            print("STATUS: Dùng engine yt-dlp trong tiến trình (thư viện yt_dlp), yt-dlp.exe làm dự phòng.")
+        else:
+            print("WARNING: Không import được thư viện yt_dlp. Dùng yt-dlp.exe.")
+            engine = 'exe'
     
     if js_runtime_type == 'deno':
         print(f"STATUS: Đã sẵn sàng JS runtime: Deno ({js_runtime_path})")
@@ -277,8 +3153,6 @@ def main(url, save_path, resources_path, cookies_path, quality, thumbnail, no_pl
         '--no-update',  # Tắt cảnh báo cập nhật để tránh spam log
         # Ép sử dụng downloader nội bộ của yt-dlp (tránh dùng curl/wget bên ngoài nếu có cấu hình global)
         '--downloader', 'native',
-        # Tăng tốc độ tải bằng cách tải xuống nhiều fragment cùng lúc
-        '--concurrent-fragments', '5',
         # Thêm các tùy chọn thử lại để tăng độ ổn định
         '--retries', '10',
         '--fragment-retries', '10',
@@ -286,6 +3160,44 @@ def main(url, save_path, resources_path, cookies_path, quality, thumbnail, no_pl
         '--remote-components', 'ejs:github',
     ]
 
+    # Tải nhiều fragment (HLS/DASH) cùng lúc: số fragment song song và chunk size được tự chọn theo
+    # lịch sử thông lượng của (platform, host), hoặc cố định nếu truyền --concurrent-fragments N
+    transfer_host = urllib.parse.urlparse(sanitized_url).hostname
+    if concurrent_fragments == 'auto':
+        fragments, chunk_size = choose_transfer_settings(platform, transfer_host)
+        print(f"STATUS: Tự chọn {fragments} fragment song song"
+              f"{f', http chunk {chunk_size}' if chunk_size else ''} cho {transfer_host}")
+    else:
+        fragments, chunk_size = int(concurrent_fragments), None
+    job_download_args = ['--concurrent-fragments', str(fragments)]
+    if chunk_size:
+        job_download_args.extend(['--http-chunk-size', chunk_size])
+    # Budget request của host dùng chung với các job khác: chờ nếu host đang bị giới hạn (429) hoặc hết lượt,
+    # giãn request khi extract và giới hạn băng thông theo mức host chịu được gần đây
+    host_budget = acquire_host_budget(platform, transfer_host, cost=0)
+    if host_budget['sleep_requests']:
+        job_download_args.extend(['--sleep-requests', str(host_budget['sleep_requests'])])
+    # Giới hạn băng thông do bộ lập lịch của app chia cho job này (khi tải nhiều link cùng lúc)
+    host_rate = host_budget['limit_rate']
+    if host_rate and (not limit_rate or host_rate < (_rate_bytes(limit_rate) or float('inf'))):
+        print(f"STATUS: Giới hạn tốc độ {host_rate // 1024}KB/s để tránh bị {transfer_host} chặn.")
+        limit_rate = str(host_rate)
+    if limit_rate:
+        job_download_args.extend(['--limit-rate', limit_rate])
+    # Job bị gián đoạn lần trước (app tắt/crash): tải tiếp từ file .part đã có
+    if resume:
+        print("STATUS: Tiếp tục tải từ lần trước (dùng lại file .part nếu có)...")
+        job_download_args.append('--continue')
+    # Archive dùng chung: yt-dlp bỏ qua các video (kể cả entry trong playlist/kênh) đã tải trước đó.
+    # MP3 hậu xử lý riêng: chỉ ghi archive khi đã chuyển sang mp3 xong (--run-postprocess)
+    if archive_path and not POSTPROCESS['mp3']:
+        job_download_args.extend(['--download-archive', archive_path])
+    if files_list_path:
+        job_download_args.extend(['--print-to-file', 'after_move:filepath', files_list_path])
+    if stage_dir:
+        job_download_args.extend(['--paths', f"home:{stage_dir}", '--paths', f"temp:{os.path.join(stage_dir, '.tmp')}"])
+    command.extend(job_download_args)
+
     # Chỉ thêm extractor-args của YouTube nếu URL là YouTube
     if platform == 'youtube':
         # Thử nhiều client để bypass SABR streaming và truy cập format chất lượng cao hơn
@@ -311,20 +3223,28 @@ def main(url, save_path, resources_path, cookies_path, quality, thumbnail, no_pl
         # yt-dlp sẽ tìm node trong PATH; nếu portable, chúng ta đã thêm PATH ở env
         command.extend(['--js-runtimes', 'node'])
 
-    if download_format.lower() == 'mp3':
-        # Ưu tiên audio gốc hoặc audio theo ngôn ngữ người dùng chọn (nếu có metadata language)
-        # Nếu có audio_lang, thử chọn bestaudio với language đó trước, rồi fallback về bestaudio/best
-        if audio_lang:
-            audio_format_selector = f"bestaudio[language={audio_lang}]/bestaudio/best"
-        else:
-            audio_format_selector = "bestaudio/best"
+    # Ưu tiên audio gốc hoặc audio theo ngôn ngữ người dùng chọn (nếu có metadata language)
+    # Nếu có audio_lang, thử chọn bestaudio với language đó trước, rồi fallback về bestaudio/best
+    if audio_lang:
+        audio_format_selector = f"bestaudio[language={audio_lang}]/bestaudio/best"
+    else:
+        audio_format_selector = "bestaudio/best"
+
+    if POSTPROCESS['mp3']:
+        # Chỉ tải audio gốc; chuyển sang mp3 do pool hậu xử lý của app làm sau
+        command.extend([
+            '-f', audio_format_selector,
+            '-o', output_template,
+            '--windows-filenames',
+        ])
+    elif download_format.lower() == 'mp3':
         command.extend([
             '-f', audio_format_selector,
             '--extract-audio',
             '--audio-format', 'mp3',
             '--audio-quality', '0',
             '-o', output_template,
-            '--ffmpeg-location', resources_path,
+            '--ffmpeg-location', ffmpeg_location,
             '--windows-filenames',  # Chỉ loại bỏ ký tự không hợp lệ trên Windows, giữ tên gần với tên gốc
         ])
     else:
@@ -354,16 +3274,29 @@ def main(url, save_path, resources_path, cookies_path, quality, thumbnail, no_pl
             )
         else:
             format_selection = "bestvideo[height>=720]+bestaudio[asr>=44100]/bestvideo[height>=480]+bestaudio[asr>=44100]/best[height>=720]/best[height>=480]/bestvideo+bestaudio/best/-18/-36/-17/-5"
+        # Người dùng chọn trần chất lượng (vd: 720p): thử các format không vượt trần trước,
+        # chuỗi mặc định ở trên chỉ còn là phương án cuối nếu không xác định được chiều cao
+        if height_cap:
+            capped = f"bestvideo[height<={height_cap}]+bestaudio[language={audio_lang}][asr>=44100]/" if audio_lang else ''
+            format_selection = (
+                f"{capped}bestvideo[height<={height_cap}]+bestaudio[asr>=44100]/"
+                f"bestvideo[height<={height_cap}]+bestaudio/best[height<={height_cap}]/{format_selection}"
+            )
+        if quality_mode == 'audio':
+            format_selection = audio_format_selector
+        # Ưu tiên format có resolution cao hơn, bitrate cao hơn, codec tốt hơn.
+        # Có trần chất lượng: "+height" (tăng dần) sẽ khiến bestvideo[height<=N] chọn chiều cao NHỎ nhất dưới trần,
+        # nên sắp theo res:N (giảm dần, không vượt N) để lấy độ phân giải cao nhất trong trần
+        format_sort = f'res:{height_cap},tbr' if height_cap else '+height:+tbr:+codec'
 
         command.extend([
             '-f', format_selection,
-            # Ưu tiên format có resolution cao hơn, bitrate cao hơn, codec tốt hơn
-            '--format-sort', '+height:+tbr:+codec',
+            '--format-sort', format_sort,
             '--merge-output-format', 'mp4',
             # Sử dụng copy codec khi merge để giữ nguyên chất lượng gốc, không re-encode
             '--postprocessor-args', 'ffmpeg:-c copy',
             '-o', output_template,
-            '--ffmpeg-location', resources_path,
+            '--ffmpeg-location', ffmpeg_location,
             '--windows-filenames',  # Chỉ loại bỏ ký tự không hợp lệ trên Windows, giữ tên gần với tên gốc
         ])
 
@@ -385,8 +3318,8 @@ def main(url, save_path, resources_path, cookies_path, quality, thumbnail, no_pl
         if not has_tiktok_cookies_file:
             # Chỉ auto lấy cookies từ trình duyệt khi không có cookies.txt
             print("STATUS: TikTok yêu cầu cookies. Đang tự động lấy cookies từ trình duyệt...")
-            # Thử Chrome trước (phổ biến nhất), sau đó Edge
-            browsers_to_try = ['chrome', 'edge', 'brave', 'opera']
+            # Mặc định thử Chrome trước (phổ biến nhất), sau đó Edge; thứ tự được điều chỉnh theo thống kê gần đây
+            browsers_to_try = order_browsers(platform, ['chrome', 'edge', 'brave', 'opera'])
             browser_found = False
             for browser in browsers_to_try:
                 try:
@@ -394,8 +3327,7 @@ def main(url, save_path, resources_path, cookies_path, quality, thumbnail, no_pl
                     # Trên Windows, Chrome/Edge thường ở AppData\Local
                     if browser == 'chrome':
                         # Chrome profile path thường ở LOCALAPPDATA\Google\Chrome\User Data
-                        chrome_path = os.path.join(os.getenv('LOCALAPPDATA', ''), 'Google', 'Chrome', 'User Data')
-                        if os.path.exists(chrome_path):
+                        if 'chrome' in browser_sources:
                             print(f"STATUS: Tìm thấy Chrome. Sử dụng cookies từ Chrome...")
                             command.extend(['--cookies-from-browser', 'chrome'])
                             tiktok_uses_browser_cookies = True
@@ -403,8 +3335,7 @@ def main(url, save_path, resources_path, cookies_path, quality, thumbnail, no_pl
                             break
                     elif browser == 'edge':
                         # Edge profile path thường ở LOCALAPPDATA\Microsoft\Edge\User Data
-                        edge_path = os.path.join(os.getenv('LOCALAPPDATA', ''), 'Microsoft', 'Edge', 'User Data')
-                        if os.path.exists(edge_path):
+                        if 'edge' in browser_sources:
                             print(f"STATUS: Tìm thấy Edge. Sử dụng cookies từ Edge...")
                             command.extend(['--cookies-from-browser', 'edge'])
                             tiktok_uses_browser_cookies = True
@@ -440,21 +3371,19 @@ def main(url, save_path, resources_path, cookies_path, quality, thumbnail, no_pl
     # Douyin (抖音): dùng cookies từ trình duyệt + headers tương tự TikTok
     if 'douyin.com' in sanitized_url or 'iesdouyin.com' in sanitized_url:
         print("STATUS: Douyin yêu cầu cookies. Đang tự động lấy cookies từ trình duyệt...")
-        browsers_to_try = ['chrome', 'edge', 'brave', 'opera']
+        browsers_to_try = order_browsers(platform, ['chrome', 'edge', 'brave', 'opera'])
         browser_found = False
         for browser in browsers_to_try:
             try:
                 if browser == 'chrome':
-                    chrome_path = os.path.join(os.getenv('LOCALAPPDATA', ''), 'Google', 'Chrome', 'User Data')
-                    if os.path.exists(chrome_path):
+                    if 'chrome' in browser_sources:
                         print("STATUS: Tìm thấy Chrome. Sử dụng cookies từ Chrome...")
                         command.extend(['--cookies-from-browser', 'chrome'])
                         douyin_uses_browser_cookies = True
                         browser_found = True
                         break
                 elif browser == 'edge':
-                    edge_path = os.path.join(os.getenv('LOCALAPPDATA', ''), 'Microsoft', 'Edge', 'User Data')
-                    if os.path.exists(edge_path):
+                    if 'edge' in browser_sources:
                         print("STATUS: Tìm thấy Edge. Sử dụng cookies từ Edge...")
                         command.extend(['--cookies-from-browser', 'edge'])
                         douyin_uses_browser_cookies = True
@@ -486,39 +3415,143 @@ def main(url, save_path, resources_path, cookies_path, quality, thumbnail, no_pl
 
     command.append(sanitized_url)
 
-    print("STATUS: Đang thực thi yt-dlp...", flush=True)
-
     env = os.environ.copy()
     if js_prepend:
         env["PATH"] = f"{js_prepend}{os.pathsep}{env.get('PATH', '')}"
 
-    process = subprocess.Popen(
-        command,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT,
-        text=True,
-        encoding='utf-8',
-        errors='replace',
-        creationflags=subprocess.CREATE_NO_WINDOW,
-        env=env
-    )
+    def _apply_cookie_jar():
+        """
+        TikTok/Douyin: dùng cookie jar đã xuất sẵn thay cho việc đọc cookie DB của trình duyệt ở mỗi lần chạy
+        (không có jar thì giữ --cookies-from-browser và các nhánh thử lại cookie_locked/DPAPI như cũ).
+        Info JSON đã extract theo lệnh cũ (strategy thắng race) được chuyển sang khóa cache của lệnh mới.
+        """
+        if platform not in COOKIE_JAR_DOMAINS or '--cookies-from-browser' not in command or '--cookies' in command:
+            return False
+        previous = list(command)
+        with PHASES.phase('cookies') as metric:
+            metric['ok'] = use_cookie_jar(command, yt_dlp_exe_path, platform)
+        cached_info_path = find_cached_info(previous) if metric['ok'] else None
+        if cached_info_path:
+            try:
+                with open(cached_info_path, 'r', encoding='utf-8') as f:
+                    store_cached_info(command, f.read())
+            except OSError:
+                pass
+        return metric['ok']
 
-    output_lines = []
-    for line in iter(process.stdout.readline, ''):
-        line = line.strip()
-        if line:
-            print(line, flush=True)
-            output_lines.append(line)
+    # Đổi sang cookie jar trước khi dựng các strategy race để strategy mặc định extract đúng bằng lệnh sẽ tải
+    if _apply_cookie_jar():
+        tiktok_uses_browser_cookies = douyin_uses_browser_cookies = False
 
-    process.wait()
+    # Chế độ race (tùy chọn): chạy song song bước extract của các cấu hình ứng viên, chọn cấu hình
+    # đầu tiên thành công rồi tải đúng một lần. Chỉ áp dụng cho video đơn lẻ.
+    if race and no_playlist and not batch_urls:
+        emit_event('phase', phase='extract')
+        strategies = build_race_strategies(platform, command, browser_sources, cookies_path)
+        if len(strategies) > 1:
+            with PHASES.phase('race', strategies=len(strategies)) as metric:
+                winner = race_strategies(platform, strategies, env, race_workers, race_timeout)
+                metric['ok'] = bool(winner)
+            if winner:
+                command = winner[1]
+                tiktok_uses_browser_cookies = tiktok_uses_browser_cookies and '--cookies-from-browser' in command
+                douyin_uses_browser_cookies = douyin_uses_browser_cookies and '--cookies-from-browser' in command
+
+    # Strategy thắng race dùng trình duyệt khác: đổi sang jar của trình duyệt đó (giữ info JSON đã extract)
+    if _apply_cookie_jar():
+        tiktok_uses_browser_cookies = douyin_uses_browser_cookies = False
+
+    # Chế độ batch (--url-file): cả nhóm URL cùng platform được tải bằng một lần chạy yt-dlp với lệnh vừa dựng
+    if batch_urls:
+        emit_event('phase', phase='download')
+        return download_batch(command, env, batch_urls, platform)
+
+    # Format plan: chỉ cho video đơn lẻ và khi bật cache metadata (bước tải dùng lại đúng info vừa extract).
+    # Plan còn hạn (fallback, tải lại trong thời hạn URL đã ký) thì không cần lấy/đánh giá lại danh sách format.
+    plan_format = None
+    if METADATA_CACHE['ttl'] > 0 and single_video:
+        plan_key = f"{video_key or sanitized_url}|{quality_mode}|{height_cap or ''}|{audio_lang or ''}"
+        with PHASES.phase('extract') as metric:
+            plan = get_format_plan(command, env, plan_key, quality_mode, height_cap, audio_lang)
+            metric.update(ok=bool(plan), cached=bool(plan and plan['cached']))
+        if plan:
+            plan_format = plan['format']
+            expires = time.strftime('%H:%M %d/%m', time.localtime(plan['expires_at']))
+            print(f"STATUS: Format plan{' (đã lưu)' if plan['cached'] else ''}: {plan['summary']} — hết hạn lúc {expires}",
+                  flush=True)
+            emit_event('format_plan', format=plan_format, summary=plan['summary'], cached=plan['cached'],
+                       expires_at=plan['expires_at'])
+            format_index = command.index('-f') + 1
+            command[format_index] = f"{plan_format}/{command[format_index]}"
+            # Kiểm tra dung lượng trống theo kích thước trong metadata: thiếu chỗ thì dừng ngay thay vì lỗi lúc merge.
+            # Merge ngay trong job cần chỗ cho cả các phần lẫn file merge; file cuối nằm ở save_path.
+            if plan.get('size'):
+                merge = '+' in plan_format
+                download_size = plan['size'] * (2 if merge and not POSTPROCESS['defer'] else 1)
+                requirements = [(stage_dir or save_path, download_size)]
+                if stage_dir or (merge and POSTPROCESS['defer']):
+                    requirements.append((save_path, plan['size']))
+                shortage = check_free_space(requirements)
+                if shortage:
+                    print(f"ERROR: Không đủ dung lượng trống để tải video này: {shortage}.")
+                    emit_event('error', error_class='disk', message=shortage)
+                    return 1
+        else:
+            print("STATUS: Không lập được format plan, dùng chuỗi chọn format mặc định.", flush=True)
+    if POSTPROCESS['mp3'] and archive_path:
+        cached_info_path = find_cached_info(command)
+        info = load_json_file(cached_info_path, {}) if cached_info_path else {}
+        POSTPROCESS['archive_id'] = (f"{info['extractor_key'].lower()} {info['id']}"
+                                     if info.get('id') and info.get('extractor_key') else video_key)
+
+    emit_event('phase', phase='download')
+    print("STATUS: Đang thực thi yt-dlp...", flush=True)
+    def _run_strategy(strategy, cmd, run_env=None, runner=None):
+        """Chạy một lần thử và ghi thống kê (thành công/thất bại, độ trễ) cho strategy"""
+        # Mỗi lần thử (kể cả thử lại/fallback) lấy một token và chờ backoff nếu host vừa bị giới hạn
+        budget = acquire_host_budget(platform, transfer_host)
+        started = time.time()
+        with PHASES.phase(f"attempt:{strategy}") as metric:
+            if runner:
+                rc, out = runner(cmd, run_env or env, engine)
+            else:
+                # Chỉ dừng sớm khi gặp lỗi chốt với video đơn lẻ; playlist/kênh để yt-dlp bỏ qua video lỗi như mặc định
+                rc, out = run_ytdlp(cmd, run_env or env, engine, stop_on_fatal=single_video)
+            metric['ok'] = rc == 0
+            if rc != 0:
+                metric['error_class'] = out.error_class()
+        JOB_STATS['archive_skips'] += out.counts.get('archive_skip', 0)
+        duration = time.time() - started
+        record_strategy_result(platform, strategy, rc == 0, duration)
+        throttled = is_host_throttled(platform, out)
+        if rc == 0 or throttled:
+            report_host_result(platform, transfer_host, budget, rc != 0, median_transfer_speed())
+        if concurrent_fragments == 'auto':
+            record_transfer_result(platform, transfer_host, fragments, out.has('rate_limited'))
+        else:
+            TRANSFER_SAMPLES.clear()
+        emit_event('strategy', platform=platform, strategy=strategy, ok=rc == 0, duration=round(duration, 3))
+        return rc, out
+
+    result = None
+    # Format plan là video+audio tách riêng: tải hai luồng song song rồi merge, thay vì để yt-dlp tải lần lượt
+    if (parallel_streams and plan_format and quality_mode == 'video' and plan_format.count('+') == 1
+            and find_cached_info(command)):
+        result = _run_strategy(
+            strategy_name_of(command), command,
+            runner=lambda cmd, run_env, _engine: download_streams_parallel(
+                cmd, plan_format.split('+'), run_env, ffmpeg_location, archive_path, files_list_path, platform))
+        if result is not None and result[0] != 0:
+            print("WARNING: Tải song song video/audio thất bại, thử lại theo cách tải thông thường...", flush=True)
+            result = None
+    returncode, output = result or _run_strategy(strategy_name_of(command), command)
 
-    if process.returncode == 0:
+    if returncode == 0:
         print("SUCCESS: Tải và xử lý file thành công!")
     else:
-        print(f"ERROR: Quá trình thất bại với mã lỗi {process.returncode}.")
-        # Kiểm tra các loại lỗi phổ biến
-        output_text = '\n'.join(output_lines).lower()
-        output_text_original = '\n'.join(output_lines)  # Giữ nguyên để in ra
+        print(f"ERROR: Quá trình thất bại với mã lỗi {returncode}.")
+        # Các loại lỗi phổ biến đã được ErrorClassifier ghi nhận trong lúc chạy (output.has(...))
+        emit_event('error', error_class=output.error_class(), message=output.last_error)
 
         def _has_arg(flag: str) -> bool:
             try:
@@ -538,26 +3571,9 @@ def main(url, save_path, resources_path, cookies_path, quality, thumbnail, no_pl
                 i += 1
             return out
 
-        def _run_retry(retry_command, title: str):
+        def _run_retry(retry_command, title: str, strategy: str):
             print(f"\n🔄 {title}...", flush=True)
-            retry_process = subprocess.Popen(
-                retry_command,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-                text=True,
-                encoding='utf-8',
-                errors='replace',
-                creationflags=subprocess.CREATE_NO_WINDOW,
-                env=env
-            )
-            retry_output = []
-            for ln in iter(retry_process.stdout.readline, ''):
-                ln = ln.strip()
-                if ln:
-                    print(ln, flush=True)
-                    retry_output.append(ln)
-            retry_process.wait()
-            return retry_process.returncode, retry_output
+            return _run_strategy(strategy, retry_command)
 
         def _build_command_with_browser_cookies(browser_name: str):
             # Tạo command mới: bỏ --cookies-from-browser cũ (nếu có), rồi thêm browser mới trước URL
@@ -581,43 +3597,35 @@ def main(url, save_path, resources_path, cookies_path, quality, thumbnail, no_pl
         # Tự động retry bằng cookies từ trình duyệt (Edge/Chrome), kể cả khi đã có cookies file
         # vì cookies file có thể không đủ quyền hoặc đã hết hạn.
         if platform == 'youtube':
-            yt_unavailable_152 = ('error code: 152' in output_text) or ('watch video on youtube' in output_text)
-            yt_auth_like = (
-                yt_unavailable_152 or
-                ('confirm your age' in output_text) or
-                ('age-restricted' in output_text) or
-                ('this video is unavailable' in output_text) or
-                ('video is unavailable' in output_text)
-            )
+            yt_unavailable_152 = output.has('yt_152')
+            yt_auth_like = yt_unavailable_152 or output.has('age_restricted', 'yt_unavailable')
 
             has_browser_cookies = _has_arg('--cookies-from-browser')
 
             # 1) Nếu chưa dùng --cookies-from-browser, thử tự động lấy từ Edge/Chrome
             if yt_auth_like and (not has_browser_cookies):
-                edge_profile = os.path.join(os.getenv('LOCALAPPDATA', ''), 'Microsoft', 'Edge', 'User Data')
-                chrome_profile = os.path.join(os.getenv('LOCALAPPDATA', ''), 'Google', 'Chrome', 'User Data')
-
                 # Thử theo thứ tự: ưu tiên browser có profile tồn tại.
                 # Lưu ý: có profile chưa chắc có đăng nhập YouTube, nên sẽ thử cả 2 nếu cần.
                 candidates = []
-                if os.path.exists(edge_profile):
+                if 'edge' in browser_sources:
                     candidates.append('edge')
-                if os.path.exists(chrome_profile):
+                if 'chrome' in browser_sources:
                     candidates.append('chrome')
                 if not candidates:
                     candidates = ['edge', 'chrome']  # yt-dlp sẽ tự xử lý nếu không tìm thấy profile
+                candidates = order_browsers(platform, candidates)
 
-                last_retry_out = []
+                last_retry_out = None
                 for b in candidates:
                     retry_cmd = _build_command_with_browser_cookies(b)
-                    rc, retry_out = _run_retry(retry_cmd, f"YouTube yêu cầu xác thực — thử dùng cookies từ {b.capitalize()}")
+                    rc, retry_out = _run_retry(retry_cmd, f"YouTube yêu cầu xác thực — thử dùng cookies từ {b.capitalize()}",
+                                               f"cookies:{b}")
                     last_retry_out = retry_out
                     if rc == 0:
                         print(f"\n✅ SUCCESS: Đã tải thành công với cookies từ {b.capitalize()}!")
                         return 0
 
-                    retry_out_text = '\n'.join(retry_out).lower()
-                    if ('could not copy chrome cookie database' in retry_out_text) or ('could not copy edge cookie database' in retry_out_text):
+                    if retry_out.has('cookie_locked'):
                         print("\n⚠️  Không thể đọc cookies từ trình duyệt (có thể trình duyệt đang chạy/khóa dữ liệu).")
                         print("💡 GỢI Ý: Hãy đóng hẳn Chrome/Edge rồi thử lại, hoặc xuất cookies.txt và chọn trong app.")
                         # Nếu bị khóa DB thì thử browser còn lại luôn, biết đâu đọc được.
@@ -625,13 +3633,11 @@ def main(url, save_path, resources_path, cookies_path, quality, thumbnail, no_pl
 
                 # Nếu retry vẫn thất bại, gom log để các nhánh chẩn đoán phía dưới xử lý tiếp
                 if last_retry_out:
-                    output_lines.extend(last_retry_out)
-                    output_text = '\n'.join(output_lines).lower()
-                    output_text_original = '\n'.join(output_lines)
+                    output.merge(last_retry_out)
 
             # 2) Nếu sau tất cả vẫn còn lỗi 152-18, thử cấu hình YouTube đơn giản hơn (player_client=web, format=best)
             #    Điều này giúp tránh các client embed/tv có thể bị chặn "Watch video on YouTube".
-            yt_unavailable_152 = ('error code: 152' in output_text) or ('watch video on youtube' in output_text)
+            yt_unavailable_152 = output.has('yt_152')
             if yt_unavailable_152:
                 print("\n⚠️  YouTube trả về lỗi 152-18 (Watch video on YouTube). Đang thử cấu hình fallback đơn giản hơn...", flush=True)
                 yt_fallback_cmd = [
@@ -639,11 +3645,11 @@ def main(url, save_path, resources_path, cookies_path, quality, thumbnail, no_pl
                     '--impersonate', 'chrome',
                     '--no-update',
                     '--downloader', 'native',
-                    '--concurrent-fragments', '5',
                     '--retries', '10',
                     '--fragment-retries', '10',
+                    *job_download_args,
                     '--merge-output-format', 'mp4',
-                    '-f', 'best',
+                    '-f', f"{plan_format}/best" if plan_format else 'best',
                     '-o', output_template,
                     '--windows-filenames',
                     '--extractor-args', 'youtube:player_client=web',
@@ -654,13 +3660,7 @@ def main(url, save_path, resources_path, cookies_path, quality, thumbnail, no_pl
                     yt_fallback_cmd.extend(['--cookies', cookies_path])
                 else:
                     # Nếu không có cookies file, thử lại với cookies từ trình duyệt (Chrome/Edge)
-                    edge_profile = os.path.join(os.getenv('LOCALAPPDATA', ''), 'Microsoft', 'Edge', 'User Data')
-                    chrome_profile = os.path.join(os.getenv('LOCALAPPDATA', ''), 'Google', 'Chrome', 'User Data')
-                    browsers = []
-                    if os.path.exists(chrome_profile):
-                        browsers.append('chrome')
-                    if os.path.exists(edge_profile):
-                        browsers.append('edge')
+                    browsers = [b for b in ('chrome', 'edge') if b in browser_sources]
                     if not browsers:
                         browsers = ['chrome', 'edge']
                     # Chỉ chọn browser đầu tiên cho fallback đơn giản
@@ -675,26 +3675,16 @@ def main(url, save_path, resources_path, cookies_path, quality, thumbnail, no_pl
 
                 yt_fallback_cmd.append(sanitized_url)
 
-                rc_fb, out_fb = _run_retry(yt_fallback_cmd, "Fallback YouTube: player_client=web, format=best")
+                rc_fb, out_fb = _run_retry(yt_fallback_cmd, "Fallback YouTube: player_client=web, format=best", 'fallback:web')
                 if rc_fb == 0:
                     print("\n✅ SUCCESS: YouTube đã tải thành công với cấu hình fallback đơn giản!", flush=True)
                     return 0
 
                 # Nếu vẫn lỗi, bổ sung log để các nhánh chẩn đoán phía dưới có thông tin đầy đủ hơn
-                output_lines.extend(out_fb)
-                output_text = '\n'.join(output_lines).lower()
-                output_text_original = '\n'.join(output_lines)
+                output.merge(out_fb)
 
         # Xử lý lỗi không đọc được cookies từ trình duyệt (Chrome đang chạy, Edge DPAPI, ...)
-        def _browser_cookie_read_failed(text: str) -> bool:
-            t = text.lower()
-            return (
-                'could not copy chrome cookie database' in t
-                or 'could not copy edge cookie database' in t
-                or 'failed to decrypt with dpapi' in t
-            )
-
-        cookie_db_error = _browser_cookie_read_failed(output_text)
+        cookie_db_error = output.has('cookie_locked', 'dpapi')
         if platform == 'tiktok' and cookie_db_error and tiktok_uses_browser_cookies:
             print("\n⚠️  Không thể lấy cookies từ trình duyệt (trình duyệt đang chạy). Đang thử các cách khác...")
             
@@ -707,8 +3697,7 @@ def main(url, save_path, resources_path, cookies_path, quality, thumbnail, no_pl
             
             # Thử Edge nếu đang dùng Chrome
             if used_browser == 'chrome':
-                edge_path = os.path.join(os.getenv('LOCALAPPDATA', ''), 'Microsoft', 'Edge', 'User Data')
-                if os.path.exists(edge_path):
+                if 'edge' in browser_sources:
                     print("🔄 Thử lấy cookies từ Edge thay vì Chrome...")
                     # Tạo command mới với Edge
                     retry_command = []
@@ -724,36 +3713,16 @@ def main(url, save_path, resources_path, cookies_path, quality, thumbnail, no_pl
                         else:
                             retry_command.append(arg)
                     
-                    retry_process = subprocess.Popen(
-                        retry_command,
-                        stdout=subprocess.PIPE,
-                        stderr=subprocess.STDOUT,
-                        text=True,
-                        encoding='utf-8',
-                        errors='replace',
-                        creationflags=subprocess.CREATE_NO_WINDOW,
-                        env=env
-                    )
-                    
-                    retry_output = []
-                    for line in iter(retry_process.stdout.readline, ''):
-                        line = line.strip()
-                        if line:
-                            print(line, flush=True)
-                            retry_output.append(line)
-                    
-                    retry_process.wait()
+                    retry_rc, retry_output = _run_strategy('cookies:edge', retry_command)
                     
-                    if retry_process.returncode == 0:
+                    if retry_rc == 0:
                         print("\n✅ SUCCESS: Đã tải thành công với cookies từ Edge!")
                         return 0
                     else:
-                        retry_output_text = '\n'.join(retry_output).lower()
-                        output_lines.extend(retry_output)
-                        output_text = '\n'.join(output_lines).lower()
-                        if 'could not copy edge cookie database' in retry_output_text:
+                        output.merge(retry_output)
+                        if retry_output.has('cookie_locked'):
                             print("⚠️  Edge cũng đang chạy. Thử với cookies file hoặc đóng trình duyệt...")
-                        elif 'failed to decrypt with dpapi' in retry_output_text:
+                        elif retry_output.has('dpapi'):
                             print("⚠️  Edge không giải mã được cookies (DPAPI). Sẽ thử tải không dùng cookies trình duyệt...")
             
             # Nếu có cookies file, thử dùng nó
@@ -782,32 +3751,14 @@ def main(url, save_path, resources_path, cookies_path, quality, thumbnail, no_pl
                     retry_command.insert(insert_pos, cookies_path)
                     retry_command.insert(insert_pos, '--cookies')
                 
-                retry_process = subprocess.Popen(
-                    retry_command,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.STDOUT,
-                    text=True,
-                    encoding='utf-8',
-                    errors='replace',
-                    creationflags=subprocess.CREATE_NO_WINDOW,
-                    env=env
-                )
-                
-                retry_output = []
-                for line in iter(retry_process.stdout.readline, ''):
-                    line = line.strip()
-                    if line:
-                        print(line, flush=True)
-                        retry_output.append(line)
-                
-                retry_process.wait()
+                retry_rc, retry_output = _run_strategy('cookies-file', retry_command)
                 
-                if retry_process.returncode == 0:
+                if retry_rc == 0:
                     print("\n✅ SUCCESS: Đã tải thành công với cookies file!")
                     return 0
                 else:
                     print("\n❌ Cookies file cũng không hoạt động.")
-                    output_lines.extend(retry_output)
+                    output.merge(retry_output)
             
             # Không có cookies.txt: nhiều video TikTok công khai vẫn tải được không cần cookies
             if not (cookies_path and os.path.exists(cookies_path)):
@@ -816,12 +3767,12 @@ def main(url, save_path, resources_path, cookies_path, quality, thumbnail, no_pl
                     rc_nb, out_nb = _run_retry(
                         no_browser_cmd,
                         "TikTok — thử không dùng cookies trình duyệt (video/ kênh công khai)",
+                        'no-cookies',
                     )
                     if rc_nb == 0:
                         print("\n✅ SUCCESS: Đã tải TikTok thành công không cần cookies trình duyệt.")
                         return 0
-                    output_lines.extend(out_nb)
-                    output_text = '\n'.join(output_lines).lower()
+                    output.merge(out_nb)
 
             # Nếu vẫn lỗi, hướng dẫn người dùng
             if not (cookies_path and os.path.exists(cookies_path)):
@@ -834,13 +3785,14 @@ def main(url, save_path, resources_path, cookies_path, quality, thumbnail, no_pl
                 print("   Cách 3: Thử với trình duyệt khác (Brave, Opera)")
 
         # Fallback riêng cho TikTok nếu gặp lỗi "Video not available" / status code 0
-        if platform == 'tiktok' and ('video not available' in output_text or 'status code 0' in output_text):
+        if platform == 'tiktok' and output.has('tiktok_status0'):
             print("\n⚠️  TikTok trả về lỗi video not available/status 0. Đang thử lại với cấu hình fallback...")
             
             # Thử nhiều cách fallback khác nhau với cookies từ trình duyệt
             fallback_configs = [
                 {
                     'name': 'Web client với cookies từ trình duyệt',
+                    'strategy': 'fallback:web',
                     'extractor_args': 'tiktok:player_client=web',
                     'use_browser_cookies': True,
                     'headers': [
@@ -857,6 +3809,7 @@ def main(url, save_path, resources_path, cookies_path, quality, thumbnail, no_pl
                 },
                 {
                     'name': 'Android client với cookies từ trình duyệt',
+                    'strategy': 'fallback:android',
                     'extractor_args': 'tiktok:player_client=android,app_info=1,download_api=1',
                     'use_browser_cookies': True,
                     'headers': [
@@ -867,6 +3820,7 @@ def main(url, save_path, resources_path, cookies_path, quality, thumbnail, no_pl
                 },
                 {
                     'name': 'iOS client với cookies từ trình duyệt',
+                    'strategy': 'fallback:ios',
                     'extractor_args': 'tiktok:player_client=ios',
                     'use_browser_cookies': True,
                     'headers': [
@@ -877,6 +3831,10 @@ def main(url, save_path, resources_path, cookies_path, quality, thumbnail, no_pl
                 }
             ]
             
+            # Thử cấu hình có tỉ lệ thành công gần đây cao nhất trước
+            config_by_strategy = {config['strategy']: config for config in fallback_configs}
+            fallback_configs = [config_by_strategy[name] for name in order_strategies(platform, list(config_by_strategy))]
+
             success = False
             for config in fallback_configs:
                 if success:
@@ -890,6 +3848,7 @@ def main(url, save_path, resources_path, cookies_path, quality, thumbnail, no_pl
                     '--downloader', 'native',
                     '--force-ipv4',
                     '--geo-bypass',
+                    *job_download_args,
                     '--merge-output-format', 'mp4',
                     '-o', output_template,
                     '--windows-filenames',
@@ -898,11 +3857,9 @@ def main(url, save_path, resources_path, cookies_path, quality, thumbnail, no_pl
                 # Thêm cookies từ trình duyệt nếu được yêu cầu
                 if config.get('use_browser_cookies', False):
                     # Thử Chrome trước, sau đó Edge
-                    chrome_path = os.path.join(os.getenv('LOCALAPPDATA', ''), 'Google', 'Chrome', 'User Data')
-                    edge_path = os.path.join(os.getenv('LOCALAPPDATA', ''), 'Microsoft', 'Edge', 'User Data')
-                    if os.path.exists(chrome_path):
+                    if 'chrome' in browser_sources:
                         tiktok_fallback_cmd.extend(['--cookies-from-browser', 'chrome'])
-                    elif os.path.exists(edge_path):
+                    elif 'edge' in browser_sources:
                         tiktok_fallback_cmd.extend(['--cookies-from-browser', 'edge'])
                     else:
                         # Fallback: thử chrome anyway (yt-dlp sẽ tự xử lý)
@@ -926,36 +3883,23 @@ def main(url, save_path, resources_path, cookies_path, quality, thumbnail, no_pl
                 # Cookies file sẽ được dùng như fallback nếu browser cookies không đủ
                 if cookies_path and os.path.exists(cookies_path):
                     tiktok_fallback_cmd.extend(['--cookies', cookies_path])
-                
+                elif '--cookies-from-browser' in tiktok_fallback_cmd:
+                    with PHASES.phase('cookies') as metric:
+                        metric['ok'] = use_cookie_jar(tiktok_fallback_cmd, yt_dlp_exe_path, platform)
+
                 # Format selection cho TikTok (đơn giản hơn, TikTok thường chỉ có một format)
-                tiktok_fallback_cmd.extend(['-f', 'best'])
+                tiktok_fallback_cmd.extend(['-f', f"{plan_format}/best" if plan_format else 'best'])
                 tiktok_fallback_cmd.append(sanitized_url)
 
-                fb_process = subprocess.Popen(
-                    tiktok_fallback_cmd,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.STDOUT,
-                    text=True,
-                    encoding='utf-8',
-                    errors='replace',
-                    creationflags=subprocess.CREATE_NO_WINDOW,
-                    env=env
-                )
-                fb_output = []
-                for line in iter(fb_process.stdout.readline, ''):
-                    line = line.strip()
-                    if line:
-                        print(line, flush=True)
-                        fb_output.append(line)
-                fb_process.wait()
-
-                if fb_process.returncode == 0:
+                fb_rc, fb_output = _run_strategy(config['strategy'], tiktok_fallback_cmd)
+
+                if fb_rc == 0:
                     print(f"\n✅ SUCCESS: TikTok đã tải thành công với cấu hình fallback: {config['name']}!")
                     success = True
                     return 0
                 else:
                     print(f"❌ Fallback '{config['name']}' thất bại, thử cách tiếp theo...")
-                    output_lines.extend(fb_output)
+                    output.merge(fb_output)
             
             # Nếu tất cả fallback đều thất bại
             print("\n❌ Tất cả các cách fallback TikTok đều thất bại.")
@@ -968,9 +3912,9 @@ def main(url, save_path, resources_path, cookies_path, quality, thumbnail, no_pl
             print("   - Kiểm tra xem video có còn tồn tại trên TikTok không")
         
         # Kiểm tra lỗi: chỉ có ảnh (thumbnail) có sẵn
-        has_only_images = 'only images are available' in output_text
-        has_format_error = 'requested format is not available' in output_text
-        has_challenge_failed = 'challenge solving failed' in output_text
+        has_only_images = output.has('only_images')
+        has_format_error = output.has('no_formats')
+        has_challenge_failed = output.has('challenge_failed')
         
         # Kiểm tra lỗi: video không có format nào phù hợp (chỉ có thumbnail)
         # Lưu ý: Với fallback "best" ở cuối, lỗi "requested format is not available" 
@@ -979,13 +3923,11 @@ def main(url, save_path, resources_path, cookies_path, quality, thumbnail, no_pl
             print("\n⚠️  LỖI: Video này không có format video phù hợp có sẵn.")
             print("⚠️  Ứng dụng đã thử tải 1080p (ưu tiên), 720p (fallback), và chất lượng cao nhất có sẵn.")
             print("💡 GỢI Ý: Video này có thể chỉ có thumbnail hoặc không có format video nào.")
-            return process.returncode
+            return returncode
         
-        # Kích hoạt fallback nếu có "only images" hoặc "requested format is not available" 
-        # (thường đi kèm với "only images" trong trường hợp này)
-        should_try_thumbnail = has_only_images or (has_format_error and 'images' in output_text)
-        
-        if should_try_thumbnail:
+        # Kích hoạt fallback khi yt-dlp báo "only images are available"
+        # ("requested format is not available" không kèm thông báo này đã dừng ở nhánh trên)
+        if has_only_images:
             print("\n⚠️  LỖI: Video này chỉ có ảnh thumbnail có sẵn, không có video/audio để tải.")
             if has_challenge_failed:
                 print("⚠️  CẢNH BÁO: Không thể giải quyết challenge của YouTube - điều này có thể là nguyên nhân.")
@@ -1002,82 +3944,74 @@ def main(url, save_path, resources_path, cookies_path, quality, thumbnail, no_pl
             # Thử tải thumbnail như một fallback
             print("\n🔄 Đang thử tải thumbnail như một giải pháp thay thế...")
             
-            # Thử với nhiều client khác nhau để bypass challenge
-            clients_to_try = ['android', 'ios', 'web']
-            thumbnail_downloaded = False
+            # Lệnh chung cho các client; mỗi client thêm extractor-args, thư mục tạm riêng và URL
+            thumbnail_command = [
+                yt_dlp_exe_path,
+                '--impersonate', 'chrome',
+                '--no-update',
+                '--write-thumbnail',
+                '--skip-download',
+                '--windows-filenames',  # Chỉ loại bỏ ký tự không hợp lệ trên Windows, giữ tên gần với tên gốc
+            ]
             
-            for client in clients_to_try:
-                if thumbnail_downloaded:
-                    break
-                    
-                print(f"\n🔄 Thử với client: {client}...")
-                thumbnail_command = [
-                    yt_dlp_exe_path,
-                    '--impersonate', 'chrome',
-                    '--no-update',
-                    '--write-thumbnail',
-                    '--skip-download',
-                    '--extractor-args', f'youtube:player_client={client}',
-                    '-o', os.path.join(save_path, '%(title).200s.%(ext)s'),
-                    '--windows-filenames',  # Chỉ loại bỏ ký tự không hợp lệ trên Windows, giữ tên gần với tên gốc
-                ]
-                
-                if cookies_path and os.path.exists(cookies_path):
-                    thumbnail_command.extend(['--cookies', cookies_path])
-                
-                # Thêm JS runtime và EJS components cho thumbnail download
-                if js_runtime_type == 'deno':
-                    thumbnail_command.extend(['--js-runtimes', f'deno:{js_runtime_path}'])
-                elif js_runtime_type == 'node':
-                    thumbnail_command.extend(['--js-runtimes', 'node'])
-                thumbnail_command.extend(['--remote-components', 'ejs:github'])
-                
-                if js_prepend:
-                    env_thumb = os.environ.copy()
-                    env_thumb["PATH"] = f"{js_prepend}{os.pathsep}{env_thumb.get('PATH', '')}"
-                else:
-                    env_thumb = os.environ.copy()
-                
-                thumbnail_command.append(url)
-                
-                thumb_process = subprocess.Popen(
-                    thumbnail_command,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.STDOUT,
-                    text=True,
-                    encoding='utf-8',
-                    errors='replace',
-                    creationflags=subprocess.CREATE_NO_WINDOW,
-                    env=env_thumb
-                )
-                
-                thumb_output = []
-                for line in iter(thumb_process.stdout.readline, ''):
-                    line = line.strip()
-                    if line:
-                        print(line, flush=True)
-                        thumb_output.append(line)
-                
-                thumb_process.wait()
-                
-                if thumb_process.returncode == 0:
-                    print(f"\n✅ Đã tải thành công thumbnail của video (sử dụng client: {client})!")
-                    thumbnail_downloaded = True
-                    return 0
+            if cookies_path and os.path.exists(cookies_path):
+                thumbnail_command.extend(['--cookies', cookies_path])
             
-            if not thumbnail_downloaded:
-                print("\n❌ Không thể tải thumbnail với bất kỳ client nào.")
-                if not cookies_path:
-                    print("\n💡 GỢI Ý: Hãy thử thêm file cookies.txt mới trong ứng dụng và tải lại.")
-                else:
-                    print("\n💡 GỢI Ý: Cookies hiện tại có thể không đủ quyền hoặc đã hết hạn.")
-                    print("   Hãy thử xuất cookies mới từ trình duyệt (đảm bảo đã đăng nhập và có quyền xem video).")
-                print("💡 Bạn có thể thử sử dụng --list-formats để xem các định dạng có sẵn.")
+            # Thêm JS runtime và EJS components cho thumbnail download
+            if js_runtime_type == 'deno':
+                thumbnail_command.extend(['--js-runtimes', f'deno:{js_runtime_path}'])
+            elif js_runtime_type == 'node':
+                thumbnail_command.extend(['--js-runtimes', 'node'])
+            thumbnail_command.extend(['--remote-components', 'ejs:github'])
+            
+            if js_prepend:
+                env_thumb = os.environ.copy()
+                env_thumb["PATH"] = f"{js_prepend}{os.pathsep}{env_thumb.get('PATH', '')}"
+            else:
+                env_thumb = os.environ.copy()
+            
+            thumbnail_path = None
+            with PHASES.phase('thumbnail') as metric:
+                # Thumbnail của video này đã lấy gần đây (cache theo ID video, chỉ dùng sau khi tải thật đã thất bại)
+                if video_key:
+                    thumbnail_path = restore_cached_thumbnail(video_key, save_path, prefer_jpg=thumbnail)
+                    thumbnail_source = 'thumbnail đã lưu'
+                # Metadata đã extract (format plan/lần thử trước) có sẵn URL thumbnail: tải thẳng, không chạy yt-dlp
+                cached_info_path = None if thumbnail_path else find_cached_info(command)
+                if cached_info_path:
+                    thumbnail_path = fetch_thumbnail_from_info(load_json_file(cached_info_path, {}), save_path)
+                    thumbnail_source = 'metadata đã extract'
+                # Không có: thử song song nhiều client khác nhau để bypass challenge
+                if not thumbnail_path:
+                    winner = race_thumbnail_clients(platform, thumbnail_command, url, ['android', 'ios', 'web'],
+                                                    env_thumb, save_path, os.path.basename(output_template),
+                                                    race_workers, race_timeout)
+                    if winner:
+                        thumbnail_source = f"client: {winner[0]}"
+                        thumbnail_path = winner[1]
+                metric['ok'] = bool(thumbnail_path)
+            
+            if thumbnail_path:
+                print(f"\n✅ Đã tải thành công thumbnail của video (sử dụng {thumbnail_source})!")
+                if video_key:
+                    try:
+                        cache_thumbnail(video_key, thumbnail_path)
+                    except OSError as e:
+                        print(f"WARNING: Không lưu được thumbnail vào cache: {e}")
+                if thumbnail:
+                    queue_thumbnail_conversion(thumbnail_path, resources_path, video_key)
+                return 0
+            
+            print("\n❌ Không thể tải thumbnail với bất kỳ client nào.")
+            if not cookies_path:
+                print("\n💡 GỢI Ý: Hãy thử thêm file cookies.txt mới trong ứng dụng và tải lại.")
+            else:
+                print("\n💡 GỢI Ý: Cookies hiện tại có thể không đủ quyền hoặc đã hết hạn.")
+                print("   Hãy thử xuất cookies mới từ trình duyệt (đảm bảo đã đăng nhập và có quyền xem video).")
+            print("💡 Bạn có thể thử sử dụng --list-formats để xem các định dạng có sẵn.")
         
         # Kiểm tra lỗi authentication
-        elif ('sign in' in output_text and 'bot' in output_text) or \
-             ('from-browser' in output_text and 'cookies' in output_text) or \
-             ('authentication' in output_text and 'required' in output_text):
+        elif output.has('bot_check', 'cookies_required', 'auth_required'):
             if not cookies_path:
                 print("\nGỢI Ý: Video này có thể yêu cầu cookies để xác thực.")
                 print("Hãy thử thêm file cookies.txt trong ứng dụng và tải lại.")
@@ -1097,34 +4031,408 @@ def main(url, save_path, resources_path, cookies_path, quality, thumbnail, no_pl
             else:
                 print("\n💡 GỢI Ý: Cookies hiện tại có thể không đủ. Hãy thử xuất cookies mới từ trình duyệt.")
     
-    return process.returncode
+    return returncode
 
-if __name__ == '__main__':
+# Template --print cho mỗi entry khi liệt kê playlist (--flat-playlist)
+ENTRY_PRINT_TEMPLATE = '%(.{id,url,webpage_url,title,ie_key,playlist_index})j'
+
+
+def list_playlist_entries(url, resources_path, cookies_path, update_ttl=DEFAULT_UPDATE_TTL_HOURS,
+                          force_update=False, rediscover=False, cookie_jar_ttl=DEFAULT_COOKIE_JAR_TTL_MINUTES):
+    """
+    Chế độ --list-entries: liệt kê entry của playlist/kênh bằng --flat-playlist --lazy-playlist
+    (không extract từng video) và in ngay mỗi entry yt-dlp trả về thành một dòng:
+        ENTRY: {"url": ..., "id": ..., "title": ..., "index": ..., "archived": true/false}
+    App dùng các dòng này để tách thành job tải riêng cho từng video.
+    URL không phải playlist (video đơn lẻ) thì không in dòng ENTRY nào.
+    """
+    COOKIE_JARS['ttl'] = max(0, cookie_jar_ttl) * 60
+    PHASES.reset()
+    platform = detect_platform(url)
+    if platform == 'tiktok':
+        url = url.split('?', 1)[0]
+    yt_dlp_exe_path = os.path.abspath(os.path.join(resources_path, 'yt-dlp.exe'))
+    if not os.path.exists(yt_dlp_exe_path):
+        print("ERROR: Thiếu file thực thi yt-dlp.exe.")
+        return 1
+    with PHASES.phase('update'):
+        yt_dlp_exe_path = update_ytdlp_cached(yt_dlp_exe_path, update_ttl, force_update)
+    with PHASES.phase('runtime'):
+        runtime = discover_runtime(resources_path, force=rediscover)
+
+    command = [
+        yt_dlp_exe_path,
+        '--impersonate', 'chrome',
+        '--no-update',
+        '--flat-playlist',
+        '--lazy-playlist',
+        '--ignore-errors',
+        '--print', ENTRY_PRINT_TEMPLATE,
+    ]
+    # Cookies giống job tải: ưu tiên file cookies, TikTok/Douyin dùng cookies trình duyệt nếu không có file
+    if cookies_path and os.path.exists(cookies_path):
+        command.extend(['--cookies', cookies_path])
+    elif platform in ('tiktok', 'douyin'):
+        browsers = order_browsers(platform, [b for b in ('chrome', 'edge') if b in runtime['browser_cookie_sources']])
+        if browsers:
+            command.extend(['--cookies-from-browser', browsers[0]])
+            with PHASES.phase('cookies') as metric:
+                metric['ok'] = use_cookie_jar(command, yt_dlp_exe_path, platform)
+    if runtime['js_runtime_type'] == 'deno':
+        command.extend(['--js-runtimes', f"deno:{runtime['js_runtime_path']}"])
+    elif runtime['js_runtime_type'] == 'node':
+        command.extend(['--js-runtimes', 'node'])
+    command.append(url)
+
+    env = os.environ.copy()
+    if runtime['js_prepend']:
+        env["PATH"] = f"{runtime['js_prepend']}{os.pathsep}{env.get('PATH', '')}"
+
+    print(f"STATUS: Đang liệt kê các video trong playlist/kênh: {url}", flush=True)
+    list_started = time.perf_counter()
+    process = subprocess.Popen(
+        command,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        encoding='utf-8',
+        errors='replace',
+        creationflags=CREATE_NO_WINDOW,
+        env=env
+    )
+    archive_path = get_download_archive_path()
+    archived_ids = set()
+    if archive_path and os.path.exists(archive_path):
+        with open(archive_path, 'r', encoding='utf-8') as f:
+            archived_ids = {line.strip() for line in f if line.strip()}
+
+    count = 0
+    for line in iter(process.stdout.readline, ''):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            entry = json.loads(line) if line.startswith('{') else None
+        except ValueError:
+            entry = None
+        if entry is None:
+            print(line, flush=True)
+            continue
+        if entry.get('playlist_index') is None:
+            # Video đơn lẻ: để app tải như bình thường
+            continue
+        entry_url = entry.get('webpage_url') or entry.get('url')
+        if not entry_url:
+            continue
+        count += 1
+        archive_id = f"{(entry.get('ie_key') or platform).lower()} {entry.get('id')}"
+        print("ENTRY: " + json.dumps({
+            'url': entry_url,
+            'id': entry.get('id'),
+            'title': entry.get('title'),
+            'index': entry.get('playlist_index'),
+            'archived': archive_id in archived_ids,
+        }, ensure_ascii=False), flush=True)
+
+    process.wait()
+    PHASES.record('list', list_started, time.perf_counter(), ok=process.returncode == 0, entries=count)
+    if count:
+        print(f"STATUS: Đã liệt kê {count} video.", flush=True)
+    else:
+        print("STATUS: URL không phải playlist/kênh (hoặc không liệt kê được entry nào).", flush=True)
+    # Liệt kê được một phần (vd: vài entry lỗi với --ignore-errors) vẫn coi là thành công
+    exit_code = 0 if count or process.returncode == 0 else process.returncode
+    PHASES.print_summary(exit_code=exit_code, platform=platform)
+    return exit_code
+
+
+def sanitize_url(url, platform):
+    """URL đã chuẩn hóa như ở đầu _main(): bỏ query của link TikTok, chuyển link Douyin sang dạng video"""
+    if platform == 'tiktok':
+        return url.split('?', 1)[0]
+    if platform == 'douyin':
+        return normalize_douyin_url(url)
+    return url
+
+
+def read_url_file(path):
+    """URL trong file (hoặc stdin nếu path là '-'), mỗi dòng một URL; bỏ dòng trống, dòng chú thích (#, ;) và URL trùng"""
+    if path == '-':
+        lines = sys.stdin.read().splitlines()
+    else:
+        with open(path, 'r', encoding='utf-8-sig') as f:
+            lines = f.read().splitlines()
+    return list(dict.fromkeys(line.strip() for line in lines if line.strip() and not line.strip().startswith(('#', ';'))))
+
+
+def run_batch(args):
+    """
+    Chế độ --url-file: tải nhiều URL trong một lần chạy downloader.
+    - Cập nhật yt-dlp và dò runtime một lần cho cả lô; các job trong lô dùng trạng thái đã giữ trong bộ nhớ.
+    - Video đơn lẻ cùng platform được gom thành nhóm (tối đa --batch-size URL) và tải bằng một lần chạy yt-dlp
+      (download_batch); URL đã có trong download archive được bỏ qua ngay, không gọi yt-dlp.
+    - Chỉ các URL lỗi trong nhóm mới được tải lại từng cái bằng main() với đầy đủ các nhánh fallback.
+    - Playlist/kênh và URL không xác định được ID video được tải riêng như một job thường.
+    Mỗi URL có một dòng kết quả:
+        BATCH_RESULT: {"url": ..., "status": "downloaded"|"skipped"|"failed", "via": "batch"|"single"|"archive"|"duplicate"}
+    """
+    try:
+        urls = read_url_file(args.url_file)
+    except OSError as e:
+        print(f"ERROR: Không đọc được danh sách URL: {e}")
+        return 1
+    if not urls:
+        print("ERROR: Danh sách URL trống.")
+        return 1
+    yt_dlp_exe_path = os.path.abspath(os.path.join(args.resources_path, 'yt-dlp.exe'))
+    if not os.path.exists(yt_dlp_exe_path):
+        print("ERROR: Thiếu file thực thi yt-dlp.exe.")
+        return 1
+    print(f"STATUS: Chế độ batch: {len(urls)} URL", flush=True)
+    update_ytdlp_cached(yt_dlp_exe_path, args.update_ttl, args.force_update)
+    discover_runtime(args.resources_path, force=args.rediscover)
+    job_args = copy.copy(args)
+    job_args.force_update = job_args.rediscover = False
+
+    statuses = []
+
+    def report(url, status, via):
+        statuses.append(status)
+        print("BATCH_RESULT: " + json.dumps({'url': url, 'status': status, 'via': via}, ensure_ascii=False), flush=True)
+
+    def run_single(url):
+        report(url, 'downloaded' if _main_from_args(job_args, url) == 0 else 'failed', 'single')
+
+    archive_path = None if args.no_archive else get_download_archive_path()
+    groups = {}  # platform -> {URL đã chuẩn hóa: URL gốc}
+    singles = []
+    for url in urls:
+        platform = detect_platform(url)
+        sanitized = sanitize_url(url, platform)
+        archive_id = archive_id_from_url(sanitized)
+        if not archive_id or 'list=' in sanitized:
+            singles.append(url)
+        elif archive_path and is_in_download_archive(archive_id):
+            report(url, 'skipped', 'archive')
+        elif sanitized in groups.get(platform, {}):
+            report(url, 'skipped', 'duplicate')
+        else:
+            groups.setdefault(platform, {})[sanitized] = url
+
+    for platform, members in groups.items():
+        sanitized_urls = list(members)
+        for start in range(0, len(sanitized_urls), args.batch_size):
+            chunk = sanitized_urls[start:start + args.batch_size]
+            if len(chunk) == 1:
+                run_single(members[chunk[0]])
+                continue
+            _main_from_args(job_args, chunk[0], batch_urls=chunk)
+            failed = []
+            for sanitized in chunk:
+                if BATCH_RESULTS.get(sanitized):
+                    report(members[sanitized], 'downloaded', 'batch')
+                else:
+                    failed.append(members[sanitized])
+            if failed:
+                print(f"STATUS: {len(failed)}/{len(chunk)} URL {platform} lỗi khi tải theo nhóm, "
+                      f"thử lại từng URL với các phương án dự phòng...", flush=True)
+            for url in failed:
+                run_single(url)
+    for url in singles:
+        run_single(url)
+
+    failed_count = statuses.count('failed')
+    print(f"STATUS: Batch xong: {statuses.count('downloaded')} tải xong, {statuses.count('skipped')} bỏ qua, "
+          f"{failed_count} lỗi.", flush=True)
+    return 0 if failed_count == 0 else 1
+
+
+def build_arg_parser():
     parser = argparse.ArgumentParser(description="Tải video từ URL với yt-dlp.")
-    parser.add_argument("--url", required=True)
-    parser.add_argument("--save-path", required=True)
-    parser.add_argument("--resources-path", required=True)
+    # --url/--save-path/--resources-path bắt buộc với job tải, được kiểm tra trong validate_job_args()
+    parser.add_argument("--url")
+    parser.add_argument("--url-file", help="File danh sách URL (mỗi dòng một URL, '-' = đọc từ stdin) để tải theo lô")
+    parser.add_argument("--batch-size", type=int, default=50,
+                        help="Số URL tối đa trong một lần chạy yt-dlp khi tải theo lô (--url-file)")
+    parser.add_argument("--save-path")
+    parser.add_argument("--resources-path")
     parser.add_argument("--cookies-path", required=False, default=None)
     parser.add_argument("--quality", default='best')
     parser.add_argument("--thumbnail", action='store_true')
     parser.add_argument("--no-playlist", action='store_true')
     parser.add_argument("--format", default='video', help="Định dạng tải: video hoặc mp3")
     parser.add_argument("--audio-lang", default=None, help="Mã ngôn ngữ audio ưu tiên (vd: ja, ko, en, auto)")
+    parser.add_argument("--update-ttl", type=float, default=DEFAULT_UPDATE_TTL_HOURS,
+                        help="Số giờ giữa hai lần kiểm tra cập nhật yt-dlp (0 = luôn kiểm tra)")
+    parser.add_argument("--force-update", action='store_true', help="Bỏ qua cache, luôn kiểm tra cập nhật yt-dlp")
+    parser.add_argument("--rediscover", action='store_true',
+                        help="Bỏ qua cache, dò tìm lại JS runtime, ffmpeg và profile trình duyệt")
+    parser.add_argument("--engine", choices=['exe', 'python'], default='exe',
+                        help="exe: chạy yt-dlp.exe (mặc định); python: dùng thư viện yt_dlp trong tiến trình nếu có")
+    parser.add_argument("--metadata-ttl", type=float, default=DEFAULT_METADATA_TTL_MINUTES,
+                        help="Số phút dùng lại info JSON đã extract cho các lần thử lại (0 = tắt)")
+    parser.add_argument("--cookie-jar-ttl", type=float, default=DEFAULT_COOKIE_JAR_TTL_MINUTES,
+                        help="Số phút dùng lại cookies TikTok/Douyin đã xuất từ trình duyệt (0 = đọc trình duyệt mỗi lần)")
+    parser.add_argument("--race", action='store_true',
+                        help="Chạy song song bước extract của nhiều cấu hình (cookies/client), tải bằng cấu hình thắng")
+    parser.add_argument("--race-workers", type=int, default=3, help="Số cấu hình extract song song tối đa khi --race")
+    parser.add_argument("--race-timeout", type=float, default=60, help="Thời gian tối đa (giây) cho mỗi cấu hình khi --race")
+    parser.add_argument("--limit-rate", default=None,
+                        help="Giới hạn tốc độ tải cho job (vd: 500K, 2M), truyền thẳng cho yt-dlp")
+    parser.add_argument("--resume", action='store_true',
+                        help="Job bị gián đoạn trước đó: tải tiếp từ file .part (--continue)")
+    parser.add_argument("--no-archive", action='store_true',
+                        help="Không dùng download archive dùng chung (tải lại cả video đã tải trước đó)")
+    parser.add_argument("--list-entries", action='store_true',
+                        help="Chỉ liệt kê các video trong playlist/kênh (dòng ENTRY: {json}), không tải")
+    parser.add_argument("--events", choices=['text', 'json'], default='text',
+                        help="text: log dạng chữ (mặc định); json: mỗi dòng stdout là một event JSON")
+    parser.add_argument("--events-rate", type=float, default=5,
+                        help="Số event progress tối đa mỗi giây cho một job khi --events json (0 = không giới hạn)")
+    parser.add_argument("--defer-postprocess", action='store_true',
+                        help="Không merge/chuyển mp3/đổi thumbnail trong job tải; in các bước POSTPROCESS: để app chạy riêng")
+    parser.add_argument("--scratch-dir",
+                        help="Thư mục tạm trên ổ nhanh cho .part/fragment/file trung gian; "
+                             "file hoàn chỉnh mới được chuyển vào --save-path")
+    parser.add_argument("--run-postprocess", metavar='SPEC_JSON',
+                        help="Chạy một bước hậu xử lý (JSON của dòng POSTPROCESS:) rồi thoát")
+    parser.add_argument("--no-parallel-streams", action='store_true',
+                        help="Không tải song song video và audio (để yt-dlp tải lần lượt rồi merge)")
+    parser.add_argument("--concurrent-fragments", default='auto',
+                        help="Số fragment tải song song (HLS/DASH); auto = tự chọn theo lịch sử tốc độ của platform/host")
+    parser.add_argument("--strategy-report", action='store_true',
+                        help="In bảng thống kê thành công/thất bại/độ trễ của các strategy theo platform rồi thoát")
+    parser.add_argument("--worker", action='store_true',
+                        help="Chạy thường trú: nhận job (JSON lines) qua stdin, báo kết quả từng job qua stdout")
+    return parser
+
+
+def validate_job_args(parser, args):
+    required = (('--url', args.url), ('--save-path', args.save_path), ('--resources-path', args.resources_path))
+    if args.run_postprocess:
+        required = required[2:]
+    elif args.url_file:
+        required = required[1:]
+        if args.url:
+            parser.error("chỉ dùng một trong --url hoặc --url-file")
+        if args.batch_size < 1:
+            parser.error("--batch-size phải là số nguyên dương")
+    missing = [flag for flag, value in required if not value]
+    if missing:
+        parser.error(f"thiếu tham số bắt buộc: {', '.join(missing)}")
+    if args.concurrent_fragments != 'auto' and not (args.concurrent_fragments.isdigit()
+                                                    and int(args.concurrent_fragments) > 0):
+        parser.error("--concurrent-fragments phải là 'auto' hoặc số nguyên dương")
+
+
+def run_job_args(args):
+    with job_event_output(args.events, args.events_rate):
+        return _run_job_args(args)
+
+
+def _run_job_args(args):
+    if args.run_postprocess:
+        return run_postprocess(args.run_postprocess, args.resources_path, use_archive=not args.no_archive)
+    if args.list_entries:
+        return list_playlist_entries(args.url, args.resources_path, args.cookies_path, update_ttl=args.update_ttl,
+                                     force_update=args.force_update, rediscover=args.rediscover,
+                                     cookie_jar_ttl=args.cookie_jar_ttl)
+    if args.url_file:
+        return run_batch(args)
+    return _main_from_args(args, args.url)
+
 
+def _main_from_args(args, url, batch_urls=None):
+    return main(
+        url,
+        args.save_path,
+        args.resources_path,
+        args.cookies_path,
+        args.quality,
+        args.thumbnail,
+        args.no_playlist,
+        args.format,
+        args.audio_lang,
+        update_ttl=args.update_ttl,
+        force_update=args.force_update,
+        rediscover=args.rediscover,
+        engine=args.engine,
+        metadata_ttl=args.metadata_ttl,
+        race=args.race,
+        race_workers=args.race_workers,
+        race_timeout=args.race_timeout,
+        limit_rate=args.limit_rate,
+        resume=args.resume,
+        use_archive=not args.no_archive,
+        concurrent_fragments=args.concurrent_fragments,
+        parallel_streams=not args.no_parallel_streams,
+        defer_postprocess=args.defer_postprocess,
+        cookie_jar_ttl=args.cookie_jar_ttl,
+        batch_urls=batch_urls,
+        scratch_dir=args.scratch_dir,
+    )
+
+
+def run_worker(parser):
+    """
+    Chế độ worker thường trú: mỗi dòng stdin là một job JSON {"id": ..., "args": [...]},
+    trong đó args giống hệt tham số dòng lệnh của một lần chạy đơn lẻ.
+    Log của job được in ra như bình thường, kẹp giữa hai dòng điều khiển:
+        JOB_START: {"id": ...}
+        JOB_RESULT: {"id": ..., "exit_code": ..., "duration": ...}
+    Trạng thái đã dò tìm (cập nhật yt-dlp, runtime) được giữ trong bộ nhớ giữa các job.
+    Dòng {"action": "shutdown"} hoặc EOF sẽ kết thúc worker.
+    """
+    # Pipe mặc định được buffer theo block; worker cần đẩy log ra ngay vì tiến trình không kết thúc sau mỗi job
+    sys.stdout.reconfigure(line_buffering=True)
+    print("WORKER_READY", flush=True)
+
+    for raw in sys.stdin:
+        raw = raw.strip()
+        if not raw:
+            continue
+        try:
+            job = json.loads(raw)
+        except ValueError as e:
+            print(f"WORKER_ERROR: Job không hợp lệ: {e}", flush=True)
+            continue
+        if job.get('action') == 'shutdown':
+            break
+
+        job_id = job.get('id')
+        started = time.time()
+        print(f"JOB_START: {json.dumps({'id': job_id})}", flush=True)
+        try:
+            job_args = parser.parse_args([str(a) for a in job.get('args', [])])
+            validate_job_args(parser, job_args)
+            exit_code = run_job_args(job_args)
+        except SystemExit as e:
+            # argparse báo lỗi tham số bằng SystemExit - không được làm chết worker
+            exit_code = e.code if isinstance(e.code, int) else 2
+        except Exception as e:
+            print(f"FATAL_ERROR: {e}", file=sys.stderr, flush=True)
+            exit_code = 1
+        sys.stderr.flush()
+        print(f"JOB_RESULT: {json.dumps({'id': job_id, 'exit_code': exit_code, 'duration': round(time.time() - started, 3)})}",
+              flush=True)
+    return 0
+
+
+if __name__ == '__main__':
+    parser = build_arg_parser()
     args = parser.parse_args()
 
+    if args.worker:
+        sys.exit(run_worker(parser))
+
+    if args.strategy_report:
+        print_strategy_report()
+        sys.exit(0)
+
+    validate_job_args(parser, args)
+
     try:
-        exit_code = main(
-            args.url,
-            args.save_path,
-            args.resources_path,
-            args.cookies_path,
-            args.quality,
-            args.thumbnail,
-            args.no_playlist,
-            args.format,
-            args.audio_lang,
-        )
+        exit_code = run_job_args(args)
         sys.exit(exit_code)
         
     except Exception as e:
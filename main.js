@@ -1,5 +1,8 @@
 const { app, BrowserWindow, ipcMain, dialog } = require('electron');
 const path = require('path');
+const fs = require('fs');
+const os = require('os');
+const http = require('http');
 const { spawn } = require('child_process');
 const { autoUpdater } = require('electron-updater');
 
@@ -8,9 +11,41 @@ let resourcesPath;
 
 // Hàng chờ download
 let downloadQueue = [];
-let isDownloading = false;
-let currentDownloadProcess = null;
-let currentDownloadId = null;
+let nextQueueSeq = 1;
+// Các job đang chạy: id -> { item, proc, worker, lineBuffer }
+const activeDownloads = new Map();
+
+// Worker downloader thường trú (downloader --worker) đang rảnh, dùng lại cho job tiếp theo
+let idleWorkers = [];
+// Bản downloader.exe cũ không hỗ trợ --worker: quay về chạy một tiến trình cho mỗi link
+let workerUnsupported = false;
+
+// Pool hậu xử lý (merge, chuyển mp3, đổi thumbnail sang jpg) tách khỏi các slot tải: job tải xong file gốc là
+// nhả slot cho link tiếp theo, các bước ffmpeg chạy song song tối đa theo số nhân CPU (chừa một nhân cho app)
+const POSTPROCESS_WORKERS = Math.max(1, os.cpus().length - 1);
+// Các bước đang chờ: { itemId, taskId }
+let postprocessQueue = [];
+// Các bước đang chạy: taskId -> { item, task, proc, lineBuffer }
+const activePostprocess = new Map();
+
+// Cấu hình bộ lập lịch tải, lưu trong userData/settings.json
+const DEFAULT_SETTINGS = {
+  maxConcurrent: 3,
+  // Giới hạn số job đồng thời theo platform để tránh bị rate limit
+  platformLimits: { tiktok: 2, douyin: 2 },
+  // Tổng băng thông cho tất cả job (KB/s), 0 = không giới hạn
+  bandwidthLimitKB: 0,
+  // Cổng HTTP (chỉ 127.0.0.1) xuất số liệu OpenMetrics tại /metrics, 0 = tắt
+  metricsPort: 0,
+  // Thư mục tạm trên ổ nhanh: job tải vào đây rồi mới chuyển file hoàn chỉnh sang thư mục lưu, '' = tắt
+  scratchDir: ''
+};
+let settings = { ...DEFAULT_SETTINGS };
+
+// Journal của hàng chờ (userData/queue.jsonl): mỗi dòng là một thay đổi {op:'put',item} hoặc {op:'remove',id},
+// ghi nối tiếp nên app bị tắt/crash giữa chừng cũng không mất hàng chờ
+const QUEUE_JOURNAL_COMPACT_THRESHOLD = 500;
+let queueJournalLines = 0;
 
 function createWindow() {
   mainWindow = new BrowserWindow({
@@ -47,202 +82,1072 @@ ipcMain.handle('dialog:selectCookieFile', async () => {
     return canceled ? null : filePaths[0];
 });
 
-// Thêm download vào hàng chờ
-ipcMain.on('queue:add', (event, downloadItem) => {
+function getSettingsPath() {
+  return path.join(app.getPath('userData'), 'settings.json');
+}
+
+function loadSettings() {
+  try {
+    const saved = JSON.parse(fs.readFileSync(getSettingsPath(), 'utf-8'));
+    settings = {
+      ...DEFAULT_SETTINGS,
+      ...saved,
+      platformLimits: { ...DEFAULT_SETTINGS.platformLimits, ...(saved.platformLimits || {}) }
+    };
+  } catch (e) {
+    settings = { ...DEFAULT_SETTINGS };
+  }
+}
+
+function saveSettings() {
+  try {
+    fs.writeFileSync(getSettingsPath(), JSON.stringify(settings, null, 2));
+  } catch (e) {
+    console.error('Không lưu được settings:', e);
+  }
+}
+
+ipcMain.handle('settings:get', () => settings);
+
+ipcMain.handle('settings:set', (event, patch) => {
+  settings = {
+    ...settings,
+    ...patch,
+    platformLimits: { ...settings.platformLimits, ...((patch && patch.platformLimits) || {}) }
+  };
+  settings.maxConcurrent = Math.max(1, parseInt(settings.maxConcurrent, 10) || 1);
+  settings.bandwidthLimitKB = Math.max(0, parseInt(settings.bandwidthLimitKB, 10) || 0);
+  settings.metricsPort = Math.min(65535, Math.max(0, parseInt(settings.metricsPort, 10) || 0));
+  settings.scratchDir = typeof settings.scratchDir === 'string' ? settings.scratchDir : '';
+  saveSettings();
+  if (patch && 'metricsPort' in patch) {
+    startMetricsServer();
+  }
+  trimIdleWorkers();
+  processNextDownload();
+  return settings;
+});
+
+function getQueueJournalPath() {
+  return path.join(app.getPath('userData'), 'queue.jsonl');
+}
+
+function appendQueueJournal(entry) {
+  try {
+    fs.appendFileSync(getQueueJournalPath(), JSON.stringify(entry) + '\n');
+    queueJournalLines++;
+  } catch (e) {
+    console.error('Không ghi được journal hàng chờ:', e);
+    return;
+  }
+  if (queueJournalLines > QUEUE_JOURNAL_COMPACT_THRESHOLD) {
+    compactQueueJournal();
+  }
+}
+
+// Ghi lại trạng thái hiện tại của item (mỗi lần đổi status)
+function persistQueueItem(item) {
+  appendQueueJournal({ op: 'put', item });
+}
+
+function persistQueueRemove(id) {
+  appendQueueJournal({ op: 'remove', id });
+}
+
+// Viết lại journal chỉ gồm các item còn trong hàng chờ (ghi file tạm rồi rename để không hỏng file cũ)
+function compactQueueJournal() {
+  const journalPath = getQueueJournalPath();
+  const tmpPath = journalPath + '.tmp';
+  try {
+    fs.writeFileSync(tmpPath, downloadQueue.map(item => JSON.stringify({ op: 'put', item }) + '\n').join(''));
+    fs.renameSync(tmpPath, journalPath);
+    queueJournalLines = downloadQueue.length;
+  } catch (e) {
+    console.error('Không compact được journal hàng chờ:', e);
+  }
+}
+
+// Đọc lại hàng chờ từ journal khi khởi động. Item đang tải dở khi app tắt được đưa về pending
+// và tải tiếp (--resume) để dùng lại file .part đã có.
+function loadQueueJournal() {
+  let content = '';
+  try {
+    content = fs.readFileSync(getQueueJournalPath(), 'utf-8');
+  } catch (e) {
+    return;
+  }
+  const items = new Map();
+  for (const line of content.split('\n')) {
+    if (!line.trim()) continue;
+    let entry;
+    try {
+      entry = JSON.parse(line);
+    } catch (e) {
+      // Dòng cuối có thể bị ghi dở nếu app crash: bỏ qua
+      continue;
+    }
+    if (entry.op === 'put' && entry.item) {
+      items.set(entry.item.id, entry.item);
+    } else if (entry.op === 'remove') {
+      items.delete(entry.id);
+    }
+  }
+  downloadQueue = [...items.values()].sort((a, b) => (a.seq || 0) - (b.seq || 0));
+  for (const item of downloadQueue) {
+    // Playlist đã tách xong: trạng thái được tổng hợp từ các video con, không chạy lại
+    if (item.status === 'downloading' && !item.listed) {
+      item.status = 'pending';
+      item.resume = true;
+    }
+    // Thời gian chờ trong hàng tính từ lúc mở lại app, không tính lúc app đang tắt
+    if (item.status === 'pending') {
+      item.queuedAt = new Date().toISOString();
+    }
+    // Đang hậu xử lý dở: file gốc đã tải xong, chỉ cần chạy lại các bước chưa xong
+    if (item.status === 'postprocessing') {
+      (item.postprocess || []).forEach((task) => {
+        if (task.status === 'running') task.status = 'pending';
+      });
+      enqueuePostprocess(item, false);
+    }
+  }
+  nextQueueSeq = downloadQueue.reduce((max, item) => Math.max(max, item.seq || 0), 0) + 1;
+  compactQueueJournal();
+}
+
+// Giống detect_platform() trong downloader.py
+function detectPlatform(url) {
+  const u = (url || '').toLowerCase();
+  if (u.includes('youtube.com') || u.includes('youtu.be')) return 'youtube';
+  if (u.includes('tiktok.com')) return 'tiktok';
+  if (u.includes('douyin.com') || u.includes('iesdouyin.com')) return 'douyin';
+  if (u.includes('instagram.com')) return 'instagram';
+  if (u.includes('twitter.com') || u.includes('x.com')) return 'twitter';
+  if (u.includes('facebook.com') || u.includes('fb.watch')) return 'facebook';
+  if (u.includes('bilibili.com')) return 'bilibili';
+  if (u.includes('vimeo.com')) return 'vimeo';
+  return 'generic';
+}
+
+function addToQueue(downloadItem) {
   const id = Date.now() + Math.random();
   const queueItem = {
     id,
+    seq: nextQueueSeq++,
     ...downloadItem,
-    status: 'pending', // pending, downloading, completed, failed
-    addedAt: new Date().toISOString()
+    platform: detectPlatform(downloadItem.url),
+    status: 'pending', // pending, downloading, postprocessing, completed, failed
+    // Playlist/kênh: trước hết liệt kê các video (--list-entries) rồi tách thành từng job riêng
+    fanout: !downloadItem.ignorePlaylist && !downloadItem.parentId,
+    addedAt: new Date().toISOString(),
+    // Thời gian từng lần tải (dùng cho thống kê)
+    attempts: []
   };
   downloadQueue.push(queueItem);
+  persistQueueItem(queueItem);
   updateQueueStatus();
-  
-  // Nếu chưa đang download, bắt đầu download ngay
-  if (!isDownloading) {
-    processNextDownload();
+  processNextDownload();
+}
+
+function getChildItems(parentId) {
+  return downloadQueue.filter(item => item.parentId === parentId);
+}
+
+// Thêm một video con (dòng ENTRY: của job liệt kê playlist) ngay sau các video con trước đó của playlist
+function addPlaylistEntry(parent, entry) {
+  const children = getChildItems(parent.id);
+  if (children.some(child => child.url === entry.url)) {
+    return; // Đã có từ lần liệt kê trước (app bị tắt giữa chừng)
+  }
+  const child = {
+    id: Date.now() + Math.random(),
+    seq: nextQueueSeq++,
+    url: entry.url,
+    title: entry.title || null,
+    savePath: parent.savePath,
+    quality: parent.quality,
+    downloadFormat: parent.downloadFormat,
+    downloadThumbnail: parent.downloadThumbnail,
+    cookiesPath: parent.cookiesPath,
+    audioLang: parent.audioLang,
+    ignorePlaylist: true,
+    parentId: parent.id,
+    platform: detectPlatform(entry.url),
+    // Đã có trong download archive: không cần tạo job tải
+    status: entry.archived ? 'completed' : 'pending',
+    skipped: !!entry.archived,
+    addedAt: new Date().toISOString(),
+    attempts: []
+  };
+  const anchor = children.length > 0 ? children[children.length - 1] : parent;
+  downloadQueue.splice(downloadQueue.indexOf(anchor) + 1, 0, child);
+  persistQueueItem(child);
+  updatePlaylistProgress(parent);
+}
+
+// Tổng hợp tiến độ playlist (done/total) từ các video con
+function updatePlaylistProgress(parent) {
+  const children = getChildItems(parent.id);
+  parent.total = children.length;
+  parent.done = children.filter(child => child.status === 'completed').length;
+  parent.failedCount = children.filter(child => child.status === 'failed').length;
+  const running = children.some(child => ['pending', 'downloading', 'postprocessing'].includes(child.status));
+  if (parent.listed && !running && !activeDownloads.has(parent.id)) {
+    const previousStatus = parent.status;
+    parent.status = parent.failedCount > 0 ? 'failed' : 'completed';
+    if (parent.status === 'completed' && previousStatus !== 'completed') {
+      mainWindow.webContents.send('download_finished', { id: parent.id });
+    }
   }
+  persistQueueItem(parent);
+  updateQueueStatus();
+}
+
+// Thêm download vào hàng chờ
+ipcMain.on('queue:add', (event, downloadItem) => {
+  addToQueue(downloadItem);
 });
 
+// Dừng một job đang chạy (worker của job đó bị dừng, worker mới sẽ được tạo khi cần)
+function cancelActiveDownload(id) {
+  const active = activeDownloads.get(id);
+  if (!active) {
+    return;
+  }
+  activeDownloads.delete(id);
+  if (active.worker) {
+    active.worker.jobId = null;
+  }
+  killProcessTree(active.proc);
+}
+
+// Dừng và bỏ các bước hậu xử lý của một item
+function cancelPostprocess(itemId) {
+  postprocessQueue = postprocessQueue.filter(entry => entry.itemId !== itemId);
+  for (const [taskId, active] of [...activePostprocess.entries()]) {
+    if (active.item.id === itemId) {
+      activePostprocess.delete(taskId);
+      killProcessTree(active.proc);
+    }
+  }
+}
+
 // Xóa download khỏi hàng chờ
 ipcMain.on('queue:remove', (event, id) => {
   const index = downloadQueue.findIndex(item => item.id === id);
   if (index !== -1) {
-    // Nếu đang download item này, dừng nó
-    if (currentDownloadId === id && currentDownloadProcess) {
-      currentDownloadProcess.kill();
-      currentDownloadProcess = null;
-      currentDownloadId = null;
-      isDownloading = false;
-    }
-    downloadQueue.splice(index, 1);
-    updateQueueStatus();
-    
-    // Nếu không đang download, bắt đầu download tiếp theo
-    if (!isDownloading) {
-      processNextDownload();
+    const item = downloadQueue[index];
+    // Nếu đang download item này (hoặc video con của playlist này), dừng nó
+    for (const target of [item, ...getChildItems(id)]) {
+      cancelActiveDownload(target.id);
+      cancelPostprocess(target.id);
+      downloadQueue.splice(downloadQueue.indexOf(target), 1);
+      persistQueueRemove(target.id);
+    }
+    const parent = item.parentId && downloadQueue.find(p => p.id === item.parentId);
+    if (parent) {
+      updatePlaylistProgress(parent);
     }
+    updateQueueStatus();
+    processNextDownload();
   }
 });
 
+// Đặt lại một item bị lỗi: nếu file đã tải xong và chỉ lỗi ở bước hậu xử lý thì chỉ chạy lại các bước đó
+function retryItem(item) {
+  const failedTasks = (item.postprocess || []).filter(task => task.status === 'failed');
+  if (failedTasks.length > 0) {
+    failedTasks.forEach((task) => {
+      task.status = 'pending';
+    });
+    item.status = 'postprocessing';
+    persistQueueItem(item);
+    enqueuePostprocess(item);
+    return;
+  }
+  item.status = 'pending';
+  item.queuedAt = new Date().toISOString();
+  persistQueueItem(item);
+}
+
 // Retry download (đặt lại status thành pending)
 ipcMain.on('queue:retry', (event, id) => {
   const item = downloadQueue.find(item => item.id === id);
   if (item && item.status === 'failed') {
-    item.status = 'pending';
-    updateQueueStatus();
-    
-    // Nếu không đang download, bắt đầu download ngay
-    if (!isDownloading) {
-      processNextDownload();
+    if (item.listed) {
+      // Playlist: chỉ tải lại các video con bị lỗi
+      item.status = 'downloading';
+      getChildItems(id).filter(child => child.status === 'failed').forEach((child) => {
+        retryItem(child);
+      });
+      updatePlaylistProgress(item);
+    } else {
+      retryItem(item);
+      const parent = item.parentId && downloadQueue.find(p => p.id === item.parentId);
+      if (parent) {
+        parent.status = 'downloading';
+        updatePlaylistProgress(parent);
+      }
     }
+    updateQueueStatus();
+    processNextDownload();
   }
 });
 
 // Xóa các download đã hoàn thành/thất bại khỏi hàng chờ,
 // giữ lại các video đang chờ hoặc đang tải
 ipcMain.on('queue:clear', () => {
-  downloadQueue = downloadQueue.filter(item => item.status === 'pending' || item.status === 'downloading');
+  const isRunning = item => item && ['pending', 'downloading', 'postprocessing'].includes(item.status);
+  // Video con của playlist chưa xong được giữ lại để tiến độ done/total không bị sai
+  const runningParents = new Set(downloadQueue.filter(isRunning).map(item => item.id));
+  downloadQueue = downloadQueue.filter(item => isRunning(item) || runningParents.has(item.parentId));
+  compactQueueJournal();
 
-  // Nếu currentDownloadId không còn trong queue (trường hợp hiếm), reset trạng thái
-  const hasCurrent = downloadQueue.some(item => item.id === currentDownloadId);
-  if (!hasCurrent) {
-    currentDownloadId = null;
-    isDownloading = false;
+  // Job đang chạy nhưng không còn trong queue (trường hợp hiếm): dừng lại
+  for (const id of [...activeDownloads.keys()]) {
+    if (!downloadQueue.some(item => item.id === id)) {
+      cancelActiveDownload(id);
+    }
   }
 
   updateQueueStatus();
+  processNextDownload();
 });
 
-// Lấy trạng thái hàng chờ
-ipcMain.handle('queue:getStatus', () => {
+function getQueueStatus() {
+  const activeDownloadIds = [...activeDownloads.keys()];
   return {
     queue: downloadQueue,
-    isDownloading,
-    currentDownloadId
+    isDownloading: activeDownloadIds.length > 0,
+    // Giữ trường cũ cho tương thích: job đang chạy đầu tiên
+    currentDownloadId: activeDownloadIds.length > 0 ? activeDownloadIds[0] : null,
+    activeDownloadIds,
+    maxConcurrent: settings.maxConcurrent,
+    // Item đang có bước hậu xử lý chạy (pool riêng, không chiếm slot tải)
+    activePostprocessIds: [...new Set([...activePostprocess.values()].map(active => active.item.id))],
+    postprocessWorkers: POSTPROCESS_WORKERS
   };
+}
+
+// Lấy trạng thái hàng chờ
+ipcMain.handle('queue:getStatus', () => {
+  return getQueueStatus();
 });
 
-// Xử lý download tiếp theo trong hàng chờ
-function processNextDownload() {
-  if (isDownloading || downloadQueue.length === 0) {
-    return;
+// Lệnh chạy downloader. Trong chế độ dev (npm start), chạy trực tiếp downloader.py bằng Python
+// để luôn dùng phiên bản mã nguồn mới nhất mà không cần build lại downloader.exe.
+function getDownloaderSpawn(args) {
+  if (!app.isPackaged) {
+    const pythonCmd = process.platform === 'win32' ? 'python' : 'python3';
+    return {
+      command: pythonCmd,
+      args: [path.join(__dirname, 'downloader.py'), ...args],
+      options: { cwd: __dirname }
+    };
   }
+  return {
+    command: path.join(resourcesPath, 'downloader.exe'),
+    args,
+    options: {}
+  };
+}
 
-  const nextItem = downloadQueue.find(item => item.status === 'pending');
-  if (!nextItem) {
+// Dừng tiến trình cùng các tiến trình con (yt-dlp.exe, ffmpeg.exe) do downloader sinh ra
+function killProcessTree(proc) {
+  if (!proc || proc.exitCode !== null) {
     return;
   }
+  if (process.platform === 'win32') {
+    spawn('taskkill', ['/pid', String(proc.pid), '/T', '/F']);
+  } else {
+    proc.kill();
+  }
+}
 
-  isDownloading = true;
-  currentDownloadId = nextItem.id;
-  nextItem.status = 'downloading';
-  updateQueueStatus();
+function sendLog(data) {
+  if (mainWindow && !mainWindow.isDestroyed()) {
+    mainWindow.webContents.send('download:log', data.toString());
+  }
+}
 
-  // Xóa log cũ và bắt đầu log mới
-  mainWindow.webContents.send('download:clearLog');
-  mainWindow.webContents.send('download:log', `========== Bắt đầu tải: ${nextItem.url} ==========\n`);
+function sendProgress(data) {
+  if (mainWindow && !mainWindow.isDestroyed()) {
+    mainWindow.webContents.send('download:progress', data);
+  }
+}
+
+// Xử lý một event JSON của downloader (--events json). Trả về dòng cần in ra log (hoặc null).
+function handleJobEvent(item, event) {
+  switch (event.event) {
+    case 'log':
+      return event.message;
+    case 'status':
+      return `STATUS: ${event.message}`;
+    case 'progress':
+      sendProgress({ id: item.id, phase: item.phase, ...event });
+      return null;
+    case 'phase':
+      item.phase = event.phase;
+      sendProgress({ id: item.id, phase: event.phase });
+      return null;
+    case 'entry':
+      addPlaylistEntry(item, event);
+      return null;
+    case 'postprocess':
+      addPostprocessTask(item, event.spec);
+      return null;
+    case 'metric':
+      recordJobMetric(item, event);
+      return null;
+    case 'metric_summary':
+      // Bản tổng kết thời gian từng pha của job tải, giữ lại số liệu phía app (chờ hàng, khởi động tiến trình)
+      item.metrics = { ...item.metrics, ...event };
+      delete item.metrics.event;
+      return null;
+    case 'error':
+      item.errorClass = event.error_class;
+      return null;
+    case 'result':
+      item.result = event;
+      return null;
+    default:
+      return null;
+  }
+}
+
+// Thời gian một pha của job (METRIC: của downloader). Pha của bước hậu xử lý chạy sau job tải
+// được cộng thêm vào tổng kết đã có của item.
+function recordJobMetric(item, metric) {
+  if (!item.metrics) item.metrics = {};
+  const { event, ...phase } = metric;
+  item.metrics.phases = [...(item.metrics.phases || []), phase];
+  if (phase.phase.startsWith('postprocess:')) {
+    const totals = item.metrics.totals || {};
+    totals.postprocess = Math.round(((totals.postprocess || 0) + phase.seconds) * 1000) / 1000;
+    item.metrics.totals = totals;
+  }
+}
+
+// Log của từng job: khi có thể chạy nhiều job cùng lúc, mỗi dòng được gắn nhãn [#số thứ tự].
+// Downloader chạy với --events json: mỗi dòng là một event; dòng không phải JSON (downloader cũ,
+// lỗi Python...) được in nguyên văn. Dòng ENTRY: (job liệt kê playlist) được tách thành video con.
+function sendJobLog(id, text) {
+  const active = activeDownloads.get(id);
+  if (active) {
+    appendJobOutput(active, text);
+  }
+}
+
+// Tách output (job tải hoặc bước hậu xử lý) thành từng dòng, xử lý event và gửi log cho renderer
+function appendJobOutput(active, text) {
+  active.lineBuffer += text;
+  const lines = active.lineBuffer.split('\n');
+  active.lineBuffer = lines.pop();
+  const logLines = [];
+  for (let line of lines) {
+    if (line.startsWith('{')) {
+      try {
+        line = handleJobEvent(active.item, JSON.parse(line));
+      } catch (e) {
+        // Không phải event: in nguyên văn
+      }
+      if (line === null) continue;
+    } else if (line.startsWith('ENTRY:')) {
+      try {
+        addPlaylistEntry(active.item, JSON.parse(line.slice('ENTRY:'.length)));
+        continue;
+      } catch (e) {
+        // In nguyên văn
+      }
+    } else if (line.startsWith('POSTPROCESS:')) {
+      try {
+        addPostprocessTask(active.item, JSON.parse(line.slice('POSTPROCESS:'.length)));
+        continue;
+      } catch (e) {
+        // In nguyên văn
+      }
+    }
+    logLines.push(settings.maxConcurrent <= 1 ? line : `[#${active.item.seq}] ${line}`);
+  }
+  if (logLines.length > 0) {
+    sendLog(logLines.join('\n') + '\n');
+  }
+}
 
-  const downloaderExe = path.join(resourcesPath, 'downloader.exe');
-  const baseArgs = [
-      '--url', nextItem.url,
-      '--save-path', nextItem.savePath,
+// Chia đều tổng băng thông cho số job tối đa chạy đồng thời
+function getPerJobRateLimitKB() {
+  if (!settings.bandwidthLimitKB) {
+    return 0;
+  }
+  return Math.max(1, Math.floor(settings.bandwidthLimitKB / settings.maxConcurrent));
+}
+
+function buildDownloaderArgs(item) {
+  const args = [
+      '--url', item.url,
+      '--save-path', item.savePath,
       '--resources-path', resourcesPath,
-      '--quality', nextItem.quality,
-      '--format', nextItem.downloadFormat
+      '--quality', item.quality,
+      '--format', item.downloadFormat,
+      '--events', 'json',
+      // Merge/chuyển mp3/đổi thumbnail do pool hậu xử lý chạy riêng (xem POSTPROCESS_WORKERS)
+      '--defer-postprocess'
   ];
-  if (nextItem.downloadThumbnail) baseArgs.push('--thumbnail');
-  if (nextItem.ignorePlaylist) baseArgs.push('--no-playlist');
-  if (nextItem.cookiesPath) baseArgs.push('--cookies-path', nextItem.cookiesPath);
-  if (nextItem.audioLang && nextItem.audioLang !== 'auto') {
-    baseArgs.push('--audio-lang', nextItem.audioLang);
+  if (item.downloadThumbnail) args.push('--thumbnail');
+  if (item.ignorePlaylist) args.push('--no-playlist');
+  if (item.cookiesPath) args.push('--cookies-path', item.cookiesPath);
+  if (item.audioLang && item.audioLang !== 'auto') {
+    args.push('--audio-lang', item.audioLang);
   }
+  if (item.rateLimitKB) args.push('--limit-rate', `${item.rateLimitKB}K`);
+  if (item.resume) args.push('--resume');
+  if (settings.scratchDir) args.push('--scratch-dir', settings.scratchDir);
+  if (item.fanout && !item.listed) args.push('--list-entries');
+  return args;
+}
 
-  // Trong chế độ dev (npm start), chạy trực tiếp downloader.py bằng Python
-  // để luôn dùng phiên bản mã nguồn mới nhất mà không cần build lại downloader.exe.
-  let command;
-  let args;
-  let spawnOptions = {};
+// Xử lý một dòng stdout của worker: dòng điều khiển JOB_* hoặc log của job đang chạy
+function handleWorkerLine(worker, line) {
+  line = line.replace(/\r$/, '');
+  if (line === 'WORKER_READY') {
+    worker.ready = true;
+    if (worker.jobId !== null) {
+      recordProcessStartup(worker.jobId, Date.now() - worker.spawnedAt);
+    }
+    return;
+  }
+  if (line.startsWith('JOB_START:')) {
+    return;
+  }
+  if (line.startsWith('JOB_RESULT:')) {
+    let result = {};
+    try {
+      result = JSON.parse(line.slice('JOB_RESULT:'.length));
+    } catch (e) {
+      result = { id: worker.jobId, exit_code: 1 };
+    }
+    if (worker.jobId !== null && result.id === worker.jobId) {
+      worker.jobId = null;
+      releaseWorker(worker);
+      finishDownload(result.id, result.exit_code);
+    }
+    return;
+  }
+  if (worker.jobId !== null) {
+    sendJobLog(worker.jobId, line + '\n');
+  }
+}
 
-  if (!app.isPackaged) {
-    const pythonCmd = process.platform === 'win32' ? 'python' : 'python3';
-    command = pythonCmd;
-    args = [path.join(__dirname, 'downloader.py'), ...baseArgs];
-    spawnOptions = { cwd: __dirname };
+function startDownloaderWorker() {
+  const { command, args, options } = getDownloaderSpawn(['--worker']);
+  const proc = spawn(command, args, options);
+  const worker = { proc, ready: false, jobId: null, job: null, stdoutBuffer: '', spawnedAt: Date.now() };
+
+  proc.stdout.on('data', (data) => {
+    worker.stdoutBuffer += data.toString();
+    const lines = worker.stdoutBuffer.split('\n');
+    worker.stdoutBuffer = lines.pop();
+    lines.forEach((line) => handleWorkerLine(worker, line));
+  });
+  proc.stderr.on('data', (data) => {
+    if (worker.jobId !== null) {
+      sendJobLog(worker.jobId, data.toString());
+    }
+  });
+  // Tránh crash main process nếu worker chết khi đang ghi job vào stdin
+  proc.stdin.on('error', () => {});
+
+  proc.on('close', (code) => {
+    idleWorkers = idleWorkers.filter(w => w !== worker);
+    if (worker.jobId === null) {
+      return;
+    }
+    const jobId = worker.jobId;
+    worker.jobId = null;
+    if (!worker.ready) {
+      // Worker không khởi động được (downloader cũ không có --worker): chạy lại job theo cách cũ
+      workerUnsupported = true;
+      idleWorkers.forEach(w => killProcessTree(w.proc));
+      idleWorkers = [];
+      runDownloadProcess(worker.job);
+    } else {
+      finishDownload(jobId, code === null ? 1 : code);
+    }
+  });
+
+  return worker;
+}
+
+// Trả worker về pool sau khi xong job
+function releaseWorker(worker) {
+  if (worker.proc.exitCode === null) {
+    idleWorkers.push(worker);
+  }
+  trimIdleWorkers();
+}
+
+// Không giữ nhiều worker rảnh hơn số job đồng thời tối đa
+function trimIdleWorkers() {
+  while (idleWorkers.length > settings.maxConcurrent) {
+    const worker = idleWorkers.shift();
+    try {
+      worker.proc.stdin.write(JSON.stringify({ action: 'shutdown' }) + '\n');
+    } catch (e) {
+      killProcessTree(worker.proc);
+    }
+  }
+}
+
+// Gửi job cho một worker thường trú rảnh (hoặc tạo worker mới)
+function runDownloadInWorker(item) {
+  const worker = idleWorkers.pop() || startDownloaderWorker();
+  if (worker.ready) {
+    recordProcessStartup(item.id, 0); // Worker thường trú đã sẵn sàng: không tốn thời gian khởi động
+  }
+  worker.jobId = item.id;
+  worker.job = item;
+  activeDownloads.get(item.id).proc = worker.proc;
+  activeDownloads.get(item.id).worker = worker;
+  worker.proc.stdin.write(JSON.stringify({ id: item.id, args: buildDownloaderArgs(item) }) + '\n');
+}
+
+// Chạy job bằng một tiến trình downloader riêng (cách cũ)
+function runDownloadProcess(item) {
+  const active = activeDownloads.get(item.id);
+  if (!active) {
+    return;
+  }
+  const { command, args, options } = getDownloaderSpawn(buildDownloaderArgs(item));
+  const spawnedAt = Date.now();
+  const proc = spawn(command, args, options);
+  active.proc = proc;
+  active.worker = null;
+
+  proc.stdout.once('data', () => recordProcessStartup(item.id, Date.now() - spawnedAt));
+  proc.stdout.on('data', (data) => sendJobLog(item.id, data.toString()));
+  proc.stderr.on('data', (data) => sendJobLog(item.id, data.toString()));
+
+  proc.on('close', (code) => {
+    const current = activeDownloads.get(item.id);
+    if (current && current.proc === proc) {
+      finishDownload(item.id, code);
+    }
+  });
+}
+
+// Thời gian từ lúc spawn downloader tới khi nó sẵn sàng/in dòng đầu tiên (Python/PyInstaller khởi động, import)
+function recordProcessStartup(id, ms) {
+  const active = activeDownloads.get(id);
+  if (active) {
+    active.item.metrics = { ...active.item.metrics, processStartupMs: ms };
+  }
+}
+
+function countActiveByPlatform(platform) {
+  let count = 0;
+  for (const { item } of activeDownloads.values()) {
+    if (item.platform === platform) count++;
+  }
+  return count;
+}
+
+// Job pending tiếp theo được phép chạy (còn slot theo giới hạn của platform)
+function findNextRunnable() {
+  return downloadQueue.find((item) => {
+    if (item.status !== 'pending') return false;
+    const limit = settings.platformLimits[item.platform];
+    return !limit || countActiveByPlatform(item.platform) < limit;
+  });
+}
+
+// Khởi chạy các job pending cho tới khi hết slot
+function processNextDownload() {
+  while (activeDownloads.size < settings.maxConcurrent) {
+    const nextItem = findNextRunnable();
+    if (!nextItem) {
+      break;
+    }
+    startDownload(nextItem);
+  }
+}
+
+function startDownload(nextItem) {
+  // Xóa log cũ khi bắt đầu một lượt tải mới (không xóa log của các job khác đang chạy)
+  if (activeDownloads.size === 0) {
+    mainWindow.webContents.send('download:clearLog');
+  }
+
+  nextItem.status = 'downloading';
+  nextItem.rateLimitKB = getPerJobRateLimitKB();
+  nextItem.postprocess = [];
+  const startedAt = new Date().toISOString();
+  // Thời gian chờ trong hàng: từ lúc thêm vào (hoặc đặt lại pending) tới lúc có slot chạy
+  const queueWaitMs = Math.max(0, Date.parse(startedAt) - Date.parse(nextItem.queuedAt || nextItem.addedAt));
+  nextItem.metrics = { queueWaitMs };
+  observeHistogram('redbi_queue_wait_seconds', { platform: nextItem.platform || 'generic' }, queueWaitMs / 1000);
+  if (!nextItem.attempts) nextItem.attempts = [];
+  nextItem.attempts.push({ startedAt, resumed: !!nextItem.resume, queueWaitMs });
+  persistQueueItem(nextItem);
+  activeDownloads.set(nextItem.id, { item: nextItem, proc: null, worker: null, lineBuffer: '' });
+  updateQueueStatus();
+
+  const title = nextItem.fanout && !nextItem.listed ? 'Liệt kê playlist' : 'Bắt đầu tải';
+  sendJobLog(nextItem.id, `========== ${title}: ${nextItem.url} ==========\n`);
+
+  if (workerUnsupported) {
+    runDownloadProcess(nextItem);
   } else {
-    command = downloaderExe;
-    args = baseArgs;
-    spawnOptions = {};
+    runDownloadInWorker(nextItem);
   }
+}
 
-  currentDownloadProcess = spawn(command, args, spawnOptions);
-  const sendLog = (data) => {
-    mainWindow.webContents.send('download:log', data.toString());
-  };
-  
-  currentDownloadProcess.stdout.on('data', sendLog);
-  currentDownloadProcess.stderr.on('data', sendLog);
-
-  currentDownloadProcess.on('close', (code) => {
-    sendLog(`\n--- Tiến trình kết thúc với mã ${code} ---\n`);
-    
-    // Cập nhật trạng thái
-    const item = downloadQueue.find(item => item.id === currentDownloadId);
-    if (item) {
-      if (code === 0) {
-        item.status = 'completed';
-        mainWindow.webContents.send('download_finished', { id: currentDownloadId });
+// Kết thúc một job (từ worker hoặc tiến trình riêng) và chuyển sang job tiếp theo
+function finishDownload(id, code) {
+  const active = activeDownloads.get(id);
+  if (active) {
+    sendJobLog(id, `${active.lineBuffer ? '\n' : ''}\n--- Tiến trình kết thúc với mã ${code} ---\n`);
+    activeDownloads.delete(id);
+  }
+
+  // Cập nhật trạng thái
+  const item = downloadQueue.find(item => item.id === id);
+  const listing = !!(item && item.fanout && !item.listed);
+  if (listing) {
+    // Kết thúc bước liệt kê playlist
+    if (getChildItems(id).length > 0) {
+      item.listed = true;
+      item.status = 'downloading';
+    } else {
+      // Không phải playlist hoặc không liệt kê được: tải cả URL như cũ bằng một job
+      item.fanout = false;
+      item.status = 'pending';
+      item.queuedAt = new Date().toISOString();
+    }
+  } else if (item) {
+    if (code === 0 && item.postprocess && item.postprocess.length > 0) {
+      // Đã tải xong file gốc: slot tải được nhả ngay, các bước ffmpeg chạy trong pool hậu xử lý
+      item.status = 'postprocessing';
+      enqueuePostprocess(item);
+    } else if (code === 0) {
+      item.status = 'completed';
+      // Video con của playlist: chỉ thông báo khi cả playlist xong
+      if (!item.parentId) {
+        mainWindow.webContents.send('download_finished', { id });
+      }
+    } else {
+      item.status = 'failed';
+    }
+  }
+  if (item) {
+    const attempt = item.attempts && item.attempts[item.attempts.length - 1];
+    if (attempt && !attempt.finishedAt) {
+      attempt.finishedAt = new Date().toISOString();
+      attempt.durationMs = Date.parse(attempt.finishedAt) - Date.parse(attempt.startedAt);
+      attempt.exitCode = code;
+    }
+    if (!listing) {
+      recordDownloadMetrics(item);
+      if (item.status === 'completed' || item.status === 'failed') {
+        recordJobOutcome(item);
+      }
+    }
+    item.resume = false;
+    persistQueueItem(item);
+    const parent = item.listed ? item : downloadQueue.find(p => p.id === item.parentId);
+    if (parent) {
+      updatePlaylistProgress(parent);
+    }
+    updateQueueStatus(); // Cập nhật UI ngay lập tức
+  }
+
+  // Xử lý download tiếp theo (skip các item failed)
+  processNextDownload();
+}
+
+// Bước hậu xử lý (dòng POSTPROCESS: của job tải) được gắn vào item, chạy sau khi job tải kết thúc
+function addPostprocessTask(item, spec) {
+  if (!item.postprocess) item.postprocess = [];
+  item.postprocess.push({ id: `${item.id}-${item.postprocess.length}`, spec, status: 'pending' });
+}
+
+function enqueuePostprocess(item, start = true) {
+  for (const task of item.postprocess || []) {
+    if (task.status === 'pending' && !postprocessQueue.some(entry => entry.taskId === task.id)) {
+      postprocessQueue.push({ itemId: item.id, taskId: task.id });
+    }
+  }
+  if (start) {
+    processPostprocessQueue();
+  }
+}
+
+// Chạy các bước hậu xử lý đang chờ cho tới khi hết worker
+function processPostprocessQueue() {
+  while (activePostprocess.size < POSTPROCESS_WORKERS && postprocessQueue.length > 0) {
+    const { itemId, taskId } = postprocessQueue.shift();
+    const item = downloadQueue.find(i => i.id === itemId);
+    const task = item && (item.postprocess || []).find(t => t.id === taskId);
+    if (task && task.status === 'pending') {
+      startPostprocess(item, task);
+    }
+  }
+}
+
+function startPostprocess(item, task) {
+  task.status = 'running';
+  persistQueueItem(item);
+  const { command, args, options } = getDownloaderSpawn([
+    '--run-postprocess', JSON.stringify(task.spec),
+    '--resources-path', resourcesPath,
+    '--events', 'json'
+  ]);
+  const proc = spawn(command, args, options);
+  const active = { item, task, proc, lineBuffer: '', startedAt: Date.now() };
+  activePostprocess.set(task.id, active);
+  updateQueueStatus();
+
+  proc.stdout.on('data', (data) => appendJobOutput(active, data.toString()));
+  proc.stderr.on('data', (data) => appendJobOutput(active, data.toString()));
+
+  proc.on('close', (code) => {
+    if (activePostprocess.get(task.id) !== active) {
+      return; // Đã bị hủy (item bị xóa hoặc app đang thoát)
+    }
+    activePostprocess.delete(task.id);
+    if (active.lineBuffer) {
+      appendJobOutput(active, '\n');
+    }
+    task.status = code === 0 ? 'completed' : 'failed';
+    incCounter('redbi_postprocess_tasks', { kind: task.spec.kind, result: code === 0 ? 'success' : 'failure' });
+    incCounter('redbi_phase_seconds', { platform: item.platform || 'generic', phase: 'postprocess' },
+      (Date.now() - active.startedAt) / 1000);
+    finishPostprocess(item);
+    processPostprocessQueue();
+  });
+}
+
+// Khi mọi bước hậu xử lý của item đã chạy xong: chốt trạng thái cuối cùng của item
+function finishPostprocess(item) {
+  if (!downloadQueue.includes(item)) {
+    return;
+  }
+  const tasks = item.postprocess || [];
+  if (item.status !== 'postprocessing' || tasks.some(t => t.status === 'pending' || t.status === 'running')) {
+    persistQueueItem(item);
+    updateQueueStatus();
+    return;
+  }
+  // Đổi thumbnail sang jpg thất bại không làm hỏng file chính (vẫn còn thumbnail gốc)
+  item.status = tasks.some(t => t.status === 'failed' && t.spec.kind !== 'thumbnail') ? 'failed' : 'completed';
+  recordJobOutcome(item);
+  if (item.status === 'completed' && !item.parentId) {
+    mainWindow.webContents.send('download_finished', { id: item.id });
+  }
+  persistQueueItem(item);
+  const parent = downloadQueue.find(p => p.id === item.parentId);
+  if (parent) {
+    updatePlaylistProgress(parent);
+  }
+  updateQueueStatus();
+}
+
+// Số liệu tổng hợp (định dạng OpenMetrics) để vẽ biểu đồ thông lượng và phát hiện platform bị lỗi hàng loạt.
+// Bộ đếm/histogram được cập nhật từ kết quả từng job (tổng kết METRIC_SUMMARY của downloader), xuất qua
+// http://127.0.0.1:<settings.metricsPort>/metrics và ghi định kỳ ra userData/metrics.prom.
+// Giá trị chỉ nằm trong bộ nhớ: bộ đếm về 0 khi mở lại app (Prometheus tự xử lý counter reset).
+const METRICS_FILE_INTERVAL_MS = 15000;
+const OPENMETRICS_CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8';
+const METRIC_DEFS = {
+  redbi_jobs: { type: 'counter', help: 'Job tải đã kết thúc theo platform và kết quả cuối cùng (sau hậu xử lý)' },
+  redbi_download_bytes: { type: 'counter', help: 'Dung lượng đã tải (byte) theo platform' },
+  redbi_download_seconds: { type: 'counter', help: 'Thời gian chạy các lần thử tải (giây) theo platform' },
+  redbi_attempts: { type: 'counter', help: 'Số lần chạy yt-dlp để tải theo platform, strategy và kết quả' },
+  redbi_fallback_attempts: { type: 'counter', help: 'Số lần thử lại bằng strategy khác sau lần thử đầu tiên' },
+  redbi_phase_seconds: { type: 'counter', help: 'Tổng thời gian (giây) theo pha của job: update, runtime, cookies, extract, attempt...' },
+  redbi_postprocess_tasks: { type: 'counter', help: 'Bước hậu xử lý đã kết thúc theo loại và kết quả' },
+  redbi_job_duration_seconds: {
+    type: 'histogram', help: 'Thời gian chạy một job tải (giây)', buckets: [1, 2, 5, 10, 30, 60, 120, 300, 600, 1800]
+  },
+  redbi_queue_wait_seconds: {
+    type: 'histogram', help: 'Thời gian chờ trong hàng trước khi job được chạy (giây)',
+    buckets: [0.1, 1, 5, 15, 60, 300, 900, 3600]
+  },
+  redbi_queue_items: { type: 'gauge', help: 'Số item trong hàng chờ theo trạng thái (không tính playlist đã tách)' },
+  redbi_queue_oldest_wait_seconds: { type: 'gauge', help: 'Thời gian chờ của item pending lâu nhất (giây)' },
+  redbi_active_downloads: { type: 'gauge', help: 'Số job tải đang chạy' },
+  redbi_postprocess_queue: { type: 'gauge', help: 'Số bước hậu xử lý đang chờ' }
+};
+// `${tên}{labels}` -> { name, labels, value } (counter) hoặc { name, labels, counts, sum, count } (histogram)
+const metricValues = new Map();
+let metricsServer = null;
+
+function formatMetricLabels(labels) {
+  const entries = Object.entries(labels);
+  if (entries.length === 0) return '';
+  const escape = value => String(value).replace(/\\/g, '\\\\').replace(/"/g, '\\"').replace(/\n/g, '\\n');
+  return `{${entries.map(([key, value]) => `${key}="${escape(value)}"`).join(',')}}`;
+}
+
+// Cộng dồn số thực sinh sai số (1.3649999999999998): làm tròn 6 chữ số thập phân khi xuất
+function formatMetricValue(value) {
+  return String(Math.round(value * 1e6) / 1e6);
+}
+
+function incCounter(name, labels, value = 1) {
+  if (!(value > 0)) return;
+  const key = name + formatMetricLabels(labels);
+  const entry = metricValues.get(key) || { name, labels, value: 0 };
+  entry.value += value;
+  metricValues.set(key, entry);
+}
+
+function observeHistogram(name, labels, value) {
+  const { buckets } = METRIC_DEFS[name];
+  const key = name + formatMetricLabels(labels);
+  const entry = metricValues.get(key) || { name, labels, counts: buckets.map(() => 0), sum: 0, count: 0 };
+  buckets.forEach((le, index) => {
+    if (value <= le) entry.counts[index]++;
+  });
+  entry.sum += value;
+  entry.count++;
+  metricValues.set(key, entry);
+}
+
+// Gauge được tính lúc xuất từ trạng thái hàng chờ hiện tại
+function collectGauges() {
+  const gauges = [];
+  const jobs = downloadQueue.filter(item => !item.listed);
+  for (const status of ['pending', 'downloading', 'postprocessing', 'completed', 'failed']) {
+    gauges.push({ name: 'redbi_queue_items', labels: { status }, value: jobs.filter(item => item.status === status).length });
+  }
+  const now = Date.now();
+  const oldestWaitMs = jobs
+    .filter(item => item.status === 'pending')
+    .reduce((max, item) => Math.max(max, now - Date.parse(item.queuedAt || item.addedAt)), 0);
+  gauges.push({ name: 'redbi_queue_oldest_wait_seconds', labels: {}, value: oldestWaitMs / 1000 });
+  gauges.push({ name: 'redbi_active_downloads', labels: {}, value: activeDownloads.size });
+  gauges.push({ name: 'redbi_postprocess_queue', labels: {}, value: postprocessQueue.length });
+  return gauges;
+}
+
+function renderOpenMetrics() {
+  const entries = [...metricValues.values(), ...collectGauges()];
+  const lines = [];
+  for (const [name, def] of Object.entries(METRIC_DEFS)) {
+    lines.push(`# TYPE ${name} ${def.type}`, `# HELP ${name} ${def.help}`);
+    for (const entry of entries.filter(e => e.name === name)) {
+      const labels = formatMetricLabels(entry.labels);
+      if (def.type === 'counter') {
+        lines.push(`${name}_total${labels} ${formatMetricValue(entry.value)}`);
+      } else if (def.type === 'gauge') {
+        lines.push(`${name}${labels} ${formatMetricValue(entry.value)}`);
       } else {
-        item.status = 'failed';
+        def.buckets.forEach((le, index) => {
+          lines.push(`${name}_bucket${formatMetricLabels({ ...entry.labels, le: String(le) })} ${entry.counts[index]}`);
+        });
+        lines.push(`${name}_bucket${formatMetricLabels({ ...entry.labels, le: '+Inf' })} ${entry.count}`);
+        lines.push(`${name}_count${labels} ${entry.count}`, `${name}_sum${labels} ${formatMetricValue(entry.sum)}`);
       }
-      updateQueueStatus(); // Cập nhật UI ngay lập tức
     }
+  }
+  lines.push('# EOF');
+  return lines.join('\n') + '\n';
+}
 
-    // Reset và xử lý download tiếp theo
-    currentDownloadProcess = null;
-    currentDownloadId = null;
-    isDownloading = false;
-    
-    // Xử lý download tiếp theo (skip các item failed)
-    processNextDownload();
+// Số liệu của một lần chạy job tải (tổng kết thời gian từng pha, dung lượng, các lần thử/fallback)
+function recordDownloadMetrics(item) {
+  const platform = item.platform || 'generic';
+  const attempt = item.attempts && item.attempts[item.attempts.length - 1];
+  if (attempt && attempt.durationMs !== undefined) {
+    observeHistogram('redbi_job_duration_seconds', { platform }, attempt.durationMs / 1000);
+  }
+  const summary = item.metrics || {};
+  const totals = summary.totals || {};
+  incCounter('redbi_download_bytes', { platform }, summary.bytes || 0);
+  incCounter('redbi_download_seconds', { platform }, totals.attempt || 0);
+  for (const [phase, seconds] of Object.entries(totals)) {
+    incCounter('redbi_phase_seconds', { platform, phase }, seconds);
+  }
+  (summary.phases || []).filter(phase => phase.phase.startsWith('attempt:')).forEach((phase, index) => {
+    const strategy = phase.phase.slice('attempt:'.length);
+    incCounter('redbi_attempts', { platform, strategy, result: phase.ok ? 'success' : 'failure' });
+    if (index > 0) {
+      incCounter('redbi_fallback_attempts', { platform, strategy });
+    }
+  });
+}
+
+// Kết quả cuối cùng của item (sau khi tải và hậu xử lý xong) - dùng cho tỉ lệ thành công theo platform
+function recordJobOutcome(item) {
+  incCounter('redbi_jobs', { platform: item.platform || 'generic', result: item.status === 'completed' ? 'success' : 'failure' });
+}
+
+function startMetricsServer() {
+  if (metricsServer) {
+    metricsServer.close();
+    metricsServer = null;
+  }
+  if (!settings.metricsPort) {
+    return;
+  }
+  metricsServer = http.createServer((req, res) => {
+    if (req.method !== 'GET' || req.url.split('?')[0] !== '/metrics') {
+      res.writeHead(404);
+      res.end();
+      return;
+    }
+    res.writeHead(200, { 'Content-Type': OPENMETRICS_CONTENT_TYPE });
+    res.end(renderOpenMetrics());
+  });
+  metricsServer.on('error', (e) => {
+    console.error('Không mở được cổng metrics:', e.message);
   });
+  metricsServer.listen(settings.metricsPort, '127.0.0.1');
+}
+
+// Ghi metrics ra file (ghi file tạm rồi đổi tên) để công cụ khác đọc được mà không cần cổng HTTP
+function writeMetricsFile() {
+  const metricsPath = path.join(app.getPath('userData'), 'metrics.prom');
+  try {
+    fs.writeFileSync(`${metricsPath}.tmp`, renderOpenMetrics());
+    fs.renameSync(`${metricsPath}.tmp`, metricsPath);
+  } catch (e) {
+    console.error('Không ghi được metrics:', e);
+  }
 }
 
 // Cập nhật trạng thái hàng chờ cho renderer
 function updateQueueStatus() {
   if (mainWindow && !mainWindow.isDestroyed()) {
-    mainWindow.webContents.send('queue:status', {
-      queue: downloadQueue,
-      isDownloading,
-      currentDownloadId
-    });
+    mainWindow.webContents.send('queue:status', getQueueStatus());
   }
 }
 
 // Giữ lại handler cũ để tương thích (nếu cần)
 ipcMain.on('download:start', (event, downloadItem) => {
   // Chuyển sang sử dụng hàng chờ
-  const id = Date.now() + Math.random();
-  const queueItem = {
-    id,
-    ...downloadItem,
-    status: 'pending',
-    addedAt: new Date().toISOString()
-  };
-  downloadQueue.push(queueItem);
-  updateQueueStatus();
-  
-  // Nếu chưa đang download, bắt đầu download ngay
-  if (!isDownloading) {
-    processNextDownload();
-  }
+  addToQueue(downloadItem);
 });
 
 ipcMain.on('quit_and_install', () => {
   autoUpdater.quitAndInstall();
 });
 
+app.on('before-quit', () => {
+  // Dừng các worker thường trú và job đang chạy để không để lại tiến trình downloader chạy ngầm
+  idleWorkers.forEach(worker => killProcessTree(worker.proc));
+  idleWorkers = [];
+  for (const id of [...activeDownloads.keys()]) {
+    cancelActiveDownload(id);
+  }
+  // Bước hậu xử lý đang chạy được chạy lại ở lần mở app sau (journal vẫn giữ trạng thái postprocessing)
+  for (const active of activePostprocess.values()) {
+    killProcessTree(active.proc);
+  }
+  activePostprocess.clear();
+  writeMetricsFile();
+});
+
 app.on('window-all-closed', () => {
   if (process.platform !== 'darwin') {
     app.quit();
@@ -251,7 +1156,14 @@ app.on('window-all-closed', () => {
 
 app.whenReady().then(() => {
   resourcesPath = app.isPackaged ? process.resourcesPath : path.join(__dirname, 'resources');
+  loadSettings();
+  loadQueueJournal();
+  startMetricsServer();
+  setInterval(writeMetricsFile, METRICS_FILE_INTERVAL_MS);
   createWindow();
+  // Tiếp tục các item còn lại từ lần chạy trước
+  processNextDownload();
+  processPostprocessQueue();
 
   app.on('activate', () => {
     if (BrowserWindow.getAllWindows().length === 0) {
@@ -12,6 +12,10 @@ contextBridge.exposeInMainWorld('electronAPI', {
   clearQueue: () => ipcRenderer.send('queue:clear'),
   getQueueStatus: () => ipcRenderer.invoke('queue:getStatus'),
 
+  // Settings APIs (bộ lập lịch tải)
+  getSettings: () => ipcRenderer.invoke('settings:get'),
+  setSettings: (patch) => ipcRenderer.invoke('settings:set', patch),
+
   onDownloadLog: (callback) => {
     const listener = (_event, message) => callback(message);
     ipcRenderer.on('download:log', listener);
@@ -30,6 +34,12 @@ contextBridge.exposeInMainWorld('electronAPI', {
     return () => ipcRenderer.removeListener('download_finished', listener);
   },
 
+  onDownloadProgress: (callback) => {
+    const listener = (_event, progress) => callback(progress);
+    ipcRenderer.on('download:progress', listener);
+    return () => ipcRenderer.removeListener('download:progress', listener);
+  },
+
   onQueueStatus: (callback) => {
     const listener = (_event, status) => callback(status);
     ipcRenderer.on('queue:status', listener);
@@ -66,6 +66,14 @@ function App() {
   // Queue state
   const [queue, setQueue] = useState([]);
   const [currentDownloadId, setCurrentDownloadId] = useState(null);
+  const [activeDownloadIds, setActiveDownloadIds] = useState([]);
+  // Tiến độ của từng job đang tải (event progress/phase từ downloader)
+  const [progressById, setProgressById] = useState({});
+  // Cấu hình bộ lập lịch tải (lưu ở main process)
+  const [maxConcurrent, setMaxConcurrent] = useState(3);
+  const [bandwidthLimitKB, setBandwidthLimitKB] = useState(0);
+  const [metricsPort, setMetricsPort] = useState(0);
+  const [scratchDir, setScratchDir] = useState('');
 
   /** Link kênh TikTok (/@user), không phải từng video (/video/id) — cần tải cả playlist. */
   const isTikTokChannelUrl = (rawUrl) => {
@@ -113,6 +121,14 @@ function App() {
       setQueue(status.queue || []);
       setIsDownloading(status.isDownloading || false);
       setCurrentDownloadId(status.currentDownloadId || null);
+      setActiveDownloadIds(status.activeDownloadIds || []);
+    });
+
+    window.electronAPI.getSettings().then(settings => {
+      setMaxConcurrent(settings.maxConcurrent);
+      setBandwidthLimitKB(settings.bandwidthLimitKB);
+      setMetricsPort(settings.metricsPort || 0);
+      setScratchDir(settings.scratchDir || '');
     });
 
     const removeClearLogListener = window.electronAPI.onDownloadClearLog(() => {
@@ -154,6 +170,11 @@ function App() {
       setQueue(status.queue || []);
       setIsDownloading(status.isDownloading || false);
       setCurrentDownloadId(status.currentDownloadId || null);
+      setActiveDownloadIds(status.activeDownloadIds || []);
+    });
+
+    const removeProgressListener = window.electronAPI.onDownloadProgress((progress) => {
+      setProgressById(prev => ({ ...prev, [progress.id]: { ...prev[progress.id], ...progress } }));
     });
 
     const removeUpdateAvailableListener = window.electronAPI.onUpdateAvailable((info) => {
@@ -186,6 +207,7 @@ function App() {
       removeLogListener();
       removeFinishedListener();
       removeQueueStatusListener();
+      removeProgressListener();
       removeUpdateAvailableListener();
       removeUpdateDownloadedListener();
     };
@@ -196,6 +218,19 @@ function App() {
     if (path) setSavePath(path);
   };
 
+  const handleSelectScratchDir = async () => {
+    const path = await window.electronAPI.selectDirectory();
+    if (path) {
+      setScratchDir(path);
+      window.electronAPI.setSettings({ scratchDir: path });
+    }
+  };
+
+  const handleClearScratchDir = () => {
+    setScratchDir('');
+    window.electronAPI.setSettings({ scratchDir: '' });
+  };
+
   const handleAddToQueue = () => {
     if (!url || !savePath) {
       alert('Vui lòng nhập link video và chọn nơi lưu file.');
@@ -237,16 +272,42 @@ function App() {
     switch(status) {
       case 'pending': return 'Đang chờ';
       case 'downloading': return 'Đang tải...';
+      case 'postprocessing': return 'Đang xử lý sau tải...';
       case 'completed': return 'Hoàn thành';
       case 'failed': return 'Thất bại';
       default: return status;
     }
   };
 
+  const getPhaseText = (phase) => {
+    switch(phase) {
+      case 'prepare': return 'Chuẩn bị';
+      case 'extract': return 'Lấy thông tin';
+      case 'download': return 'Đang tải';
+      case 'merge': return 'Ghép file';
+      case 'postprocess': return 'Xử lý sau tải';
+      default: return phase;
+    }
+  };
+
+  const formatProgress = (progress) => {
+    if (!progress) return '';
+    const parts = [];
+    if (progress.phase) parts.push(getPhaseText(progress.phase));
+    if (progress.percent !== undefined && progress.percent !== null) parts.push(`${progress.percent.toFixed(1)}%`);
+    if (progress.fragment_count) parts.push(`fragment ${progress.fragment_index || 0}/${progress.fragment_count}`);
+    if (progress.speed) parts.push(`${(progress.speed / 1024 / 1024).toFixed(2)} MB/s`);
+    if (progress.eta !== undefined && progress.eta !== null && progress.status === 'downloading') {
+      parts.push(`còn ${Math.floor(progress.eta / 60)}:${String(Math.floor(progress.eta % 60)).padStart(2, '0')}`);
+    }
+    return parts.join(' · ');
+  };
+
   const getStatusColor = (status) => {
     switch(status) {
       case 'pending': return '#888';
       case 'downloading': return '#4a90e2';
+      case 'postprocessing': return '#9c27b0';
       case 'completed': return '#4caf50';
       case 'failed': return '#f44336';
       default: return '#888';
@@ -355,8 +416,13 @@ function App() {
         {downloadFormat === 'video' && (
           <div className="input-group">
             <label htmlFor="quality-select">Chất lượng Video:</label>
-            <input id="quality-select" type="text" value="1080p (ưu tiên) / 720p / Tốt nhất" readOnly style={{opacity: 0.7, cursor: 'not-allowed'}}/>
-            <small style={{display: 'block', marginTop: '4px', color: '#666', fontSize: '12px'}}>Ưu tiên 1080p, nếu không có thì 720p, nếu không có thì tải chất lượng cao nhất có sẵn</small>
+            <select id="quality-select" value={quality} onChange={(e) => setQuality(e.target.value)}>
+              <option value="1080p">Tối đa 1080p</option>
+              <option value="720p">Tối đa 720p</option>
+              <option value="best">Tốt nhất có sẵn</option>
+              <option value="audio">Chỉ audio (giữ định dạng gốc)</option>
+            </select>
+            <small style={{display: 'block', marginTop: '4px', color: '#666', fontSize: '12px'}}>Chọn format cao nhất không vượt mức này; nếu video không có thì tải mức gần nhất có sẵn</small>
           </div>
         )}
 
@@ -373,6 +439,72 @@ function App() {
             </small>
           )}
         </div>
+        <div className="input-group">
+          <label htmlFor="concurrent-input">Số link tải cùng lúc:</label>
+          <input
+            id="concurrent-input"
+            type="number"
+            min="1"
+            max="8"
+            value={maxConcurrent}
+            onChange={(e) => {
+              const value = Math.max(1, parseInt(e.target.value, 10) || 1);
+              setMaxConcurrent(value);
+              window.electronAPI.setSettings({ maxConcurrent: value });
+            }}
+          />
+        </div>
+
+        <div className="input-group">
+          <label htmlFor="bandwidth-input">Giới hạn tốc độ tổng (KB/s, 0 = không giới hạn):</label>
+          <input
+            id="bandwidth-input"
+            type="number"
+            min="0"
+            step="100"
+            value={bandwidthLimitKB}
+            onChange={(e) => {
+              const value = Math.max(0, parseInt(e.target.value, 10) || 0);
+              setBandwidthLimitKB(value);
+              window.electronAPI.setSettings({ bandwidthLimitKB: value });
+            }}
+          />
+          <small style={{ display: 'block', marginTop: '4px', color: '#666', fontSize: '12px' }}>
+            Băng thông được chia đều cho các link đang tải. TikTok/Douyin tối đa 2 link cùng lúc để tránh bị chặn.
+          </small>
+        </div>
+
+        <div className="input-group">
+          <label htmlFor="metrics-port-input">Cổng metrics (0 = tắt):</label>
+          <input
+            id="metrics-port-input"
+            type="number"
+            min="0"
+            max="65535"
+            value={metricsPort}
+            onChange={(e) => {
+              const value = Math.min(65535, Math.max(0, parseInt(e.target.value, 10) || 0));
+              setMetricsPort(value);
+              window.electronAPI.setSettings({ metricsPort: value });
+            }}
+          />
+          <small style={{ display: 'block', marginTop: '4px', color: '#666', fontSize: '12px' }}>
+            Số liệu tải (OpenMetrics) tại http://127.0.0.1:{metricsPort || 'cổng'}/metrics; luôn được ghi ra file metrics.prom trong thư mục dữ liệu của app.
+          </small>
+        </div>
+
+        <div className="input-group">
+          <label htmlFor="scratch-dir-input">Thư mục tạm (ổ nhanh, để trống = tắt):</label>
+          <div className="path-container">
+            <input id="scratch-dir-input" type="text" value={scratchDir} readOnly placeholder="Tải thẳng vào thư mục lưu"/>
+            <button onClick={handleSelectScratchDir}>Chọn</button>
+            {scratchDir && <button onClick={handleClearScratchDir}>Bỏ</button>}
+          </div>
+          <small style={{ display: 'block', marginTop: '4px', color: '#666', fontSize: '12px' }}>
+            File đang tải và file trung gian nằm ở đây; chỉ file hoàn chỉnh mới được chuyển sang thư mục lưu.
+          </small>
+        </div>
+
         <div className="cookie-group">
             <button onClick={() => handleAddCookieFile(false)} className="btn-secondary">
                 {cookieFileName ? `Đang dùng: ${cookieFileName}` : 'Thêm Cookies (Tùy chọn)'}
@@ -390,16 +522,31 @@ function App() {
           </div>
           <div className="queue-list">
             {queue.map((item) => (
-              <div key={item.id} className={`queue-item ${item.id === currentDownloadId ? 'active' : ''}`}>
+              <div key={item.id} className={`queue-item ${activeDownloadIds.includes(item.id) || item.id === currentDownloadId ? 'active' : ''}`}>
                 <div className="queue-item-info">
                   <div className="queue-item-url" title={item.url}>
-                    {item.url.length > 60 ? item.url.substring(0, 60) + '...' : item.url}
+                    {item.parentId ? '↳ ' : ''}
+                    {item.title || (item.url.length > 60 ? item.url.substring(0, 60) + '...' : item.url)}
                   </div>
                   <div className="queue-item-meta">
                     <span className="queue-status" style={{ color: getStatusColor(item.status) }}>
-                      {getStatusText(item.status)}
+                      {item.skipped ? 'Đã tải trước đó' : getStatusText(item.status)}
                     </span>
                     <span className="queue-format">{item.downloadFormat === 'mp3' ? 'MP3' : 'Video'}</span>
+                    {item.status === 'downloading' && !item.listed && progressById[item.id] && (
+                      <span className="queue-format">{formatProgress(progressById[item.id])}</span>
+                    )}
+                    {item.status === 'postprocessing' && item.postprocess && (
+                      <span className="queue-format">
+                        Hậu xử lý: {item.postprocess.filter(task => task.status === 'completed').length}/{item.postprocess.length}
+                      </span>
+                    )}
+                    {item.listed && (
+                      <span className="queue-format">
+                        Playlist: {item.done || 0}/{item.total || 0}
+                        {item.failedCount ? ` (${item.failedCount} lỗi)` : ''}
+                      </span>
+                    )}
                   </div>
                 </div>
                 <div className="queue-item-actions">
@@ -415,8 +562,8 @@ function App() {
                   <button 
                     onClick={() => handleRemoveFromQueue(item.id)} 
                     className="remove-queue-btn"
-                    disabled={item.status === 'downloading'}
-                    title={item.status === 'downloading' ? 'Không thể xóa khi đang tải' : 'Xóa khỏi hàng chờ'}
+                    disabled={item.status === 'downloading' && !item.listed}
+                    title={item.status === 'downloading' && !item.listed ? 'Không thể xóa khi đang tải' : 'Xóa khỏi hàng chờ'}
                   >
                     ×
                   </button>